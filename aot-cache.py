@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Ahead-of-time compilation cache for an unpacked python webc like python-with-packages.
+
+`warm` compiles python3.wasm and every shared module in the package into wasmer's module cache once per build.
+It loads every module twice to measure compile times and to verify that the second load is served from the cache.
+The results are kept in <cache dir>/aot-manifest.json.
+
+`report` estimates the compile and execution time of each test of a run-tests.sh run. Modules that were compiled
+while a test was running count as cache misses of that test. Tests run in parallel share the cache, so a module
+compiled while several tests ran can't be attributed to one of them. It counts as a shared miss of each, and its
+compile time is split between them.
+"""
+from build_common import file_sha256
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import hashlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+wasmer = os.getenv('WASMER', 'wasmer')
+cache_dir = os.path.abspath(os.getenv('WASMER_CACHE_DIR', '.wasmer-cache'))
+manifest_file = os.path.join(cache_dir, 'aot-manifest.json')
+
+# Runs inside the package. dlopen()s the modules listed in a file and prints the time each one took to load
+loader_script = """
+import ctypes, json, sys, time
+for path in open(sys.argv[1]).read().split():
+    start = time.perf_counter()
+    try:
+        ctypes.CDLL(path)
+        error = None
+    except Exception as e:
+        error = str(e)
+    print(json.dumps({'path': path, 'seconds': time.perf_counter() - start, 'error': error}), flush=True)
+"""
+
+def find_modules(package):
+    """Get the shared modules of an unpacked package, mapped to their path inside the package."""
+    modules = {}
+    root = os.path.join(package, 'root')
+    for path in glob.glob(os.path.join(root, '**', '*.so*'), recursive=True):
+        name = os.path.basename(path)
+        if os.path.isfile(path) and not os.path.islink(path) and (name.endswith('.so') or '.so.' in name):
+            modules['/' + os.path.relpath(path, root)] = path
+    return dict(sorted(modules.items()))
+
+def cache_entries():
+    """Get the compiled artifacts in the module cache with their modification time."""
+    entries = {}
+    for directory, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if path != manifest_file:
+                entries[path] = os.path.getmtime(path)
+    return entries
+
+def wasmer_run(package, *args, mapdir=None):
+    command = [wasmer, 'run', '--llvm']
+    if mapdir is not None:
+        command.append(f'--mapdir=/aot:{mapdir}')
+    command += [package, '--', *args]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, env={**os.environ, 'WASMER_CACHE_DIR': cache_dir})
+    return time.perf_counter() - start, result
+
+def load_modules(package, paths, jobs):
+    """Load all modules in parallel batches. Returns a dict of path to load time, or to None if loading failed."""
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'load.py'), 'w') as f:
+            f.write(loader_script)
+        batches = [paths[i::jobs] for i in range(jobs) if paths[i::jobs]]
+        for i, batch in enumerate(batches):
+            with open(os.path.join(tmp_dir, f'batch-{i}'), 'w') as f:
+                f.write('\n'.join(batch))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(lambda i: wasmer_run(package, '/aot/load.py', f'/aot/batch-{i}', mapdir=tmp_dir)[1], range(len(batches)))
+            for result in results:
+                for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    times[entry['path']] = entry['seconds'] if entry['error'] is None else None
+    return times
+
+def load_manifest():
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def command_warm(args):
+    os.makedirs(cache_dir, exist_ok=True)
+    wasmer_version = subprocess.run([wasmer, '--version'], capture_output=True).stdout.decode('utf-8').strip()
+    python = os.path.join(args.package, 'root', 'usr', 'local', 'bin', 'python3.wasm')
+    modules = find_modules(args.package)
+    hashes = {path: file_sha256(file_path) for path, file_path in modules.items()}
+    stamp = hashlib.sha256(json.dumps([wasmer_version, file_sha256(python), hashes]).encode('utf-8')).hexdigest()
+
+    manifest = load_manifest()
+    if manifest is not None and manifest['stamp'] == stamp and not args.force:
+        print(f"AOT cache for {args.package} is up to date ({len(modules)} modules)")
+        return
+
+    # python3.wasm is compiled by the first run, the second run shows the startup time with a cache hit
+    python_cold, result = wasmer_run(args.package, '-c', 'pass')
+    if result.returncode != 0:
+        print(f"Failed to run python from {args.package}:\n{result.stderr.decode('utf-8', errors='replace')}", file=sys.stderr)
+        exit(1)
+    python_warm, _ = wasmer_run(args.package, '-c', 'pass')
+    print(f"python3.wasm: compiled in {python_cold - python_warm:.2f}s, starts in {python_warm:.2f}s from the cache")
+
+    start = time.perf_counter()
+    cold = load_modules(args.package, list(modules), args.jobs)
+    print(f"Compiled {len(modules)} shared modules in {time.perf_counter() - start:.2f}s with {args.jobs} workers")
+
+    # Loading everything again must not add anything to the cache
+    entries = cache_entries()
+    warm = load_modules(args.package, list(modules), args.jobs)
+    misses = sorted(set(cache_entries()) - set(entries))
+
+    failed = sorted(path for path in modules if cold.get(path) is None or warm.get(path) is None)
+    for path in failed:
+        print(f"Warning: Could not load {path}")
+    module_entries = {}
+    for path in modules:
+        if cold.get(path) is not None and warm.get(path) is not None:
+            module_entries[path] = {'sha256': hashes[path], 'compile': max(cold[path] - warm[path], 0), 'load': warm[path]}
+
+    manifest = {
+        'stamp': stamp,
+        'wasmer': wasmer_version,
+        'package': os.path.abspath(args.package),
+        'python': {'compile': max(python_cold - python_warm, 0), 'startup': python_warm},
+        'modules': module_entries,
+    }
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if misses:
+        print(f"Cache check failed: loading the modules again compiled {len(misses)} of them again", file=sys.stderr)
+        exit(1)
+    print(f"Cache check passed: {len(module_entries)} modules loaded from the cache, {len(failed)} could not be loaded")
+
+def command_report(args):
+    manifest = load_manifest()
+    if manifest is None:
+        print(f"No AOT manifest in {cache_dir}, run `aot-cache.py warm` first", file=sys.stderr)
+        exit(1)
+    compile_times = {module['sha256']: module['compile'] for module in manifest['modules'].values()}
+    typical_compile_time = statistics.median(compile_times.values()) if compile_times else 0
+    entries = cache_entries()
+
+    results_file = os.path.join(args.results, 'results.json')
+    with open(results_file, 'r') as f:
+        results = json.load(f)
+    tests = [test for test in results['tests'] if test['status'] != 'skipped' and test.get('start') is not None]
+    # Every test that was running when a module was compiled could have compiled it
+    candidates = {path: [test for test in tests if test['start'] <= mtime <= test['start'] + test['duration']] for path, mtime in entries.items()}
+    misses = {path: running for path, running in candidates.items() if running}
+    for test in tests:
+        test['cache_misses'] = 0
+        test['shared_cache_misses'] = 0
+        test['compile_time'] = 0
+    for path, running in misses.items():
+        # The cache is keyed by module hash, artifacts of modules we know get their measured compile time
+        compile_time = compile_times.get(os.path.basename(path).split('.')[0], typical_compile_time)
+        for test in running:
+            test['cache_misses' if len(running) == 1 else 'shared_cache_misses'] += 1
+            test['compile_time'] += compile_time / len(running)
+    for test in tests:
+        test['compile_time'] = round(min(test['compile_time'], test['duration']), 3)
+        test['execution_time'] = round(max(test['duration'] - test['compile_time'] - manifest['python']['startup'], 0), 3)
+    shared_misses = sum(1 for running in misses.values() if len(running) > 1)
+    results['startup_time'] = round(manifest['python']['startup'], 3)
+    with open(results_file, 'w') as f:
+        json.dump(results, f)
+
+    print(f"{'test':<48} {'total':>8} {'compile':>8} {'execute':>8} {'misses':>6} {'shared':>6}")
+    for test in sorted(tests, key=lambda test: test['duration'], reverse=True)[:args.top]:
+        print(f"{test['name']:<48} {test['duration']:>8.2f} {test['compile_time']:>8.2f} {test['execution_time']:>8.2f} {test['cache_misses']:>6} {test['shared_cache_misses']:>6}")
+    print(f"Startup from the cache: {manifest['python']['startup']:.2f}s per test")
+    print(f"Compile time: {sum(test['compile_time'] for test in tests):.2f}s, execution time: {sum(test['execution_time'] for test in tests):.2f}s")
+    if shared_misses:
+        print(f"{shared_misses} modules were compiled while several tests ran, they are shared misses of each and their compile time is split between them")
+    if misses:
+        print(f"{len(misses)} modules were compiled during the tests. Rebuild the cache with `make python-with-packages.aot`")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    warm_parser = subparsers.add_parser('warm', help='Compile python and all shared modules of a package into the cache')
+    warm_parser.add_argument('package', nargs='?', default='python-with-packages', help='Unpacked webc (default: python-with-packages)')
+    warm_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of wasmer processes compiling in parallel (default: number of cores)')
+    warm_parser.add_argument('--force', action='store_true', help='Compile and check again even if the package did not change')
+    warm_parser.set_defaults(handler=command_warm)
+
+    report_parser = subparsers.add_parser('report', help='Split the test durations of a run-tests.sh run into compile and execution time')
+    report_parser.add_argument('results', nargs='?', default='test-results', help='Results directory of run-tests.sh (default: test-results)')
+    report_parser.add_argument('--top', type=int, default=20, help='Number of tests to show (default: 20)')
+    report_parser.set_defaults(handler=command_report)
+
+    args = parser.parse_args()
+    args.handler(args)
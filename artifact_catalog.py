@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""SQLite catalog of everything in artifacts/.
+
+The Makefile records every artifact it produces with `add`. Index generation, install targets and
+assembly query the catalog instead of rescanning the filesystem. `sync` brings the catalog up to date
+with artifacts/ and the pkgs/ symlinks; artifacts whose size, mtime and inode did not change are never read again.
+"""
+from build_common import canonicalize_name, file_sha256
+from email.parser import BytesParser
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import zipfile
+
+catalog_file = os.getenv('ARTIFACT_CATALOG', 'catalog.sqlite')
+# Seconds to wait for parallel `add` and `sync` runs of make -j to release the database
+busy_timeout = 60
+
+# Suffixes of the pkgs/<project>.<suffix> symlinks and the kind of artifact they point to
+artifact_kinds = {
+    '.whl': 'wheel',
+    '.tar.gz': 'sdist',
+    '.tar.zst': 'lib',
+    '.tar.xz': 'lib',
+    '.webc': 'webc',
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    project TEXT,
+    name TEXT NOT NULL,
+    version TEXT,
+    tags TEXT,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    native INTEGER,
+    source_commit TEXT,
+    dependencies TEXT NOT NULL,
+    core_metadata BLOB,
+    stat_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_name_version ON artifacts (name, version);
+CREATE INDEX IF NOT EXISTS artifacts_project ON artifacts (project, kind);
+"""
+
+def artifact_suffix(filename):
+    for suffix in artifact_kinds:
+        if filename.endswith(suffix):
+            return suffix
+    return None
+
+def artifact_kind(filename):
+    return artifact_kinds.get(artifact_suffix(filename))
+
+def parse_filename(filename):
+    """Get the kind, canonical name, version and tags of an artifact from its filename."""
+    kind = artifact_kind(filename)
+    if kind == 'wheel':
+        # {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+        parts = filename[:-len('.whl')].split('-')
+        return kind, canonicalize_name(parts[0]), parts[1], '-'.join(parts[-3:])
+    if kind == 'sdist':
+        name, _, version = filename[:-len('.tar.gz')].rpartition('-')
+        return kind, canonicalize_name(name or version), version if name else None, 'sdist'
+    # Libs and webcs are named after the project and carry no version
+    stem = filename[:-len(artifact_suffix(filename))] if kind == 'lib' else os.path.splitext(filename)[0]
+    return kind, canonicalize_name(stem), None, None
+
+def stat_key(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+
+def inspect_wheel(wheel_path):
+    """Check if a wheel file contains native binaries (.so, .so.*, or .wasm files) and extract its core metadata.
+
+    Returns a tuple of (contains native binaries, contents of the *.dist-info/METADATA file or None)."""
+    try:
+        with zipfile.ZipFile(wheel_path, 'r') as zip_file:
+            contains_native_binaries = False
+            metadata_path = None
+            for file_info in zip_file.namelist():
+                # Check for .so, .so.*, or .wasm files
+                if file_info.endswith('.so') or '.so.' in file_info or file_info.endswith('.wasm'):
+                    contains_native_binaries = True
+                # The core metadata is always in the top-level .dist-info directory
+                directory, _, name = file_info.partition('/')
+                if metadata_path is None and directory.endswith('.dist-info') and name == 'METADATA':
+                    metadata_path = file_info
+            metadata = zip_file.read(metadata_path) if metadata_path is not None else None
+            return contains_native_binaries, metadata
+    except Exception as e:
+        print(f"Warning: Could not inspect {wheel_path}: {e}")
+        # If we can't check, include it to be safe
+        return True, None
+
+def pkg_config_requires(lib_dir):
+    """Get the pkg-config modules required by the .pc files of an unpacked lib."""
+    requires = set()
+    for pc_file in glob.glob(os.path.join(lib_dir, '**/*.pc'), recursive=True):
+        with open(pc_file, 'r', errors='replace') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() in ('Requires', 'Requires.private'):
+                    # Entries are separated by commas or spaces and may carry version constraints
+                    for module in re.split(r'[\s,]+', re.sub(r'[<>=!]+\s*\S+', '', value)):
+                        if module:
+                            requires.add(module)
+    return sorted(requires)
+
+def inspect_artifact(path):
+    """Collect the facts about an artifact that require reading it. Runs in worker processes during sync."""
+    kind = artifact_kind(os.path.basename(path))
+    facts = {
+        'stat_key': stat_key(path),
+        'sha256': file_sha256(path),
+        'size': os.path.getsize(path),
+        'native': None,
+        'dependencies': [],
+        'core_metadata': None,
+    }
+    if kind == 'wheel':
+        native, metadata = inspect_wheel(path)
+        facts['native'] = native
+        facts['core_metadata'] = metadata
+        if metadata is not None:
+            facts['dependencies'] = BytesParser().parsebytes(metadata, headersonly=True).get_all('Requires-Dist') or []
+    elif kind in ('lib', 'webc'):
+        facts['native'] = True
+    return facts
+
+def source_commit(source_dir):
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, cwd=source_dir)
+    return result.stdout.decode('utf-8').strip() or None
+
+def source_version(source_dir):
+    result = subprocess.run(['git', 'describe', '--tags', '--always'], capture_output=True, cwd=source_dir)
+    return result.stdout.decode('utf-8').strip() or None
+
+def project_symlinks(pkgs_dir='pkgs'):
+    """Map the artifacts that pkgs/<project>.<suffix> symlinks point to to their project."""
+    projects = {}
+    for link in glob.glob(os.path.join(pkgs_dir, '*')):
+        if not os.path.islink(link):
+            continue
+        filename = os.path.basename(link)
+        suffix = artifact_suffix(filename)
+        if suffix is None:
+            continue
+        projects[os.path.relpath(os.path.realpath(link))] = filename[:-len(suffix)]
+    return projects
+
+class Catalog:
+    def __init__(self, path=catalog_file):
+        self.db = sqlite3.connect(path, timeout=busy_timeout)
+        self.db.row_factory = sqlite3.Row
+        # Readers don't block the writer and the other way round
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.db.commit()
+        self.db.close()
+
+    def get(self, path):
+        return self.db.execute('SELECT * FROM artifacts WHERE path = ?', (path,)).fetchone()
+
+    def is_current(self, path):
+        row = self.db.execute('SELECT stat_key FROM artifacts WHERE path = ?', (path,)).fetchone()
+        return row is not None and row['stat_key'] == stat_key(path)
+
+    def record(self, path, facts, project=None, commit=None, version=None, dependencies=None):
+        """Insert or update an artifact. Values that are not passed are kept from the previous record."""
+        previous = self.get(path)
+        filename = os.path.basename(path)
+        kind, name, parsed_version, tags = parse_filename(filename)
+        if previous is not None and previous['sha256'] == facts['sha256']:
+            project = project or previous['project']
+            commit = commit or previous['source_commit']
+            version = version or previous['version']
+            if dependencies is None and not facts['dependencies']:
+                dependencies = json.loads(previous['dependencies'])
+        self.db.execute(
+            'INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                path, filename, kind, project, name, parsed_version or version, tags,
+                facts['sha256'], facts['size'], facts['native'], commit,
+                json.dumps(dependencies if dependencies is not None else facts['dependencies']),
+                facts['core_metadata'], facts['stat_key'],
+            ))
+        # Don't hold the write lock while the next artifact is inspected
+        self.db.commit()
+
+    def sync(self, paths, executor=None, projects=None):
+        """Record all paths that changed since they were last recorded. Returns the number of (hits, misses)."""
+        projects = projects or {}
+        changed = [path for path in paths if not self.is_current(path)]
+        results = executor.map(inspect_artifact, changed) if executor is not None else map(inspect_artifact, changed)
+        for path, facts in zip(changed, results):
+            self.record(path, facts, project=projects.get(path))
+        # Fill in missing projects, they only depend on the pkgs/ symlinks
+        for path, project in projects.items():
+            self.db.execute('UPDATE artifacts SET project = ? WHERE path = ? AND project IS NULL', (project, path))
+        self.db.commit()
+        return len(paths) - len(changed), len(changed)
+
+    def remove_missing(self):
+        missing = [row['path'] for row in self.db.execute('SELECT path FROM artifacts') if not os.path.exists(row['path'])]
+        self.db.executemany('DELETE FROM artifacts WHERE path = ?', [(path,) for path in missing])
+        self.db.commit()
+        return missing
+
+    def wheels_for(self, name, version):
+        """Get the paths of all wheels of a distribution version in artifacts/. A version of None matches every version."""
+        # Wheels left in the dist/ directories of the build trees are recorded through the pkgs/ symlinks
+        rows = self.db.execute(
+            "SELECT path FROM artifacts WHERE kind = 'wheel' AND name = ? AND (? IS NULL OR version = ?) AND path LIKE 'artifacts/%' ORDER BY path",
+            (canonicalize_name(name), version, version))
+        return [row['path'] for row in rows]
+
+    def for_project(self, project, kind=None):
+        if kind is None:
+            return self.db.execute('SELECT * FROM artifacts WHERE project = ? ORDER BY path', (project,)).fetchall()
+        return self.db.execute('SELECT * FROM artifacts WHERE project = ? AND kind = ? ORDER BY path', (project, kind)).fetchall()
+
+    def all(self):
+        return self.db.execute('SELECT * FROM artifacts ORDER BY path').fetchall()
+
+def command_add(catalog, args):
+    for path in args.artifacts:
+        path = os.path.relpath(os.path.realpath(path))
+        facts = inspect_artifact(path)
+        # Not every lib is built from a submodule
+        has_source = args.source is not None and os.path.isdir(args.source)
+        commit = source_commit(args.source) if has_source else None
+        version = source_version(args.source) if has_source else None
+        dependencies = pkg_config_requires(args.lib_dir) if args.lib_dir else None
+        catalog.record(path, facts, project=args.project, commit=commit, version=version, dependencies=dependencies)
+
+def sync_artifacts(catalog):
+    """Bring the catalog up to date with artifacts/ and the pkgs/ symlinks."""
+    projects = project_symlinks()
+    paths = sorted(set(glob.glob('artifacts/*')) | set(projects))
+    paths = [path for path in paths if os.path.isfile(path) and artifact_kind(path) is not None]
+    hits, misses = catalog.sync(paths, projects=projects)
+    removed = catalog.remove_missing()
+    print(f"Catalog: {hits} unchanged, {misses} updated, {len(removed)} removed", file=sys.stderr)
+
+def command_sync(catalog, args):
+    sync_artifacts(catalog)
+
+def command_path(catalog, args):
+    rows = catalog.for_project(args.project, args.kind)
+    if not rows:
+        print(f"No {args.kind or 'artifact'} recorded for {args.project}", file=sys.stderr)
+        exit(1)
+    for row in rows:
+        print(row['path'])
+
+def command_targets(catalog, args):
+    """Print the pkgs/ targets of every recorded artifact, e.g. to pass them to make with -o."""
+    for row in catalog.all():
+        if row['project'] is None:
+            continue
+        if args.kind is None or row['kind'] in args.kind:
+            print(f"pkgs/{row['project']}{artifact_suffix(row['filename'])}")
+
+def command_list(catalog, args):
+    for row in catalog.all():
+        entry = {key: row[key] for key in row.keys() if key not in ('core_metadata', 'stat_key')}
+        entry['dependencies'] = json.loads(entry['dependencies'])
+        entry['native'] = None if entry['native'] is None else bool(entry['native'])
+        if args.json:
+            print(json.dumps(entry))
+        else:
+            print(f"{row['path']}\t{row['project'] or '-'}\t{row['name']}\t{row['version'] or '-'}\t{row['sha256']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', default=catalog_file, help=f'Path to the catalog database (default: {catalog_file}, or $ARTIFACT_CATALOG)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help='Record artifacts that were just built')
+    add_parser.add_argument('artifacts', nargs='+')
+    add_parser.add_argument('--project', help='Name of the project in the Makefile')
+    add_parser.add_argument('--source', help='Submodule the artifact was built from, to record its commit and version')
+    add_parser.add_argument('--lib-dir', help='Unpacked lib, to record the pkg-config modules it requires')
+    add_parser.set_defaults(handler=command_add)
+
+    sync_parser = subparsers.add_parser('sync', help='Record all changed artifacts in artifacts/ and pkgs/')
+    sync_parser.set_defaults(handler=command_sync)
+
+    path_parser = subparsers.add_parser('path', help='Print the artifacts of a project')
+    path_parser.add_argument('project')
+    path_parser.add_argument('--kind', choices=sorted(artifact_kinds.values()))
+    path_parser.set_defaults(handler=command_path)
+
+    targets_parser = subparsers.add_parser('targets', help='Print the pkgs/ targets of all recorded artifacts')
+    targets_parser.add_argument('--kind', action='append', choices=sorted(artifact_kinds.values()), help='Only print artifacts of this kind. Can be repeated')
+    targets_parser.set_defaults(handler=command_targets)
+
+    list_parser = subparsers.add_parser('list', help='Print all recorded artifacts')
+    list_parser.add_argument('--json', action='store_true', help='Print one JSON object per artifact')
+    list_parser.set_defaults(handler=command_list)
+
+    args = parser.parse_args()
+    with Catalog(args.catalog) as catalog:
+        args.handler(catalog, args)
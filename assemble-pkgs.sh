@@ -8,6 +8,9 @@
 # ARG_OPTIONAL_SINGLE([artifact-dir],[],[If this is set, artifacts are picked from this directory instead of being downloaded from a github release])
 # ARG_OPTIONAL_SINGLE([release],[],[Select the github release from which to download artifacts])
 # ARG_OPTIONAL_SINGLE([github-token],[],[Github token to use for API requests])
+# ARG_OPTIONAL_SINGLE([catalog],[],[Artifact catalog used to find and verify the artifacts in --artifact-dir. Defaults to the catalog.sqlite next to the artifact directory if it exists])
+# ARG_OPTIONAL_SINGLE([jobs],[j],[Number of packages that are downloaded and extracted in parallel. Defaults to the number of cores])
+# ARG_OPTIONAL_SINGLE([cache-dir],[],[Directory downloaded release assets are cached in. Defaults to $XDG_CACHE_HOME/wasix-build-scripts])
 # ARG_OPTIONAL_BOOLEAN([merge],[m],[Allow installing packages into an existing sysroot directory],[off])
 
 # ARG_HELP([Fetch and combine multiple packages from build-scripts into one directory])
@@ -29,7 +32,7 @@ die()
 
 begins_with_short_option()
 {
-	local first_option all_short_options='iomh'
+	local first_option all_short_options='iojmh'
 	first_option="${1:0:1}"
 	test "$all_short_options" = "${all_short_options/$first_option/}" && return 1 || return 0
 }
@@ -40,18 +43,24 @@ _arg_output_dir=
 _arg_artifact_dir=
 _arg_release=
 _arg_github_token=
+_arg_catalog=
+_arg_jobs=
+_arg_cache_dir=
 _arg_merge="off"
 
 
 print_help()
 {
 	printf '%s\n' "Fetch and combine multiple packages from build-scripts into one directory"
-	printf 'Usage: %s [-i|--input <arg>] [-o|--output-dir <arg>] [--artifact-dir <arg>] [--release <arg>] [--github-token <arg>] [-m|--(no-)merge] [-h|--help]\n' "$0"
+	printf 'Usage: %s [-i|--input <arg>] [-o|--output-dir <arg>] [--artifact-dir <arg>] [--release <arg>] [--github-token <arg>] [--catalog <arg>] [-j|--jobs <arg>] [--cache-dir <arg>] [-m|--(no-)merge] [-h|--help]\n' "$0"
 	printf '\t%s\n' "-i, --input: List of input libraries (empty by default)"
 	printf '\t%s\n' "-o, --output-dir: Output directory (no default)"
 	printf '\t%s\n' "--artifact-dir: If this is set, artifacts are picked from this directory instead of being downloaded from a github release (no default)"
 	printf '\t%s\n' "--release: Select the github release from which to download artifacts (no default)"
 	printf '\t%s\n' "--github-token: Github token to use for API requests (no default)"
+	printf '\t%s\n' "--catalog: Artifact catalog used to find and verify the artifacts in --artifact-dir. Defaults to the catalog.sqlite next to the artifact directory if it exists (no default)"
+	printf '\t%s\n' "-j, --jobs: Number of packages that are downloaded and extracted in parallel. Defaults to the number of cores (no default)"
+	printf '\t%s\n' "--cache-dir: Directory downloaded release assets are cached in. Defaults to \$XDG_CACHE_HOME/wasix-build-scripts (no default)"
 	printf '\t%s\n' "-m, --merge, --no-merge: Allow installing packages into an existing sysroot directory (off by default)"
 	printf '\t%s\n' "-h, --help: Prints help"
 }
@@ -110,6 +119,33 @@ parse_commandline()
 			--github-token=*)
 				_arg_github_token="${_key##--github-token=}"
 				;;
+			--catalog)
+				test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+				_arg_catalog="$2"
+				shift
+				;;
+			--catalog=*)
+				_arg_catalog="${_key##--catalog=}"
+				;;
+			-j|--jobs)
+				test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+				_arg_jobs="$2"
+				shift
+				;;
+			--jobs=*)
+				_arg_jobs="${_key##--jobs=}"
+				;;
+			-j*)
+				_arg_jobs="${_key##-j}"
+				;;
+			--cache-dir)
+				test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+				_arg_cache_dir="$2"
+				shift
+				;;
+			--cache-dir=*)
+				_arg_cache_dir="${_key##--cache-dir=}"
+				;;
 			-m|--no-merge|--merge)
 				_arg_merge="on"
 				test "${1:0:5}" = "--no-" && _arg_merge="off"
@@ -145,7 +181,6 @@ parse_commandline "$@"
 ### END OF CODE GENERATED BY Argbash (sortof) ### ])
 # [ <-- needed because of Argbash
 
-
 set -e
 
 function check_command {
@@ -159,19 +194,29 @@ check_command curl
 check_command mktemp
 check_command tar
 check_command sed
-check_command xz
+# Packages are published as .tar.zst and as .tar.xz. Older releases only have .tar.xz
+if command -v zstd &> /dev/null ; then
+    FORMATS=( tar.zst tar.xz )
+else
+    check_command xz
+    FORMATS=( tar.xz )
+fi
+if ! command -v sha256sum &> /dev/null ; then
+    check_command shasum
+fi
 
 VERSION=latest
 if test -n "$_arg_release" ; then
     VERSION="$_arg_release"
 fi
 
-if test "$VERSION" = "latest" ; then
-    if [ -n "$_arg_github_token" ]; then
-        VERSION="$(curl -s -H "authorization: Bearer $_arg_github_token" https://api.github.com/repos/wasix-org/build-scripts/releases/latest | grep '"tag_name"' | sed -E 's/.*"([^"]+)".*/\1/')"
-    else
-        VERSION="$(curl -s https://api.github.com/repos/wasix-org/build-scripts/releases/latest | grep '"tag_name"' | sed -E 's/.*"([^"]+)".*/\1/')"
-    fi
+CURL_AUTH=()
+if [ -n "$_arg_github_token" ]; then
+    CURL_AUTH=( -H "authorization: Bearer $_arg_github_token" )
+fi
+
+if test "$VERSION" = "latest" && test -z "$_arg_artifact_dir" ; then
+    VERSION="$(curl -s "${CURL_AUTH[@]}" https://api.github.com/repos/wasix-org/build-scripts/releases/latest | grep '"tag_name"' | sed -E 's/.*"([^"]+)".*/\1/')"
 fi
 
 if test -z "$_arg_output_dir" ; then
@@ -179,6 +224,21 @@ if test -z "$_arg_output_dir" ; then
     exit 1
 fi
 
+JOBS="$_arg_jobs"
+if test -z "$JOBS" ; then
+    JOBS="$(getconf _NPROCESSORS_ONLN 2>/dev/null || echo 4)"
+fi
+if ! test "$JOBS" -gt 0 2>/dev/null ; then
+    echo "--jobs must be a positive number (got $JOBS)" >&2
+    exit 1
+fi
+
+# Downloaded release assets are kept in sha256/<checksum>. releases/<tag>/<asset>.sha256 records the checksum of an asset
+CACHE_DIR="$_arg_cache_dir"
+if test -z "$CACHE_DIR" ; then
+    CACHE_DIR="${XDG_CACHE_HOME:-$HOME/.cache}/wasix-build-scripts"
+fi
+
 ASSEMBLED_DIR="$_arg_output_dir"
 if test -e "$ASSEMBLED_DIR" ; then
     if test "$_arg_merge" = "off" ; then
@@ -200,26 +260,337 @@ if test -n "$_arg_artifact_dir" ; then
     fi
 fi
 
-TMP_DIR=$(mktemp -d)
-
-for input in "${_arg_input[@]}" ; do
-    output="$TMP_DIR/$input.tar.xz"
-    if test -f "$output" ; then
-        echo "Temporary file $output already exists. aborting." >&2
+# The artifact catalog of a build-scripts checkout lives next to its artifacts directory
+CATALOG=""
+if test -n "$_arg_catalog" ; then
+    CATALOG="$(realpath "$_arg_catalog")"
+elif test -n "$ARTIFACT_DIR" && test -f "$ARTIFACT_DIR/../catalog.sqlite" ; then
+    CATALOG="$(realpath "$ARTIFACT_DIR/../catalog.sqlite")"
+fi
+if test -n "$CATALOG" ; then
+    if test -z "$ARTIFACT_DIR" ; then
+        echo "--catalog requires --artifact-dir" >&2
         exit 1
     fi
-    if test -n "$ARTIFACT_DIR" ; then
-        cp "$ARTIFACT_DIR/$input.tar.xz" "$output"
+    check_command sqlite3
+fi
+
+TMP_DIR=$(mktemp -d)
+STAGING_DIR=""
+trap 'rm -rf "$TMP_DIR" ${STAGING_DIR:+"$STAGING_DIR"}' EXIT
+
+DUPLICATES="$(printf '%s\n' "${_arg_input[@]}" | sort | uniq -d)"
+if test -n "$DUPLICATES" ; then
+    echo "Packages were given more than once: $DUPLICATES. aborting." >&2
+    exit 1
+fi
+
+# Run a function for every argument with at most $JOBS of them running at once. Fails if any of them failed
+function run_parallel {
+    local function="$1"
+    shift
+    rm -f "$TMP_DIR/failed"
+    for item in "$@" ; do
+        while [ "$(jobs -rp | wc -l)" -ge "$JOBS" ] ; do
+            wait -n || true
+        done
+        { "$function" "$item" || touch "$TMP_DIR/failed" ; } &
+    done
+    wait
+    ! test -e "$TMP_DIR/failed"
+}
+
+function sha256_of {
+    if command -v sha256sum &> /dev/null ; then
+        sha256sum "$1" | cut -d ' ' -f 1
     else
-        curl -sSfL "https://github.com/wasix-org/build-scripts/releases/download/$VERSION/$input.tar.xz" -o "$output"
+        shasum -a 256 "$1" | cut -d ' ' -f 1
     fi
-done
+}
+
+function verify_sha256 {
+    test "$(sha256_of "$2")" = "$1"
+}
+
+# The fetched archive of a package, $TMP_DIR/<input>.<format>
+function archive_of {
+    local format
+    for format in "${FORMATS[@]}" ; do
+        if test -e "$TMP_DIR/$1.$format" ; then
+            echo "$TMP_DIR/$1.$format"
+            return 0
+        fi
+    done
+    return 1
+}
+
+function fetch_from_catalog {
+    local input="$1"
+    # Look up the file the lib was packaged to and verify it against the recorded checksum
+    local format filename="" sha256=""
+    for format in "${FORMATS[@]}" ; do
+        read -r filename sha256 < <(sqlite3 -separator ' ' "$CATALOG" "SELECT filename, sha256 FROM artifacts WHERE project = '${input//\'/\'\'}' AND kind = 'lib' AND filename LIKE '%.$format' ORDER BY path LIMIT 1") || true
+        test -z "$filename" || break
+    done
+    if test -z "$filename" ; then
+        echo "No lib artifact for $input recorded in $CATALOG" >&2
+        return 1
+    fi
+    if ! verify_sha256 "$sha256" "$ARTIFACT_DIR/$filename" ; then
+        echo "Checksum of $ARTIFACT_DIR/$filename does not match the catalog" >&2
+        return 1
+    fi
+    ln -s "$ARTIFACT_DIR/$filename" "$TMP_DIR/$input.$format"
+}
+
+function fetch_from_artifact_dir {
+    local input="$1"
+    local format
+    for format in "${FORMATS[@]}" ; do
+        if test -f "$ARTIFACT_DIR/$input.$format" ; then
+            ln -s "$ARTIFACT_DIR/$input.$format" "$TMP_DIR/$input.$format"
+            return 0
+        fi
+    done
+    echo "$ARTIFACT_DIR/$input.${FORMATS[0]} does not exist" >&2
+    return 1
+}
+
+function cached_asset {
+    local index="$CACHE_DIR/releases/$VERSION/$1.sha256"
+    test -f "$index" && test -f "$CACHE_DIR/sha256/$(cat "$index")" && echo "$CACHE_DIR/sha256/$(cat "$index")"
+}
+
+function fetch_from_release {
+    local input="$1"
+    local format asset cached
+    for format in "${FORMATS[@]}" ; do
+        if cached="$(cached_asset "$input.$format")" ; then
+            ln -s "$cached" "$TMP_DIR/$input.$format"
+            return 0
+        fi
+    done
+
+    # Try the formats in order of preference, a release does not need to have all of them
+    local download
+    for format in "${FORMATS[@]}" ; do
+        asset="$input.$format"
+        download="$(mktemp "$CACHE_DIR/tmp/$asset.XXXXXX")" || return 1
+        if curl -sSfL "https://github.com/wasix-org/build-scripts/releases/download/$VERSION/$asset" -o "$download" 2>/dev/null ; then
+            break
+        fi
+        rm -f "$download"
+        download=""
+    done
+    if test -z "$download" ; then
+        echo "Failed to download $input from release $VERSION" >&2
+        return 1
+    fi
+    # Assets uploaded before github recorded digests are keyed by the checksum of the download
+    local sha256
+    sha256="$(awk -v asset="$asset" '$1 == asset { print $2 }' "$TMP_DIR/digests")"
+    if test -n "$sha256" && ! verify_sha256 "$sha256" "$download" ; then
+        echo "Checksum of $asset does not match the digest of release $VERSION" >&2
+        rm -f "$download"
+        return 1
+    fi
+    if test -z "$sha256" ; then
+        sha256="$(sha256_of "$download")"
+    fi
+    # Renames are atomic, so concurrent runs sharing the cache never see partial files
+    mv -f "$download" "$CACHE_DIR/sha256/$sha256" \
+        && mkdir -p "$CACHE_DIR/releases/$VERSION" \
+        && echo "$sha256" > "$download.sha256" \
+        && mv -f "$download.sha256" "$CACHE_DIR/releases/$VERSION/$asset.sha256" \
+        && ln -s "$CACHE_DIR/sha256/$sha256" "$TMP_DIR/$asset"
+}
+
+if test -n "$CATALOG" ; then
+    run_parallel fetch_from_catalog "${_arg_input[@]}"
+elif test -n "$ARTIFACT_DIR" ; then
+    run_parallel fetch_from_artifact_dir "${_arg_input[@]}"
+else
+    mkdir -p "$CACHE_DIR/sha256" "$CACHE_DIR/tmp"
+    CACHE_DIR="$(realpath "$CACHE_DIR")"
+    MISSING=()
+    for input in "${_arg_input[@]}" ; do
+        CACHED=false
+        for format in "${FORMATS[@]}" ; do
+            cached_asset "$input.$format" > /dev/null && CACHED=true
+        done
+        $CACHED || MISSING+=( "$input" )
+    done
+    # The release lists the checksums of its assets. Everything else works without the API
+    touch "$TMP_DIR/digests"
+    if test ${#MISSING[@]} -gt 0 ; then
+        curl -sSfL "${CURL_AUTH[@]}" "https://api.github.com/repos/wasix-org/build-scripts/releases/tags/$VERSION" 2>/dev/null \
+            | awk '/"name":/ { gsub(/.*"name": *"|".*/, ""); name = $0 } /"digest": *"sha256:/ { gsub(/.*"sha256:|".*/, ""); print name, $0 }' \
+            > "$TMP_DIR/digests" || true
+    fi
+    echo "Fetching ${#_arg_input[@]} packages of release $VERSION, $(( ${#_arg_input[@]} - ${#MISSING[@]} )) from the cache in $CACHE_DIR" >&2
+    run_parallel fetch_from_release "${_arg_input[@]}"
+fi
 
 mkdir -p "$_arg_output_dir"
 ASSEMBLED_DIR="$(realpath "$_arg_output_dir")"
 
+# What was installed into the output directory: <input>.sha256 is the checksum of the archive of a package and
+# <input>.manifest has a `<sha256>  ./<path>` line for every file and symlink in it. `order` lists the packages in
+# the order they were installed. With --merge, packages whose archive did not change are not extracted again
+STATE_DIR="$ASSEMBLED_DIR/.assemble-pkgs"
+mkdir -p "$STATE_DIR"
+touch "$STATE_DIR/order"
+
+# Print the manifest of a directory. The Makefile writes the same manifest into every lib archive as .<lib>.manifest,
+# archives without one get it computed. Symlinks are hashed by their target
+function write_manifest {
+    (
+        cd "$1" || exit 1
+        if command -v sha256sum &> /dev/null ; then
+            find . -type f ! -name '.*.manifest' -exec sha256sum {} +
+        else
+            find . -type f ! -name '.*.manifest' -exec shasum -a 256 {} +
+        fi
+        find . -type l | while IFS= read -r link ; do
+            echo "symlink-$(printf '%s' "$(readlink "$link")" | sha256_of -)  $link"
+        done
+    ) | LC_ALL=C sort -k 2
+}
+
+function hash_package {
+    sha256_of "$(archive_of "$1")" > "$TMP_DIR/$1.sha256"
+}
+run_parallel hash_package "${_arg_input[@]}"
+
+CHANGED=()
 for input in "${_arg_input[@]}" ; do
-    tar mxJf "$TMP_DIR/$input.tar.xz" -C "$ASSEMBLED_DIR"
+    if ! test -f "$STATE_DIR/$input.manifest" || test "$(cat "$STATE_DIR/$input.sha256" 2>/dev/null)" != "$(cat "$TMP_DIR/$input.sha256")" ; then
+        CHANGED+=( "$input" )
+    fi
+done
+
+# Packages that were installed before and are not given again keep their place before the given ones
+ORDER=()
+while IFS= read -r installed ; do
+    if ! printf '%s\n' "${_arg_input[@]}" | grep -qxF -- "$installed" ; then
+        ORDER+=( "$installed" )
+    fi
+done < "$STATE_DIR/order"
+ORDER+=( "${_arg_input[@]}" )
+
+# Decompress the packages in parallel into separate directories next to the output, so their files can be
+# hardlinked into it
+STAGING_DIR="$(mktemp -d "$STATE_DIR/staging.XXXXXX")"
+
+function extract_package {
+    local input="$1"
+    local archive
+    archive="$(archive_of "$input")" && mkdir -p "$STAGING_DIR/$input" || return 1
+    if test "${archive%.tar.zst}" != "$archive" ; then
+        zstd -dcq < "$archive" | tar mxf - -C "$STAGING_DIR/$input"
+        test "${PIPESTATUS[*]}" = "0 0" || return 1
+    else
+        tar mxJf "$archive" -C "$STAGING_DIR/$input" || return 1
+    fi
+    if test -f "$STAGING_DIR/$input/.$input.manifest" ; then
+        mv "$STAGING_DIR/$input/.$input.manifest" "$TMP_DIR/$input.manifest"
+    else
+        write_manifest "$STAGING_DIR/$input" > "$TMP_DIR/$input.manifest"
+    fi
+}
+if test ${#CHANGED[@]} -gt 0 ; then
+    run_parallel extract_package "${CHANGED[@]}"
+fi
+
+# Compare who owns every path before and after. Later packages overwrite files of earlier ones, like extracting
+# them one by one would. A file is written if its content changed and checked if it did not. Unchanged packages
+# have to be extracted as well if they now own a file with a different content than before, because the order
+# changed or a later package stopped shipping it. Files that no package ships anymore are removed
+AWK_ARGS=()
+while IFS= read -r installed ; do
+    if test -f "$STATE_DIR/$installed.manifest" ; then
+        AWK_ARGS+=( kind=old "pkg=$installed" "$STATE_DIR/$installed.manifest" )
+    fi
+done < "$STATE_DIR/order"
+for input in "${ORDER[@]}" ; do
+    if test -f "$TMP_DIR/$input.manifest" ; then
+        AWK_ARGS+=( kind=new "pkg=$input" "$TMP_DIR/$input.manifest" )
+    elif test -f "$STATE_DIR/$input.manifest" ; then
+        AWK_ARGS+=( kind=new "pkg=$input" "$STATE_DIR/$input.manifest" )
+    fi
+done
+awk -v dir="$TMP_DIR" -v changed="${CHANGED[*]}" '
+    BEGIN { split(changed, names, " "); for (i in names) extracted[names[i]] = 1 }
+    {
+        path = substr($0, length($1) + 3)
+        if (kind == "old") { old_digest[path] = $1 } else { new_owner[path] = pkg; new_digest[path] = $1 }
+    }
+    END {
+        for (path in new_owner) {
+            owner = new_owner[path]
+            if (!(path in old_digest) || old_digest[path] != new_digest[path]) {
+                write[owner] = write[owner] path "\n"
+                if (!(owner in extracted)) { extracted[owner] = 1; print owner > (dir "/extra") }
+            } else if (owner in extracted) {
+                check[owner] = check[owner] path "\n"
+            }
+        }
+        for (path in old_digest) {
+            if (!(path in new_owner)) printf "%s\n", path > (dir "/delete")
+        }
+        for (owner in extracted) {
+            printf "%s", write[owner] > (dir "/" owner ".write"); close(dir "/" owner ".write")
+            printf "%s", check[owner] > (dir "/" owner ".check"); close(dir "/" owner ".check")
+        }
+    }
+' "${AWK_ARGS[@]}" < /dev/null
+touch "$TMP_DIR/extra" "$TMP_DIR/delete"
+
+EXTRA=()
+while IFS= read -r input ; do
+    EXTRA+=( "$input" )
+done < "$TMP_DIR/extra"
+if test ${#EXTRA[@]} -gt 0 ; then
+    run_parallel extract_package "${EXTRA[@]}"
+fi
+
+while IFS= read -r path ; do
+    rm -f "$ASSEMBLED_DIR/$path"
+    rmdir -p "$(dirname "$ASSEMBLED_DIR/$path")" 2>/dev/null || true
+done < "$TMP_DIR/delete"
+
+GNU_CP=false
+if cp --version 2>/dev/null | grep -q GNU ; then
+    GNU_CP=true
+fi
+WRITTEN=0
+for input in "${ORDER[@]}" ; do
+    test -f "$TMP_DIR/$input.write" || continue
+    # Files that were removed from the output since the last run are written again
+    while IFS= read -r path ; do
+        if ! test -e "$ASSEMBLED_DIR/$path" && ! test -L "$ASSEMBLED_DIR/$path" ; then
+            echo "$path"
+        fi
+    done < "$TMP_DIR/$input.check" >> "$TMP_DIR/$input.write"
+    ( cd "$STAGING_DIR/$input" && find . -type d -empty ) | while IFS= read -r directory ; do
+        mkdir -p "$ASSEMBLED_DIR/$directory"
+    done
+    if test -s "$TMP_DIR/$input.write" ; then
+        if $GNU_CP ; then
+            # Hardlinks into the staging directory, nothing has to be copied
+            ( cd "$STAGING_DIR/$input" && tr '\n' '\0' < "$TMP_DIR/$input.write" | xargs -0 cp -al --parents --remove-destination -t "$ASSEMBLED_DIR" )
+        else
+            tar cf - -C "$STAGING_DIR/$input" -T "$TMP_DIR/$input.write" | tar xf - -C "$ASSEMBLED_DIR"
+        fi
+    fi
+    WRITTEN=$(( WRITTEN + $(wc -l < "$TMP_DIR/$input.write") ))
+done
+
+for input in "${CHANGED[@]}" ; do
+    cp "$TMP_DIR/$input.manifest" "$STATE_DIR/$input.manifest"
+    cp "$TMP_DIR/$input.sha256" "$STATE_DIR/$input.sha256"
 done
+printf '%s\n' "${ORDER[@]}" > "$STATE_DIR/order"
+echo "Installed ${#_arg_input[@]} packages into $ASSEMBLED_DIR, $(( ${#_arg_input[@]} - ${#CHANGED[@]} )) were unchanged. Wrote $WRITTEN files and removed $(wc -l < "$TMP_DIR/delete" | tr -d ' ')" >&2
 
 # ] <-- needed because of Argbash
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Run many unittest based test files in a single python process.
+
+This script runs inside the python package that is tested, so interpreter startup, the site-packages scan and
+heavy shared imports like numpy are paid once per batch instead of once per test file. Every test file is run
+as __main__ in a fresh namespace. Afterwards the interpreter state the test could have changed is restored:
+sys.path, sys.argv, the environment, the working directory, warning filters and the modules the test file
+imported from its own directory. Modules imported from site-packages stay loaded, because extension modules
+can not be loaded twice in one process and dropping them is what would make the next file pay for them again.
+
+The output of each file goes to <logs>/<name>.log. Progress is appended to the results file as tab separated
+lines, `start <name> <time>` before and `end <name> <exit code> <duration>` after a file ran. A file that
+crashes or hangs the interpreter has a start line without an end line, run-tests.sh runs it and everything
+after it in separate processes.
+
+Test files that need a process of their own (monkey patching, event loop policies, tests that get stuck)
+are marked with a `# test-isolation: process` comment and are never batched.
+"""
+import argparse
+import faulthandler
+import os
+import runpy
+import sys
+import time
+import warnings
+
+def changed_modules(test_dir, before):
+    """Get the modules a test file replaced, or imported from its own directory, since the snapshot."""
+    names = []
+    for name, module in list(sys.modules.items()):
+        if before.get(name) is module:
+            continue
+        module_file = getattr(module, '__file__', None)
+        if name in before or (module_file is not None and os.path.dirname(os.path.abspath(module_file)) == test_dir):
+            names.append(name)
+    return names
+
+def run_file(test_file, log_file, timeout):
+    """Run a test file as __main__ and return its exit code."""
+    test_file = os.path.abspath(test_file)
+    test_dir = os.path.dirname(test_file)
+    modules = dict(sys.modules)
+    path = list(sys.path)
+    argv = list(sys.argv)
+    environ = dict(os.environ)
+    cwd = os.getcwd()
+    filters = list(warnings.filters)
+    stdout, stderr = sys.stdout, sys.stderr
+    saved_fds = (os.dup(1), os.dup(2))
+
+    with open(log_file, 'w') as log:
+        # Redirect the file descriptors as well, so output of extension modules ends up in the log
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = sys.stderr = log
+        sys.argv = [test_file]
+        sys.path.insert(0, test_dir)
+        # Kills the whole batch if a test hangs, run-tests.sh sees the missing end line
+        faulthandler.dump_traceback_later(timeout, exit=True, file=log)
+        try:
+            runpy.run_path(test_file, run_name='__main__')
+            exit_code = 0
+        except SystemExit as e:
+            # unittest.main() exits with a bool, sys.exit() with a message exits with 1 like the interpreter does
+            if e.code is None or isinstance(e.code, int):
+                exit_code = int(e.code or 0)
+            else:
+                print(e.code, file=log)
+                exit_code = 1
+        except BaseException:
+            import traceback
+            traceback.print_exc(file=log)
+            exit_code = 1
+        finally:
+            faulthandler.cancel_dump_traceback_later()
+            log.flush()
+            sys.stdout, sys.stderr = stdout, stderr
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+    # Restore the interpreter state for the next file
+    for name in changed_modules(test_dir, modules):
+        if name in modules:
+            sys.modules[name] = modules[name]
+        else:
+            del sys.modules[name]
+    sys.path[:] = path
+    sys.argv = argv
+    os.environ.clear()
+    os.environ.update(environ)
+    os.chdir(cwd)
+    warnings.filters[:] = filters
+    return exit_code
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--results', required=True, help='File the progress lines are appended to')
+    parser.add_argument('--logs', required=True, help='Directory for the output of the test files')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds after which a hanging test file kills the batch (default: 600)')
+    parser.add_argument('test_files', nargs='+')
+    args = parser.parse_args()
+
+    with open(args.results, 'a') as results:
+        for test_file in args.test_files:
+            name = os.path.basename(test_file)
+            start = time.time()
+            results.write(f'start\t{name}\t{start:.6f}\n')
+            results.flush()
+            exit_code = run_file(test_file, os.path.join(args.logs, f'{name}.log'), args.timeout)
+            results.write(f'end\t{name}\t{exit_code}\t{time.time() - start:.3f}\n')
+            results.flush()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Compare how long it takes to pack and unpack the libs with xz and zstd, and how large the archives get.
+
+Every lib is read from its unpacked pkgs/<lib>.lib directory, or from its archive in artifacts/ if it was not
+built locally. The tar of each lib is compressed with every format and extracted again into a temporary
+directory, as `install_tarzst` does when a sysroot is assembled. `xz` is how libs were packaged before, with a
+single thread.
+
+Run it with `make benchmark-archives` to use the LIBS and ZSTD_FLAGS of the Makefile.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def formats(zstd_flags):
+    """Compressor commands and the program tar decompresses with, by format name."""
+    return {
+        'xz': (['xz', '-T1'], 'xz'),
+        'xz-mt': (['xz', '-T0'], 'xz -T0'),
+        'zstd': (['zstd', '-q', *zstd_flags.split()], 'zstd'),
+    }
+
+def lib_tar(lib, tar_file):
+    """Write the uncompressed tar of a lib. Returns where it was read from, or None if it is not available."""
+    lib_dir = os.path.join('pkgs', f'{lib}.lib')
+    if os.path.isdir(lib_dir):
+        subprocess.run(['tar', 'cf', tar_file, '-C', lib_dir, '.'], check=True)
+        return lib_dir
+    for suffix, decompress in (('.tar.zst', 'zstd'), ('.tar.xz', 'xz')):
+        archive = os.path.join('artifacts', f'{lib}{suffix}')
+        # Artifacts that were not pulled from git LFS are tiny text files
+        if os.path.isfile(archive) and os.path.getsize(archive) > 1024:
+            with open(archive, 'rb') as source, open(tar_file, 'wb') as target:
+                subprocess.run([decompress, '-dc'], stdin=source, stdout=target, check=True)
+            return archive
+    return None
+
+def measure(tar_file, compress, decompress, work_dir, repeat):
+    """Pack and unpack a tar. Returns the best pack and unpack time of all repetitions and the archive size."""
+    archive = os.path.join(work_dir, 'archive')
+    unpacked = os.path.join(work_dir, 'unpacked')
+    pack_times = []
+    unpack_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(tar_file, 'rb') as source, open(archive, 'wb') as target:
+            subprocess.run(compress, stdin=source, stdout=target, check=True)
+        pack_times.append(time.perf_counter() - start)
+
+        os.makedirs(unpacked)
+        start = time.perf_counter()
+        subprocess.run(['tar', f'--use-compress-program={decompress}', '-xf', archive, '-C', unpacked], check=True)
+        unpack_times.append(time.perf_counter() - start)
+        shutil.rmtree(unpacked)
+    return {'pack': min(pack_times), 'unpack': min(unpack_times), 'size': os.path.getsize(archive)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('libs', nargs='+', help='Names of the libs, like the LIBS list of the Makefile')
+    parser.add_argument('--zstd-flags', default='-19 -T0', help='Flags zstd compresses with (default: -19 -T0)')
+    parser.add_argument('--format', action='append', choices=sorted(formats('')), help='Format to compare. Can be repeated (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times every lib is packed and unpacked, the fastest is reported (default: 1)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    selected = {name: commands for name, commands in formats(args.zstd_flags).items() if args.format is None or name in args.format}
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        tar_file = os.path.join(work_dir, 'lib.tar')
+        for lib in args.libs:
+            source = lib_tar(lib, tar_file)
+            if source is None:
+                print(f"Warning: {lib} was neither built nor is its artifact available, skipping it", file=sys.stderr)
+                continue
+            result = {'lib': lib, 'source': source, 'tar_size': os.path.getsize(tar_file), 'formats': {}}
+            for name, (compress, decompress) in selected.items():
+                result['formats'][name] = measure(tar_file, compress, decompress, work_dir, args.repeat)
+            results.append(result)
+            print(f"{lib:<24} {result['tar_size'] / 2**20:>8.1f} MiB  " + '  '.join(
+                f"{name} {entry['size'] / 2**20:.1f} MiB {entry['pack']:.2f}s/{entry['unpack']:.2f}s" for name, entry in result['formats'].items()
+            ))
+
+    if not results:
+        print("No libs to compare", file=sys.stderr)
+        exit(1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'zstd_flags': args.zstd_flags, 'libs': results}, f, indent=2)
+
+    print()
+    print(f"{'format':<8} {'size MiB':>9} {'pack s':>8} {'unpack s':>9}")
+    for name in selected:
+        size = sum(result['formats'][name]['size'] for result in results)
+        pack = sum(result['formats'][name]['pack'] for result in results)
+        unpack = sum(result['formats'][name]['unpack'] for result in results)
+        print(f"{name:<8} {size / 2**20:>9.1f} {pack:>8.2f} {unpack:>9.2f}")
+    print(f"Packed and unpacked {len(results)} libs, {sum(result['tar_size'] for result in results) / 2**20:.1f} MiB uncompressed")
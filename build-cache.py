@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""Content addressed cache of the libs, wheels, sdists and sysroots the Makefile builds.
+
+Make rebuilds a target when a prerequisite is newer, so a fresh clone or a `touch` rebuilds everything even if
+nothing it is built from changed. `shell` wraps the shell of the recipe lines of these targets. Before the first
+line of a recipe runs, it computes the key of the target from everything the target is built from:
+
+  - the commit of the submodule in this repository and the patches_for patches of the project
+  - the expanded recipe of the target and of its .prepared worktree, which contains the target-specific
+    variables like BUILD_ENV_VARS, BUILD_EXTRA_FLAGS and PREPARE, and the files in patches/ and resources/ that
+    the recipes use
+  - the WASIXCC_* environment variables
+  - the prerequisites: the key of the ones that have a key themselves, the content of the others. The .source,
+    .prepared and .build directories are covered by the commit and the patches
+  - the versions of the toolchain in $BUILD_CACHE_TOOLCHAIN
+
+If the cache has an artifact with that key, it is restored and the rest of the recipe is skipped. Otherwise the
+first line builds the target with the whole recipe in a nested make, that shares the jobserver, and stores its
+artifact once that make succeeded. The other lines of the recipe are skipped then. Artifacts are stored in a local
+directory and, if $BUILD_CACHE_URL is set, fetched from and uploaded to an HTTP server that supports GET and PUT,
+like `serve`. Sysroots are only keyed: assembling one from the unpacked libs is faster than unpacking an archive of it.
+"""
+from build_common import file_sha256
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+
+import jobserver
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+state_dir = os.path.join(root_dir, '.build-cache')
+cache_dir = os.path.abspath(os.path.expanduser(os.getenv('BUILD_CACHE') or '~/.cache/wasix-build-scripts/build'))
+cache_url = os.getenv('BUILD_CACHE_URL', '').rstrip('/')
+default_port = 6932
+marker = 'build-cache-marker'
+
+# Suffixes of the targets that are cached and how their artifact is stored
+target_kinds = {
+    '.lib': 'directory',
+    '.whl': 'artifact',
+    '.tar.gz': 'artifact',
+    '.tar.zst': 'artifact',
+    '.sysroot': 'key',
+}
+# Directories that only hold the sources of a project, which are covered by the commit and the patches
+source_suffixes = ('.source', '.prepared', '.build')
+
+def project_name(path):
+    """Same as project_name in the Makefile"""
+    return os.path.splitext(os.path.splitext(os.path.basename(path))[0])[0]
+
+def target_kind(target):
+    return next((kind for suffix, kind in target_kinds.items() if target.endswith(suffix)), None)
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def tree_sha256(path):
+    """Hash of a file or directory tree: names, symlinks, executable bits and contents."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return file_sha256(path)
+    digest = hashlib.sha256()
+    for directory, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            entry = os.path.join(directory, name)
+            relative = os.path.relpath(entry, path)
+            if os.path.islink(entry):
+                digest.update(f'link {relative} {os.readlink(entry)}\n'.encode('utf-8'))
+            elif os.path.isfile(entry):
+                executable = 'x' if os.stat(entry).st_mode & 0o100 else '-'
+                digest.update(f'file {relative} {executable} {file_sha256(entry)}\n'.encode('utf-8'))
+            elif os.path.isdir(entry):
+                digest.update(f'dir {relative}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def normalize(text):
+    """Make paths in this checkout the same in every checkout."""
+    return text.replace(root_dir, '$ROOT')
+
+def state_path(target):
+    return os.path.join(state_dir, target.replace('/', '%') + '.json')
+
+def read_state(target):
+    try:
+        with open(state_path(target), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_state(target, state):
+    os.makedirs(state_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=state_dir, delete=False) as f:
+        json.dump(state, f, indent=2)
+    os.replace(f.name, state_path(target))
+
+def mtime(path):
+    try:
+        return os.stat(os.path.join(root_dir, path)).st_mtime_ns
+    except OSError:
+        return None
+
+def submodule_commit(project):
+    """Commit of pkgs/<project>.source in the index of this repository, what reset_submodule checks out."""
+    result = subprocess.run(['git', '-C', root_dir, 'ls-files', '--stage', '--', f'pkgs/{project}.source'], capture_output=True, text=True)
+    fields = result.stdout.split()
+    return fields[1] if len(fields) > 1 and fields[0] == '160000' else None
+
+def patches_for(project):
+    """Same as patches_for in the Makefile"""
+    patches = []
+    for directory, _, filenames in os.walk(os.path.join(root_dir, 'patches')):
+        patches += [os.path.join(directory, name) for name in filenames if name.startswith(f'{project}-00') and name.endswith('.patch')]
+    return sorted(patches)
+
+def expanded_recipe(target, prerequisites, order_only):
+    """Recipe lines of the target and of its .prepared worktree, as make would run them now."""
+    project = project_name(target)
+    prepared = [f'pkgs/{project}.prepared'] if submodule_commit(project) else []
+    # Make passes the jobserver only to recursive lines, and the line that runs this is none
+    makeflags = re.sub(r'\s*(--jobserver-(auth|fds)=\S+|(?<!\S)-j\d*)', '', os.getenv('MAKEFLAGS', ''))
+    command = [
+        'make', '-n', '-B', '--no-print-directory', '-C', root_dir, 'SKIP_CC_CHECK=1', 'MAKE=:', 'BUILD_CACHE=', 'BUILD_TELEMETRY=',
+        f'--eval={marker}: ; @echo {marker}',
+        # Everything the goals depend on is up to date, so only their own recipes are printed
+        *(f'--old-file={path}' for path in prerequisites + order_only + [f'pkgs/{project}.source']),
+        *prepared, marker, target,
+    ]
+    result = subprocess.run(command, env={**os.environ, 'MAKEFLAGS': makeflags}, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ValueError(f'make -n {target} failed: {result.stderr.strip()}')
+    lines = []
+    for line in result.stdout.splitlines():
+        if lines and lines[-1].endswith('\\'):
+            lines[-1] += '\n' + line
+        elif not re.match(r'make(\[\d+\])?: ', line):
+            lines.append(line)
+    split = lines.index(f'echo {marker}')
+    return [normalize(line) for line in lines[:split]], [normalize(line) for line in lines[split + 1:]]
+
+def toolchain_versions(run):
+    """Output of every command in $BUILD_CACHE_TOOLCHAIN, run once per build."""
+    path = os.path.join(state_dir, 'toolchain.json')
+    try:
+        with open(path, 'r') as f:
+            toolchain = json.load(f)
+        if toolchain['run'] == run:
+            return toolchain['versions']
+    except (OSError, ValueError, KeyError):
+        pass
+    versions = {}
+    for command in filter(None, (command.strip() for command in os.getenv('BUILD_CACHE_TOOLCHAIN', '').split(';'))):
+        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        versions[command] = normalize(f'{result.returncode} {result.stdout.strip()}')
+    os.makedirs(state_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=state_dir, delete=False) as f:
+        json.dump({'run': run, 'versions': versions}, f)
+    os.replace(f.name, path)
+    return versions
+
+def dependency_hash(path):
+    """The key of a prerequisite that was built with a key and did not change since, or its content."""
+    state = read_state(path)
+    if state is not None and state.get('status') in ('hit', 'stored', 'keyed') and state.get('mtime') == mtime(path):
+        return f"key:{state['key']}"
+    if not os.path.lexists(os.path.join(root_dir, path)):
+        return 'missing'
+    return tree_sha256(os.path.join(root_dir, path))
+
+def key_inputs(target, prerequisites, order_only, run):
+    prepared_recipe, recipe = expanded_recipe(target, prerequisites, order_only)
+    projects = {project_name(target)} | {project_name(path) for path in prerequisites if path.startswith('pkgs/') and path.endswith(source_suffixes)}
+    sources = {}
+    for project in sorted(projects):
+        sources[project] = {
+            'commit': submodule_commit(project),
+            'patches': [(os.path.basename(path), file_sha256(path)) for path in patches_for(project)],
+        }
+    # Files of this repository the recipes use, like patches of other projects, toolchain files and cross files
+    files = {}
+    for path in sorted(set(re.findall(r'(?:\$ROOT/)?((?:patches|resources)/[\w.+/-]*[\w+])', '\n'.join(prepared_recipe + recipe)))):
+        if os.path.exists(os.path.join(root_dir, path)):
+            files[path] = tree_sha256(os.path.join(root_dir, path))
+    dependencies = {}
+    for path in sorted(set(prerequisites)):
+        if not (path.startswith('pkgs/') and path.endswith(source_suffixes)):
+            dependencies[path] = dependency_hash(path)
+    return {
+        'target': target,
+        'sources': sources,
+        'prepared_recipe': prepared_recipe,
+        'recipe': recipe,
+        'files': files,
+        'environment': {name: normalize(value) for name, value in sorted(os.environ.items()) if name.startswith('WASIXCC_')},
+        'dependencies': dependencies,
+        'toolchain': toolchain_versions(run),
+    }
+
+def entry_path(key):
+    return os.path.join(cache_dir, key[:2], f'{key}.tar.zst')
+
+def fetch(key):
+    """Path of the cached artifact with a key, downloaded from $BUILD_CACHE_URL if it is not in the local cache."""
+    path = entry_path(key)
+    if os.path.exists(path) or not cache_url:
+        return path if os.path.exists(path) else None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with urllib.request.urlopen(f'{cache_url}/{key[:2]}/{key}.tar.zst') as response:
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False) as f:
+                shutil.copyfileobj(response, f)
+        os.replace(f.name, path)
+    except urllib.error.HTTPError as error:
+        if error.code != HTTPStatus.NOT_FOUND:
+            print(f"Warning: Failed to fetch {key} from {cache_url}: {error}", file=sys.stderr)
+        return None
+    except OSError as error:
+        print(f"Warning: Failed to fetch {key} from {cache_url}: {error}", file=sys.stderr)
+        return None
+    return path
+
+def store(target, key):
+    """Pack the artifact of a target into the cache and upload it."""
+    target_path = os.path.join(root_dir, target)
+    meta = {'target': target}
+    if target_kind(target) == 'artifact':
+        meta['link'] = os.readlink(target_path)
+        meta['filename'] = os.path.basename(os.path.realpath(target_path))
+    path = entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False) as f:
+        compressor = subprocess.Popen(['zstd', '-T0', '-q', '-c'], stdin=subprocess.PIPE, stdout=f)
+        with tarfile.open(fileobj=compressor.stdin, mode='w|') as archive:
+            data = json.dumps(meta).encode('utf-8')
+            info = tarfile.TarInfo('build-cache.json')
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+            if target_kind(target) == 'artifact':
+                archive.add(os.path.realpath(target_path), arcname='artifact')
+            else:
+                archive.add(target_path, arcname='target')
+        compressor.stdin.close()
+        if compressor.wait() != 0:
+            os.unlink(f.name)
+            raise OSError(f'zstd failed to pack {target}')
+    os.replace(f.name, path)
+    if cache_url:
+        try:
+            with open(path, 'rb') as f:
+                request = urllib.request.Request(f'{cache_url}/{key[:2]}/{key}.tar.zst', data=f, method='PUT', headers={'Content-Length': str(os.path.getsize(path))})
+                urllib.request.urlopen(request).close()
+        except OSError as error:
+            print(f"Warning: Failed to upload {target} to {cache_url}: {error}", file=sys.stderr)
+
+def restore(target, archive_path):
+    """Unpack a cached artifact to where the recipe would have put it."""
+    target_path = os.path.join(root_dir, target)
+    os.makedirs(state_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=state_dir) as tmp_dir:
+        subprocess.run(['tar', '-I', 'zstd', '-xf', archive_path, '-C', tmp_dir], check=True)
+        with open(os.path.join(tmp_dir, 'build-cache.json'), 'r') as f:
+            meta = json.load(f)
+        if target_kind(target) == 'artifact':
+            artifact = os.path.join(root_dir, 'artifacts', meta['filename'])
+            os.makedirs(os.path.dirname(artifact), exist_ok=True)
+            os.replace(os.path.join(tmp_dir, 'artifact'), artifact)
+            # Newer than the prerequisites, like a file the recipe just wrote
+            os.utime(artifact)
+            os.symlink(meta['link'], os.path.join(tmp_dir, 'link'))
+            os.replace(os.path.join(tmp_dir, 'link'), target_path)
+            catalog = ['python3', os.path.join(root_dir, 'artifact_catalog.py'), '--catalog', os.path.join(root_dir, 'catalog.sqlite'), 'add', '--project', project_name(target), '--source', f'pkgs/{project_name(target)}.source']
+            if target.endswith('.tar.zst'):
+                catalog += ['--lib-dir', f'pkgs/{project_name(target)}.lib']
+            subprocess.run(catalog + [target], cwd=root_dir, check=True)
+        else:
+            shutil.rmtree(target_path, ignore_errors=True)
+            os.replace(os.path.join(tmp_dir, 'target'), target_path)
+            os.utime(target_path)
+
+def build(target, prerequisites, order_only):
+    """Run the whole recipe of the target in a nested make. Returns its exit code."""
+    project = project_name(target)
+    makeflags = jobserver.inherit_jobserver()
+    if makeflags is None:
+        # No jobserver, or none this line can reach. -j1 keeps the Makefile from starting a new pool
+        makeflags = re.sub(r'\s*(--jobserver-(auth|fds)=\S+|(?<!\S)-j\d*)', '', os.getenv('MAKEFLAGS', '')) + ' -j1'
+    command = [
+        'make', '-B', '--no-print-directory', '-C', root_dir, 'BUILD_CACHE=', 'BUILD_TELEMETRY=',
+        # Make already decided that the target is out of date and built everything it depends on
+        *(f'--old-file={path}' for path in prerequisites + order_only + [f'pkgs/{project}.source']),
+        target,
+    ]
+    sys.stdout.flush()
+    return subprocess.run(command, env={**os.environ, 'MAKEFLAGS': makeflags}, close_fds=False).returncode
+
+def report_status(status):
+    """Tell build-telemetry.py whether the target came from the cache."""
+    if os.getenv('BUILD_TELEMETRY_STATUS'):
+        with open(os.getenv('BUILD_TELEMETRY_STATUS'), 'w') as f:
+            f.write(status)
+
+def command_shell(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No shell given", file=sys.stderr)
+        exit(1)
+    target = args.target
+    # Prerequisites of a cached target inherit its variables, their recipes just run
+    if target_kind(target) is None:
+        sys.stdout.flush()
+        os.execv(command[0], command)
+    # Every make run has its own id. Once the first line built or restored the target, the others are skipped
+    run = os.getenv('BUILD_CACHE_RUN') or str(os.getppid())
+    state = read_state(target)
+    if state is not None and state.get('run') == run and state.get('status') in ('hit', 'stored', 'keyed', 'built'):
+        exit(0)
+    prerequisites, order_only = args.prerequisites.split(), args.order_only.split()
+    state = {'run': run, 'status': 'uncached'}
+    try:
+        inputs = key_inputs(target, prerequisites, order_only, run)
+        state.update({'key': sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')), 'inputs': inputs, 'status': 'miss'})
+        archive_path = fetch(state['key']) if target_kind(target) != 'key' else None
+        if archive_path is not None:
+            restore(target, archive_path)
+            state.update({'status': 'hit', 'mtime': mtime(target)})
+            write_state(target, state)
+            print(f"Restored {target} from the build cache ({state['key'][:16]})", file=sys.stderr)
+            report_status('hit')
+            exit(0)
+    except (OSError, ValueError, subprocess.CalledProcessError) as error:
+        print(f"Warning: Building {target} without the build cache: {error}", file=sys.stderr)
+    write_state(target, state)
+    if state['status'] == 'miss' and target_kind(target) != 'key':
+        report_status('miss')
+
+    exit_code = build(target, prerequisites, order_only)
+    if exit_code != 0:
+        exit(128 - exit_code if exit_code < 0 else exit_code)
+    # The recipe ran to its end, so the artifact is complete
+    if state['status'] == 'miss' and target_kind(target) == 'key':
+        state['status'] = 'keyed'
+    elif state['status'] == 'miss':
+        try:
+            store(target, state['key'])
+            state['status'] = 'stored'
+        except (OSError, subprocess.CalledProcessError) as error:
+            print(f"Warning: Failed to store {target} in the build cache: {error}", file=sys.stderr)
+            state['status'] = 'built'
+    else:
+        state['status'] = 'built'
+    state['mtime'] = mtime(target)
+    write_state(target, state)
+
+def command_recipe(args):
+    _, recipe = expanded_recipe(args.target, args.prerequisites.split(), args.order_only.split())
+    print(json.dumps(recipe, indent=2))
+
+def command_explain(args):
+    state = read_state(args.target)
+    if state is None or 'inputs' not in state:
+        print(f"{args.target} was not built with the build cache yet", file=sys.stderr)
+        exit(1)
+    print(json.dumps({'key': state['key'], 'status': state['status'], **state['inputs']}, indent=2))
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    def entry(self):
+        match = re.fullmatch(r'/([0-9a-f]{2})/([0-9a-f]{64})\.tar\.zst', self.path)
+        if match is None or not match.group(2).startswith(match.group(1)):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return None
+        return os.path.join(self.server.directory, match.group(1), f'{match.group(2)}.tar.zst')
+
+    def do_GET(self):
+        self.send_entry(send_body=True)
+
+    def do_HEAD(self):
+        self.send_entry(send_body=False)
+
+    def send_entry(self, send_body):
+        path = self.entry()
+        if path is None:
+            return
+        if not os.path.exists(path):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/zstd')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        if send_body:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        path = self.entry()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length', '0'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False) as f:
+            remaining = length
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 2**20))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining > 0:
+            os.unlink(f.name)
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Incomplete upload')
+            return
+        os.replace(f.name, path)
+        self.send_response(HTTPStatus.CREATED)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class CacheServer(ThreadingHTTPServer):
+    def __init__(self, address, directory):
+        self.directory = directory
+        super().__init__(address, CacheRequestHandler)
+
+def command_serve(args):
+    os.makedirs(args.dir, exist_ok=True)
+    server = CacheServer((args.host, args.port), os.path.abspath(args.dir))
+    print(f"Serving the build cache in {args.dir} on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def command_clear(args):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.rmtree(state_dir, ignore_errors=True)
+    print(f"Removed {cache_dir}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    shell_parser = subparsers.add_parser('shell', help='Restore a target from the cache, or build it with its whole recipe and store it')
+    shell_parser.add_argument('--target', required=True, help='Target the recipe belongs to')
+    shell_parser.add_argument('--prerequisites', default='', help='Normal prerequisites of the target, separated by spaces')
+    shell_parser.add_argument('--order-only', default='', help='Order-only prerequisites of the target, separated by spaces')
+    shell_parser.add_argument('command', nargs=argparse.REMAINDER)
+    shell_parser.set_defaults(handler=command_shell)
+
+    recipe_parser = subparsers.add_parser('recipe', help='Print the recipe of a target as make would run it now, as JSON')
+    recipe_parser.add_argument('--target', required=True)
+    recipe_parser.add_argument('--prerequisites', default='', help='Normal prerequisites of the target, separated by spaces')
+    recipe_parser.add_argument('--order-only', default='', help='Order-only prerequisites of the target, separated by spaces')
+    recipe_parser.set_defaults(handler=command_recipe)
+
+    explain_parser = subparsers.add_parser('explain', help='Print the key of the last build of a target and what it was computed from')
+    explain_parser.add_argument('target')
+    explain_parser.set_defaults(handler=command_explain)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve a cache directory over HTTP with GET and PUT, for $BUILD_CACHE_URL')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('--port', type=int, default=default_port, help=f'Port to listen on (default: {default_port})')
+    serve_parser.add_argument('--dir', default=cache_dir, help=f'Directory to serve (default: {cache_dir}, or $BUILD_CACHE)')
+    serve_parser.set_defaults(handler=command_serve)
+
+    clear_parser = subparsers.add_parser('clear', help='Remove the local cache and the keys of the built targets')
+    clear_parser.set_defaults(handler=command_clear)
+
+    args = parser.parse_args()
+    args.handler(args)
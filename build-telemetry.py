@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Where the time of a build goes, target by target.
+
+`run` wraps the shell of every recipe line when the Makefile is run with BUILD_TELEMETRY=<log>. It runs the line
+and appends a JSON line to the log with the target, its prerequisites, the start and end time, the CPU time and
+peak RSS of the line and everything it waited for, and the cache status. A recipe reports a cache status by
+writing it (e.g. `hit`) to the file in $BUILD_TELEMETRY_STATUS.
+
+`report` adds up the lines of every target of a make run and rebuilds the dependency graph between the targets
+that ran from their prerequisites. It prints the most expensive targets, the critical path, and the speedup a
+build with more parallel jobs could reach. The speedup comes from simulating the build with a number of job slots
+that always start the ready target with the longest remaining path first. Targets that run make -j themselves
+use more than one core, their CPU time is higher than their wall time.
+"""
+import argparse
+import fcntl
+import heapq
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+log_file = os.getenv('BUILD_TELEMETRY', 'build-telemetry.jsonl')
+
+def command_run(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No command given", file=sys.stderr)
+        exit(1)
+    with tempfile.NamedTemporaryFile('r', prefix='build-telemetry-status.') as status:
+        start = time.time()
+        # Keep the jobserver file descriptors of make open for sub-makes
+        process = subprocess.Popen(command, env={**os.environ, 'BUILD_TELEMETRY_STATUS': status.name}, close_fds=False)
+        # Make stops its children with SIGTERM or SIGINT, both have to reach the recipe
+        signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        _, wait_status, usage = os.wait4(process.pid, 0)
+        end = time.time()
+        cache = status.read().strip() or None
+    exit_code = os.waitstatus_to_exitcode(wait_status)
+    entry = {
+        'run': os.getenv('BUILD_TELEMETRY_RUN'),
+        'target': args.target,
+        'prerequisites': args.prerequisites.split(),
+        'start': round(start, 3),
+        'end': round(end, 3),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        # KiB on linux
+        'rss': usage.ru_maxrss,
+        'exit': exit_code,
+        'cache': cache,
+    }
+    # Parallel jobs append to the same log
+    with open(args.log, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(entry) + '\n')
+    exit(128 - exit_code if exit_code < 0 else exit_code)
+
+def load_targets(path, run):
+    """Add up the recipe lines of every target of a run. Returns the run and the targets by name."""
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The line of a recipe that was killed while writing
+                continue
+    runs = [entry['run'] for entry in entries]
+    if run is None and runs:
+        run = runs[-1]
+    targets = {}
+    for entry in entries:
+        if entry['run'] != run:
+            continue
+        target = targets.setdefault(entry['target'], {
+            'name': entry['target'], 'prerequisites': set(), 'start': entry['start'], 'end': entry['end'],
+            'wall': 0, 'cpu': 0, 'rss': 0, 'lines': 0, 'exit': 0, 'cache': None,
+        })
+        target['prerequisites'].update(entry['prerequisites'])
+        target['start'] = min(target['start'], entry['start'])
+        target['end'] = max(target['end'], entry['end'])
+        target['wall'] += entry['end'] - entry['start']
+        target['cpu'] += entry['cpu']
+        target['rss'] = max(target['rss'], entry['rss'])
+        target['lines'] += 1
+        target['exit'] = entry['exit'] or target['exit']
+        target['cache'] = entry['cache'] or target['cache']
+    # Only targets that ran in this build are part of the graph, the others were up to date
+    for target in targets.values():
+        target['prerequisites'] = sorted(prerequisite for prerequisite in target['prerequisites'] if prerequisite in targets and prerequisite != target['name'])
+    return run, targets
+
+def remaining_paths(targets):
+    """Longest path from the start of every target to the end of the build, following the targets that need it."""
+    dependents = {name: [] for name in targets}
+    for target in targets.values():
+        for prerequisite in target['prerequisites']:
+            dependents[prerequisite].append(target['name'])
+    remaining = {}
+    def visit(name, active):
+        if name in remaining:
+            return remaining[name]
+        active.add(name)
+        following = [visit(dependent, active) for dependent in dependents[name] if dependent not in active]
+        active.discard(name)
+        remaining[name] = targets[name]['wall'] + max(following, default=0)
+        return remaining[name]
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * len(targets) + 100))
+    for name in targets:
+        visit(name, set())
+    return remaining
+
+def critical_path(targets, remaining):
+    """The chain of targets that takes the longest, in build order."""
+    finish = {}
+    previous = {}
+    def visit(name, active):
+        if name in finish:
+            return finish[name]
+        active.add(name)
+        best = None
+        for prerequisite in targets[name]['prerequisites']:
+            if prerequisite in active:
+                continue
+            # Every prerequisite has to be visited, it may come after its dependent in the log
+            length = visit(prerequisite, active)
+            if best is None or length > finish[best]:
+                best = prerequisite
+        active.discard(name)
+        previous[name] = best
+        finish[name] = targets[name]['wall'] + (finish[best] if best is not None else 0)
+        return finish[name]
+    for name in targets:
+        visit(name, set())
+    path = []
+    name = max(finish, key=finish.get, default=None)
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return list(reversed(path))
+
+def simulate(targets, remaining, jobs):
+    """Time a build of the targets would take with a number of job slots."""
+    waiting = {name: len(target['prerequisites']) for name, target in targets.items()}
+    dependents = {name: [] for name in targets}
+    for target in targets.values():
+        for prerequisite in target['prerequisites']:
+            dependents[prerequisite].append(target['name'])
+    ready = [(-remaining[name], name) for name, count in waiting.items() if count == 0]
+    heapq.heapify(ready)
+    running = []
+    now = 0
+    while ready or running:
+        while ready and len(running) < jobs:
+            _, name = heapq.heappop(ready)
+            heapq.heappush(running, (now + targets[name]['wall'], name))
+        now, name = heapq.heappop(running)
+        for dependent in dependents[name]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                heapq.heappush(ready, (-remaining[dependent], dependent))
+    return now
+
+def kind(name):
+    """The kind of a pkgs/<project>.<suffix> target, like lib, whl or sysroot."""
+    if not name.startswith('pkgs/'):
+        return name
+    return os.path.basename(name).split('.', 1)[-1] if '.' in os.path.basename(name) else name
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return f'{seconds / 3600:.1f}h'
+    if seconds >= 60:
+        return f'{seconds / 60:.1f}m'
+    return f'{seconds:.1f}s'
+
+def command_report(args):
+    if not os.path.exists(args.log):
+        print(f"{args.log} does not exist, build with BUILD_TELEMETRY={args.log} first", file=sys.stderr)
+        exit(1)
+    run, targets = load_targets(args.log, args.run)
+    if not targets:
+        print(f"No targets recorded for run {run} in {args.log}", file=sys.stderr)
+        exit(1)
+
+    total = sum(target['wall'] for target in targets.values())
+    elapsed = max(target['end'] for target in targets.values()) - min(target['start'] for target in targets.values())
+    remaining = remaining_paths(targets)
+    path = critical_path(targets, remaining)
+    critical = sum(targets[name]['wall'] for name in path)
+
+    if args.json:
+        print(json.dumps({
+            'run': run,
+            'targets': sorted(targets.values(), key=lambda target: target['start']),
+            'critical_path': path,
+            'speedup': {jobs: total / simulate(targets, remaining, jobs) for jobs in args.jobs},
+        }, indent=2))
+        return
+
+    print(f"Run {run}: {len(targets)} targets, {format_duration(total)} of recipes in {format_duration(elapsed)} ({total / elapsed if elapsed else 1:.1f} at once on average)")
+    print()
+    print(f"{'target':<48} {'wall':>7} {'cpu':>7} {'rss MiB':>8} {'cache':>6}")
+    for target in sorted(targets.values(), key=lambda target: target['wall'], reverse=True)[:args.top]:
+        failed = ' failed' if target['exit'] else ''
+        print(f"{target['name']:<48} {format_duration(target['wall']):>7} {format_duration(target['cpu']):>7} {target['rss'] / 1024:>8.0f} {target['cache'] or '-':>6}{failed}")
+
+    print()
+    kinds = {}
+    for target in targets.values():
+        entry = kinds.setdefault(kind(target['name']), [0, 0])
+        entry[0] += 1
+        entry[1] += target['wall']
+    print('By kind: ' + ', '.join(f"{name} {format_duration(wall)} ({count})" for name, (count, wall) in sorted(kinds.items(), key=lambda item: item[1][1], reverse=True)))
+
+    print()
+    print(f"Critical path, {format_duration(critical)}:")
+    for name in path:
+        print(f"  {name:<46} {format_duration(targets[name]['wall']):>7}")
+
+    print()
+    print(f"{'jobs':>6} {'time':>8} {'speedup':>8}")
+    for jobs in args.jobs:
+        makespan = simulate(targets, remaining, jobs)
+        print(f"{jobs:>6} {format_duration(makespan):>8} {total / makespan if makespan else 1:>7.1f}x")
+    print(f"{'inf':>6} {format_duration(critical):>8} {total / critical if critical else 1:>7.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--log', default=log_file, help=f'Telemetry log (default: {log_file}, or $BUILD_TELEMETRY)')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a recipe line and append its usage to the log')
+    run_parser.add_argument('--target', required=True, help='Target the recipe belongs to')
+    run_parser.add_argument('--prerequisites', default='', help='Prerequisites of the target, separated by spaces')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER)
+    run_parser.set_defaults(handler=command_run)
+
+    report_parser = subparsers.add_parser('report', help='Print the most expensive targets, the critical path and the possible speedup of a run')
+    report_parser.add_argument('--run', help='Run to report (default: the last one in the log)')
+    report_parser.add_argument('--top', type=int, default=15, help='Number of most expensive targets to show (default: 15)')
+    report_parser.add_argument('--jobs', type=lambda value: [int(jobs) for jobs in value.split(',')], default=[1, 2, 4, 8, 12, 16, 32], help='Comma separated job counts to simulate (default: 1,2,4,8,12,16,32)')
+    report_parser.add_argument('--json', action='store_true', help='Print the targets, the critical path and the speedups as JSON')
+    report_parser.set_defaults(handler=command_report)
+
+    args = parser.parse_args()
+    args.handler(args)
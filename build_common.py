@@ -0,0 +1,29 @@
+"""Helpers shared by the python scripts of this repository.
+
+The scripts import it from the directory they are in, like generate-index.py imports artifact_catalog. It only
+depends on the standard library, so it stays cheap to import for scripts that run for every compile.
+"""
+import hashlib
+import os
+import re
+
+hash_chunk_size = 1024 * 1024
+
+def canonicalize_name(name):
+    """Normalize a distribution name as described in PEP 503."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def test_stem(test_file):
+    """Get the name of the package a test file is named after, e.g. lxml for tests/lxml-test-broken.py."""
+    name = os.path.basename(test_file)
+    for suffix in ('.py', '.skip', '-broken', '-test'):
+        name = name[:-len(suffix)] if name.endswith(suffix) else name
+    return name
+
+def file_sha256(file_path):
+    """Hash a file in chunks, so large artifacts are never fully loaded into memory."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(hash_chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
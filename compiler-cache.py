@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""Cache of the objects wasixcc, wasixcc++ and rustc compile, so rebuilds after clean-build-artifacts are fast.
+
+The Makefile puts resources/compiler-cache/ first on PATH, its wasixcc and wasixcc++ run the real compilers
+through `exec`. Cargo runs rustc through resources/compiler-cache/rustc-wrapper, set as RUSTC_WRAPPER.
+
+A C or C++ compile with -c is looked up by the hash of its preprocessed source, which contains every header it
+read from WASIXCC_SYSROOT, together with the arguments, the working directory, the compiler version and all
+WASIXCC_* and CCC_OVERRIDE_OPTIONS variables. A rustc invocation for the wasm32-wasmer-wasi-dl target that builds
+a library is looked up by its arguments, the source files and environment variables rustc reports as
+dependencies, the crates it links against and the rustc version. Everything else, like linking, runs uncached.
+
+The cache is evicted least recently used first when it grows beyond its size limit. `stats` prints the hits and
+misses of every Makefile target, which is passed in COMPILER_CACHE_TARGET.
+"""
+from build_common import file_sha256
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+cache_dir = os.path.abspath(os.path.expanduser(os.getenv('COMPILER_CACHE', '~/.cache/wasix-build-scripts/compiler')))
+max_size = os.getenv('COMPILER_CACHE_SIZE', '20G')
+shim_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'compiler-cache')
+rust_target = 'wasm32-wasmer-wasi-dl'
+
+source_extensions = ('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C', '.m', '.mm', '.S')
+# Compiler options whose value is the next argument
+options_with_value = {
+    '-o', '-MF', '-MT', '-MQ', '-I', '-isystem', '-iquote', '-idirafter', '-include', '-imacros', '-iprefix',
+    '-iwithprefix', '-iwithprefixbefore', '-isysroot', '-D', '-U', '-x', '-target', '-arch', '-Xclang',
+    '-Xpreprocessor', '-Xassembler', '-Xlinker', '-mllvm', '-L', '-l', '-z', '--sysroot', '-resource-dir',
+}
+dependency_options = {'-MD', '-MMD', '-MP'}
+# The stats log is compacted to counts per target once it grows beyond this
+stats_compact_size = 2**20
+
+def parse_size(size):
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+def format_size(size):
+    return f'{size / 2**30:.2f} GiB' if size >= 2**30 else f'{size / 2**20:.1f} MiB'
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def find_compiler(name):
+    """Find a compiler on PATH, skipping the wrappers in resources/compiler-cache."""
+    path = [directory for directory in os.getenv('PATH', '').split(os.pathsep) if directory and os.path.realpath(directory) != os.path.realpath(shim_dir)]
+    compiler = shutil.which(name, path=os.pathsep.join(path))
+    if compiler is None:
+        print(f"compiler-cache: {name} not found on PATH", file=sys.stderr)
+        exit(127)
+    return compiler
+
+def signature(path):
+    info = os.stat(path)
+    return [path, info.st_size, info.st_mtime_ns]
+
+def toolchain(compiler, kind):
+    """Describe the toolchain that really compiles. wasixcc is a small wrapper around clang and rustc is usually a
+    rustup proxy, so their own binaries do not change when the toolchain behind them does.
+
+    Returns the description and the binaries it depends on."""
+    if kind == 'rustc':
+        version = subprocess.run([compiler, '-vV'], capture_output=True).stdout.decode('utf-8', errors='replace')
+        sysroot = subprocess.run([compiler, '--print', 'sysroot'], capture_output=True).stdout.decode('utf-8', errors='replace').strip()
+        files = [os.path.join(sysroot, 'bin', 'rustc'), *sorted(glob.glob(os.path.join(sysroot, 'lib', 'librustc_driver-*')))]
+        return f'{version}{sysroot}\n', [path for path in files if os.path.exists(path)]
+    version = subprocess.run([compiler, '--version'], capture_output=True).stdout.decode('utf-8', errors='replace')
+    # The clang, resource dir, target and sysroot wasixcc runs. In / so the compilation dir is always the same
+    driver = subprocess.run([compiler, '-###', '-x', 'c', '-c', '/dev/null', '-o', '/dev/null'], capture_output=True, cwd='/').stderr.decode('utf-8', errors='replace')
+    files = []
+    for line in driver.splitlines():
+        if '"-cc1"' in line:
+            files.append(shlex.split(line)[0])
+    resource_dir = subprocess.run([compiler, '-print-resource-dir'], capture_output=True, cwd='/').stdout.decode('utf-8', errors='replace').strip()
+    return f'{version}{driver}{resource_dir}\n', [path for path in files if os.path.exists(path)]
+
+def compiler_version(compiler, kind):
+    """Description of the toolchain behind a compiler, remembered until the wrapper or the binaries behind it change."""
+    env = sorted((name, value) for name, value in os.environ.items() if name.startswith('WASIXCC_') or name in ('PATH', 'RUSTUP_TOOLCHAIN'))
+    key = sha256(json.dumps([signature(os.path.realpath(compiler)), kind, env]).encode('utf-8'))
+    path = os.path.join(cache_dir, 'compilers', key)
+    try:
+        with open(path, 'r') as f:
+            remembered = json.load(f)
+        if all(signature(file) == file_signature for file, file_signature in zip(remembered['files'], remembered['signatures'])):
+            return remembered['version']
+    except (OSError, ValueError, KeyError):
+        pass
+    version, files = toolchain(compiler, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+        json.dump({'version': version, 'files': files, 'signatures': [signature(file) for file in files]}, f)
+    os.replace(f.name, path)
+    return version
+
+class Cache:
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+
+    def entry_dir(self, key):
+        return os.path.join(self.directory, 'objects', key[:2], key)
+
+    def lookup(self, key):
+        """Get the directory of a cached result, or None. A hit counts as a use for the eviction."""
+        directory = self.entry_dir(key)
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            return None
+        try:
+            os.utime(directory)
+        except FileNotFoundError:
+            # Evicted right now
+            return None
+        return directory
+
+    def store(self, key, files, meta):
+        """Store files by their name in the cache together with meta. Trims the cache if it is too large."""
+        os.makedirs(os.path.join(self.directory, 'tmp'), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.directory, 'tmp'))
+        try:
+            size = 0
+            for name, path in files.items():
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+                size += os.path.getsize(path)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            directory = self.entry_dir(key)
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            try:
+                os.rename(tmp_dir, directory)
+            except OSError:
+                # Another job stored the same result in the meantime
+                return
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with self.locked():
+            total = self.read_size() + size
+            self.write_size(total)
+            if total > self.limit:
+                self.trim(self.limit * 9 // 10)
+
+    def locked(self):
+        lock = open(os.path.join(self.directory, 'lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def read_size(self):
+        try:
+            with open(os.path.join(self.directory, 'size'), 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def write_size(self, size):
+        with open(os.path.join(self.directory, 'size'), 'w') as f:
+            f.write(str(size))
+
+    def entries(self):
+        """All cache entries with their size and the time they were last used."""
+        entries = []
+        objects_dir = os.path.join(self.directory, 'objects')
+        for prefix in os.listdir(objects_dir) if os.path.isdir(objects_dir) else []:
+            for key in os.listdir(os.path.join(objects_dir, prefix)):
+                directory = os.path.join(objects_dir, prefix, key)
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(directory))
+                    entries.append((os.stat(directory).st_mtime, size, directory))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    def trim(self, limit):
+        """Remove the least recently used entries until the cache is smaller than limit. Call with the lock held."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, directory in entries:
+            if total <= limit:
+                break
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+            removed += 1
+        self.write_size(total)
+        return removed, total
+
+def read_stats(stats_file):
+    """Counts of the results of every target and kind. Lines are `target kind result` or, once compacted, followed
+    by a count."""
+    counts = {}
+    with open(stats_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) in (3, 4):
+                counts[tuple(fields[:3])] = counts.get(tuple(fields[:3]), 0) + (int(fields[3]) if len(fields) == 4 else 1)
+    return counts
+
+def record(result, kind):
+    """Count a hit, miss or uncached run for the Makefile target that is being built."""
+    target = os.getenv('COMPILER_CACHE_TARGET') or '-'
+    stats_file = os.path.join(cache_dir, 'stats')
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'stats.lock'), 'w') as lock:
+        # Lines this short are appended in one piece, parallel jobs only need to wait for a compaction
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        with open(stats_file, 'a') as f:
+            f.write(f'{target} {kind} {result}\n')
+            size = f.tell()
+        if size < stats_compact_size:
+            return
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.getsize(stats_file) < stats_compact_size:
+            return
+        counts = read_stats(stats_file)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+            f.writelines(f'{target} {kind} {result} {count}\n' for (target, kind, result), count in sorted(counts.items()))
+        os.replace(f.name, stats_file)
+
+def run_uncached(command, kind):
+    record('uncached', kind)
+    sys.stdout.flush()
+    os.execv(command[0], command)
+
+def restore_entry(directory, outputs):
+    """Copy the files of a cache entry to where the compiler would have written them and replay its output.
+    outputs is a function that maps the meta of the entry to names in the cache and their paths. Returns False if
+    the entry was evicted while it was restored, the compile has to run then."""
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        for name, path in outputs(meta).items():
+            restore(directory, name, path)
+        streams = {}
+        for name in ('stdout', 'stderr'):
+            if meta.get(name):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    streams[name] = f.read()
+    except FileNotFoundError:
+        return False
+    for stream, name in ((sys.stdout.buffer, 'stdout'), (sys.stderr.buffer, 'stderr')):
+        if name in streams:
+            stream.write(streams[name])
+            stream.flush()
+    return True
+
+def restore(directory, name, path):
+    """Copy a cached file to where the compiler would have written it, replacing it at once."""
+    tmp_path = f'{path}.compiler-cache-{os.getpid()}'
+    shutil.copyfile(os.path.join(directory, name), tmp_path)
+    os.replace(tmp_path, path)
+
+def compile_and_store(cache, key, command, outputs, kind):
+    """Run the compiler and store the files it wrote. outputs maps names in the cache to paths, or is a function
+    that finds them after the compile."""
+    start = time.time()
+    result = subprocess.run(command, capture_output=True, close_fds=False)
+    sys.stdout.buffer.write(result.stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(result.stderr)
+    sys.stderr.flush()
+    if result.returncode != 0:
+        record('error', kind)
+        return result.returncode
+    files = outputs(start) if callable(outputs) else outputs
+    if files is None or not all(os.path.isfile(path) for path in files.values()):
+        record('uncached', kind)
+        return 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, data in (('stdout', result.stdout), ('stderr', result.stderr)):
+            with open(os.path.join(tmp_dir, name), 'wb') as f:
+                f.write(data)
+        streams = {name: os.path.join(tmp_dir, name) for name, data in (('stdout', result.stdout), ('stderr', result.stderr)) if data}
+        cache.store(key, {**files, **streams}, {'outputs': {name: os.path.basename(path) for name, path in files.items()}, 'stdout': bool(result.stdout), 'stderr': bool(result.stderr)})
+    record('miss', kind)
+    return 0
+
+def cc(cache, command):
+    """Cache a C or C++ compile. Returns the exit code, or None if it can not be cached."""
+    args = command[1:]
+    if '-c' not in args or '-E' in args or '-S' in args or '-M' in args or '-MM' in args or '-x' in args:
+        return None
+    sources = []
+    output = None
+    dependency_file = None
+    preprocess_args = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        value = args[index + 1] if arg in options_with_value and index + 1 < len(args) else None
+        index += 2 if value is not None else 1
+        if arg.startswith('@') or arg.startswith('-Wp,') or arg == '-':
+            return None
+        if arg == '-o':
+            output = value
+        elif arg.startswith('-o') and len(arg) > 2:
+            output = arg[2:]
+        elif arg == '-MF':
+            dependency_file = value
+        elif arg in ('-MT', '-MQ'):
+            pass
+        elif arg in dependency_options or arg == '-c':
+            pass
+        else:
+            if not arg.startswith('-') and value is None:
+                sources.append(arg)
+            preprocess_args += [arg] if value is None else [arg, value]
+    if len(sources) != 1 or not sources[0].endswith(source_extensions):
+        return None
+    output = output or os.path.splitext(os.path.basename(sources[0]))[0] + '.o'
+    if dependency_file is None and ('-MD' in args or '-MMD' in args):
+        dependency_file = os.path.splitext(output)[0] + '.d'
+
+    preprocessed = subprocess.run([command[0], *preprocess_args, '-E'], capture_output=True)
+    if preprocessed.returncode != 0:
+        # Let the compiler report the error
+        return None
+    env = sorted((name, value) for name, value in os.environ.items() if name.startswith('WASIXCC_') or name == 'CCC_OVERRIDE_OPTIONS')
+    key = sha256(json.dumps([
+        'cc', compiler_version(command[0], 'cc'), os.path.basename(command[0]), args, os.getcwd(), env,
+        sha256(preprocessed.stdout),
+    ]).encode('utf-8'))
+
+    outputs = {'object': output}
+    if dependency_file is not None:
+        outputs['dependencies'] = dependency_file
+    directory = cache.lookup(key)
+    if directory is not None and restore_entry(directory, lambda meta: outputs):
+        record('hit', 'cc')
+        return 0
+    return compile_and_store(cache, key, command, outputs, 'cc')
+
+def option_values(args, name):
+    """Values of a rustc option given as `--name value` or `--name=value`."""
+    values = []
+    for index, arg in enumerate(args):
+        if arg == name and index + 1 < len(args):
+            values.append(args[index + 1])
+        elif arg.startswith(f'{name}='):
+            values.append(arg[len(name) + 1:])
+    return values
+
+def rustc(cache, command):
+    """Cache a rustc compile of a library for the WASIX target. Returns the exit code, or None if it can not be cached."""
+    args = command[1:]
+    codegen = option_values(args, '-C') + [arg[2:] for arg in args if arg.startswith('-C') and len(arg) > 2]
+    crate_types = ','.join(option_values(args, '--crate-type')).split(',')
+    out_dirs = option_values(args, '--out-dir')
+    crate_names = option_values(args, '--crate-name')
+    sources = [arg for arg in args if arg.endswith('.rs') and not arg.startswith('-')]
+    if (
+        rust_target not in option_values(args, '--target') or len(out_dirs) != 1
+        or len(crate_names) != 1 or len(sources) != 1 or not set(crate_types) <= {'lib', 'rlib'}
+        or any(option.startswith('incremental') for option in codegen)
+        # Static native libraries end up in the rlib, but their content is unknown here
+        or any('static' in value for value in option_values(args, '-l'))
+    ):
+        return None
+    out_dir = out_dirs[0]
+    extra_filename = next((option[len('extra-filename='):] for option in codegen if option.startswith('extra-filename=')), '')
+    stem = f'{crate_names[0]}{extra_filename}'
+
+    # Ask rustc for the source files and environment variables the crate depends on
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dep_args = []
+        skip = False
+        for index, arg in enumerate(args):
+            if skip:
+                skip = False
+                continue
+            if arg in ('--emit', '--out-dir', '-o'):
+                skip = True
+                continue
+            if arg.startswith(('--emit=', '--out-dir=')) or arg.startswith('--error-format') or arg.startswith('--json'):
+                continue
+            dep_args.append(arg)
+        result = subprocess.run([command[0], *dep_args, '--emit=dep-info', '--out-dir', tmp_dir], capture_output=True, close_fds=False)
+        dep_info_file = os.path.join(tmp_dir, f'{stem}.d')
+        if result.returncode != 0 or not os.path.exists(dep_info_file):
+            return None
+        with open(dep_info_file, 'r') as f:
+            # The targets of the dep-info are in the temporary directory, its name must not change the key
+            dep_info = f.read().replace(tmp_dir, '')
+    inputs = set()
+    for line in dep_info.splitlines():
+        if line.startswith('#'):
+            continue
+        _, _, dependencies = line.partition(': ')
+        inputs.update(path.replace('\\ ', ' ') for path in re.split(r'(?<!\\) ', dependencies.strip()) if path)
+    try:
+        input_hashes = sorted((path, file_sha256(path)) for path in inputs)
+        extern_hashes = sorted((value, file_sha256(value.split('=', 1)[1])) for value in option_values(args, '--extern') if '=' in value)
+    except OSError:
+        return None
+    # The environment variables the crate reads are in the dep-info, the others like CARGO_BUILD_JOBS do not matter
+    env = sorted((name, value) for name, value in os.environ.items() if name.startswith('WASIXCC_'))
+    key = sha256(json.dumps([
+        'rustc', compiler_version(command[0], 'rustc'), args, os.getcwd(), env, dep_info, input_hashes, extern_hashes,
+    ]).encode('utf-8'))
+
+    directory = cache.lookup(key)
+    if directory is not None and restore_entry(directory, lambda meta: {name: os.path.join(out_dir, filename) for name, filename in meta['outputs'].items()}):
+        record('hit', 'rustc')
+        return 0
+
+    def outputs(start):
+        files = {}
+        for entry in os.scandir(out_dir):
+            if entry.name.startswith((f'lib{stem}.', f'{stem}.')) and entry.stat().st_mtime >= start - 1:
+                files[f'output-{len(files)}'] = entry.path
+        return files or None
+    return compile_and_store(cache, key, command, outputs, 'rustc')
+
+def command_exec(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No compiler given", file=sys.stderr)
+        exit(1)
+    # Cargo passes the path of rustc, the wrappers of wasixcc pass its name
+    command = [command[0] if os.sep in command[0] else find_compiler(command[0]), *command[1:]]
+    kind = 'rustc' if os.path.basename(command[0]).startswith('rustc') else 'cc'
+    cache = Cache(cache_dir, parse_size(max_size))
+    exit_code = rustc(cache, command) if kind == 'rustc' else cc(cache, command)
+    if exit_code is None:
+        run_uncached(command, kind)
+    exit(exit_code)
+
+def command_stats(args):
+    stats_file = os.path.join(cache_dir, 'stats')
+    if args.zero:
+        with open(stats_file, 'w'):
+            pass
+        return
+    targets = {}
+    for (target, _, result), count in (read_stats(stats_file) if os.path.exists(stats_file) else {}).items():
+        counts = targets.setdefault(target, {'hit': 0, 'miss': 0, 'uncached': 0, 'error': 0})
+        counts[result] = counts.get(result, 0) + count
+    if args.json:
+        print(json.dumps(targets, indent=2))
+        return
+    print(f"{'target':<40} {'hits':>7} {'misses':>7} {'uncached':>9} {'hit rate':>9}")
+    totals = {'hit': 0, 'miss': 0, 'uncached': 0}
+    for target, counts in sorted(targets.items()):
+        cacheable = counts['hit'] + counts['miss']
+        print(f"{target:<40} {counts['hit']:>7} {counts['miss']:>7} {counts['uncached']:>9} {counts['hit'] / cacheable if cacheable else 0:>8.0%}")
+        for name in totals:
+            totals[name] += counts[name]
+    cacheable = totals['hit'] + totals['miss']
+    cache = Cache(cache_dir, parse_size(max_size))
+    print(f"{len(targets)} targets, {totals['hit']} hits and {totals['miss']} misses ({totals['hit'] / cacheable if cacheable else 0:.0%}), {totals['uncached']} uncached runs")
+    print(f"Cache {cache_dir}: {format_size(cache.read_size())} of {format_size(cache.limit)} used")
+
+def command_trim(args):
+    cache = Cache(cache_dir, parse_size(max_size))
+    os.makedirs(cache_dir, exist_ok=True)
+    with cache.locked():
+        removed, total = cache.trim(parse_size(args.size) if args.size else cache.limit)
+    print(f"Removed {removed} entries, {format_size(total)} left")
+
+def command_clear(args):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    print(f"Removed {cache_dir}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    exec_parser = subparsers.add_parser('exec', help='Run a compiler through the cache')
+    exec_parser.add_argument('command', nargs=argparse.REMAINDER)
+    exec_parser.set_defaults(handler=command_exec)
+
+    stats_parser = subparsers.add_parser('stats', help='Print the hits and misses of every Makefile target')
+    stats_parser.add_argument('--json', action='store_true', help='Print the counts as JSON')
+    stats_parser.add_argument('--zero', action='store_true', help='Reset the counts')
+    stats_parser.set_defaults(handler=command_stats)
+
+    trim_parser = subparsers.add_parser('trim', help='Remove the least recently used entries until the cache fits its size limit')
+    trim_parser.add_argument('--size', help=f'Size to trim to, like 5G (default: {max_size}, or $COMPILER_CACHE_SIZE)')
+    trim_parser.set_defaults(handler=command_trim)
+
+    clear_parser = subparsers.add_parser('clear', help='Remove the whole cache')
+    clear_parser.set_defaults(handler=command_clear)
+
+    args = parser.parse_args()
+    args.handler(args)
@@ -6,33 +6,33 @@
 # requires-python = ">=3.10"
 # ///
 from dumb_pypi import main
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from artifact_catalog import Catalog
+import argparse
+import fcntl
 import glob
 import os
 import json
 import hashlib
 import shutil
 import subprocess
-import zipfile
+import time
 
 package_list = 'package-list.jsonl'
 
-wheel_files = glob.glob(os.path.join("artifacts", '*.whl'))
-wheel_files += glob.glob(os.path.join("artifacts", '*.tar.gz')) # SDists
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'ddtrace*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'httptools*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'jiter*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'orjson*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'primp*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'psycopg*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pydantic_core*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pynacl*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pyyaml*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'rpds_py*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tiktoken*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tokenizers*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tornado*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'watchdog*.whl'))
-wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'watchfiles*.whl'))
+# State of the last run, used to only update what changed in dist/ with --incremental
+dist_manifest_file = '.index-cache/dist-manifest.json'
+previous_package_list = '.index-cache/previous-package-list.jsonl'
+# Held while the index is generated, parallel builds may refresh the index at the same time
+index_lock_file = '.index-cache/lock'
+
+# PEP 691 JSON simple API (application/vnd.pypi.simple.v1+json), written next to the HTML pages as index.json
+simple_json_api_version = '1.1'
+
+# ioctl to create a copy-on-write clone of a file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
 
 # These packages will be excluded from the index
 excluded_prefixes = (
@@ -45,104 +45,352 @@ included_prefixes = (
     # Example: 'artifacts/somepackage',
 )
 
-def contains_native_binaries(file_path):
-    """Check if a wheel file contains native binaries (.so, .so.*, or .wasm files).
+def find_wheel_files():
+    wheel_files = glob.glob(os.path.join("artifacts", '*.whl'))
+    wheel_files += glob.glob(os.path.join("artifacts", '*.tar.gz')) # SDists
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'ddtrace*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'httptools*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'jiter*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'orjson*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'primp*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'psycopg*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pydantic_core*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pynacl*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'pyyaml*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'rpds_py*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tiktoken*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tokenizers*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'tornado*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'watchdog*.whl'))
+    wheel_files += glob.glob(os.path.join("python-wasix-binaries/wheels", 'watchfiles*.whl'))
+
+    # Filter out excluded prefixes
+    # Sort, so the package list does not depend on the directory order
+    return sorted(f for f in wheel_files if not f.startswith(excluded_prefixes))
+
+def native_binaries_candidate(catalog, file_path):
+    """Get the wheel that needs to be checked for native binaries, or None if the file is always included.
     For tar.gz files, finds the corresponding wheel and checks that instead."""
-    
+
     if not file_path.startswith('artifacts/'):
         # Only check files in artifacts/
-        return True
+        return None
 
     # If it's a tar.gz, find the corresponding wheel
     if file_path.endswith('.tar.gz'):
         basename = os.path.basename(file_path)
-        package_version = basename.replace('.tar.gz', '')
+        sdist = catalog.get(file_path)
         # Look for matching -none-any.whl file
-        wheel_path = glob.glob(f'artifacts/{package_version}-*.whl')
+        wheel_path = catalog.wheels_for(sdist['name'], sdist['version'])
         if len(wheel_path) == 0:
             # No matching wheel found
             print(f"WARNING: No matching wheel found for {basename}")
             if os.getenv('MAKELEVEL') != None:
-                return True
+                return None
             else:
                 exit(1)
         if len(wheel_path) > 1:
             print(f"WARNING: Multiple matching wheels found for {basename}, using the first one")
             exit(1)
         file_path = wheel_path[0]
-    
+
     if not file_path.endswith('-none-any.whl'):
         # Only check none-any wheels
-        return True
-    
+        return None
+
+    return file_path
+
+def core_metadata_entry(metadata):
+    """Get the package list fields for the PEP 658 metadata sidecar of a wheel."""
+    entry = {"core_metadata": f"sha256={hashlib.sha256(metadata).hexdigest()}"}
+    requires_python = BytesParser().parsebytes(metadata, headersonly=True).get('Requires-Python')
+    if requires_python:
+        entry["requires_python"] = requires_python.strip()
+    return entry
+
+def git_metadata_for_file(file_path):
+    """Get the upload timestamp and uploader of a single file. Spawns two git processes, only used for benchmarking."""
+    filename = os.path.basename(file_path)
+    filedir = os.path.dirname(file_path)
+
+    timestamp_result = subprocess.run(["git", "log", "-1", "--pretty=%at", filename], capture_output=True, cwd=filedir)
+    upload_timestamp = int(timestamp_result.stdout.decode('utf-8').partition('\n')[0] or "0") or None
+
+    name_result = subprocess.run(["git", "log", "-1", "--pretty=%aN", filename], capture_output=True, cwd=filedir)
+    uploader_name = name_result.stdout.decode('utf-8').partition('\n')[0] or "wasmer"
+
+    return upload_timestamp, uploader_name
+
+def git_metadata_for_directory(directory):
+    """Get the upload timestamp and uploader of every file in a directory with a single git log traversal.
+
+    Returns a dict from filename to (timestamp, uploader) of the last commit that touched the file."""
+    result = subprocess.run(
+        ["git", "-c", "core.quotePath=false", "log", "--pretty=format:%x00%at %aN", "--name-only", "--relative", "--", "."],
+        capture_output=True, cwd=directory)
+    metadata = {}
+    # Every commit starts with a NUL byte, followed by the header line and the changed files
+    for commit in result.stdout.decode('utf-8').split('\0')[1:]:
+        header, _, files = commit.partition('\n')
+        timestamp, _, uploader = header.partition(' ')
+        for filename in files.splitlines():
+            # The first commit we see is the most recent one
+            if filename and filename not in metadata:
+                metadata[filename] = (int(timestamp or "0") or None, uploader or "wasmer")
+    return metadata
+
+def git_metadata(file_paths, directory_metadata):
+    """Get the upload timestamp and uploader for all files from the per-directory metadata."""
+    return {
+        file_path: directory_metadata[os.path.dirname(file_path)].get(os.path.basename(file_path), (None, "wasmer"))
+        for file_path in file_paths
+    }
+
+def benchmark_git_metadata(wheel_files):
+    start = time.perf_counter()
+    per_file_metadata = {file_path: git_metadata_for_file(file_path) for file_path in wheel_files}
+    per_file_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    directories = sorted(set(map(os.path.dirname, wheel_files)))
+    batched_metadata = git_metadata(wheel_files, {directory: git_metadata_for_directory(directory) for directory in directories})
+    batched_duration = time.perf_counter() - start
+
+    mismatches = [file_path for file_path in wheel_files if per_file_metadata[file_path] != batched_metadata[file_path]]
+    for file_path in mismatches:
+        print(f"Mismatch for {file_path}: per-file {per_file_metadata[file_path]}, batched {batched_metadata[file_path]}")
+    print(f"Collected git metadata for {len(wheel_files)} files")
+    print(f"  per-file: {per_file_duration:.3f}s ({2 * len(wheel_files)} git processes)")
+    print(f"  batched:  {batched_duration:.3f}s ({len(directories)} git processes)")
+    if batched_duration > 0:
+        print(f"  speedup:  {per_file_duration / batched_duration:.1f}x")
+    return not mismatches
+
+def load_dist_manifest():
+    """Load the manifest of the last run, or None if dist/ does not match it anymore."""
+    if not os.path.exists('dist/simple/index.html') or not os.path.exists(previous_package_list):
+        return None
+    try:
+        with open(dist_manifest_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_dist_manifest(manifest):
+    os.makedirs(os.path.dirname(dist_manifest_file), exist_ok=True)
+    tmp_file = dist_manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, dist_manifest_file)
+    shutil.copyfile(package_list, previous_package_list)
+
+def link_or_copy(src, dst):
+    """Place src at dst as a hardlink, a reflink or a copy, whichever the filesystem supports first."""
+    if os.path.lexists(dst):
+        os.remove(dst)
     try:
-        with zipfile.ZipFile(file_path, 'r') as zip_file:
-            for file_info in zip_file.namelist():
-                # Check for .so, .so.*, or .wasm files
-                if file_info.endswith('.so') or '.so.' in file_info or file_info.endswith('.wasm'):
-                    return True
-        return False
-    except Exception as e:
-        print(f"Warning: Could not check {file_path}: {e}")
-        # If we can't check, include it to be safe
-        return True
-
-# Filter out excluded prefixes
-wheel_files = [f for f in wheel_files if not f.startswith(excluded_prefixes)]
-
-# Filter out -none-any.whl and corresponding tar.gz files that don't contain native binaries
-filtered_wheel_files = []
-
-for f in wheel_files:
-    if (f.endswith('-none-any.whl') or f.endswith('.tar.gz')) and f.startswith('artifacts/'):
-        # Always include if it matches included_prefixes
-        if any(f.startswith(prefix) for prefix in included_prefixes):
-            filtered_wheel_files.append(f)
-        elif contains_native_binaries(f):
-            print(f"Including {os.path.basename(f)} even though it's `none-any` - native binaries found")
-            filtered_wheel_files.append(f)
-        else:
-            print(f"Excluding {os.path.basename(f)} - no native binaries found")
-    else:
-        filtered_wheel_files.append(f)
-
-wheel_files = filtered_wheel_files
-
-# Create JSON for each wheel file
-with open(package_list, 'w') as package_list_file:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return 'reflink'
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def remove_stale_projects(package_names, previous_package_names):
+    """Remove the pages of projects that are not in the index anymore. dumb-pypi only ever adds pages."""
+    for name in sorted(previous_package_names - package_names):
+        print(f"Removing stale project {name}")
+        shutil.rmtree(os.path.join('dist/simple', name), ignore_errors=True)
+        shutil.rmtree(os.path.join('dist/pypi', name), ignore_errors=True)
+
+def write_if_changed(path, content):
+    """Write a file atomically, but only if its content changed. Returns whether it was written."""
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(content)
+    os.replace(tmp_file, path)
+    return True
+
+def simple_json_file(package, size):
+    """Get the PEP 691 file entry for a dumb-pypi package."""
+    algorithm, _, digest = package.hash.partition('=')
+    file = {
+        "filename": package.filename,
+        "url": f"../../packages/{package.filename}",
+        "hashes": {algorithm: digest},
+    }
+    if package.requires_python:
+        file["requires-python"] = package.requires_python
+    if package.core_metadata:
+        algorithm, _, digest = package.core_metadata.partition('=')
+        file["core-metadata"] = {algorithm: digest}
+        # Older installers only know the name from before PEP 714
+        file["dist-info-metadata"] = {algorithm: digest}
+    file["yanked"] = package.yanked_reason or False
+    # The size and upload-time fields were added in version 1.1 (PEP 700)
+    file["size"] = size
+    if package.upload_timestamp is not None:
+        file["upload-time"] = datetime.fromtimestamp(package.upload_timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return file
+
+def write_simple_json(packages, sizes):
+    """Write PEP 691 JSON pages for the root project list and every project. Returns the number of pages written."""
+    meta = {"api-version": simple_json_api_version}
+    written = 0
+    root = {"meta": meta, "projects": [{"name": name} for name in sorted(packages)]}
+    written += write_if_changed('dist/simple/index.json', json.dumps(root, separators=(',', ':')))
+    for name, files in packages.items():
+        sorted_files = sorted(files)
+        project = {
+            "meta": meta,
+            "name": name,
+            "files": [simple_json_file(package, sizes[package.filename]) for package in sorted_files],
+            "versions": list(dict.fromkeys(package.version for package in sorted_files if package.version)),
+        }
+        written += write_if_changed(os.path.join('dist/simple', name, 'index.json'), json.dumps(project, separators=(',', ':')))
+    return written
+
+class StageTimer:
+    """Print how long each stage of the index generation took."""
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def done(self, stage):
+        now = time.perf_counter()
+        print(f"Stage {stage}: {now - self.start:.2f}s")
+        self.start = now
+
+def generate_index(args):
+    timer = StageTimer()
+    wheel_files = find_wheel_files()
+    timer.done("discover")
+
+    if args.benchmark_git_metadata:
+        exit(0 if benchmark_git_metadata(wheel_files) else 1)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        # The git history is independent of everything else, so start walking it right away
+        directories = sorted(set(map(os.path.dirname, wheel_files)))
+        directory_metadata_futures = {directory: executor.submit(git_metadata_for_directory, directory) for directory in directories}
+
+        # Only artifacts that changed since they were last recorded are hashed and inspected again.
+        # The wheels next to the sdists are recorded too, as they decide whether an sdist is included.
+        with Catalog() as catalog:
+            hits, misses = catalog.sync(sorted(set(wheel_files) | set(glob.glob('artifacts/*.whl'))), executor)
+            removed = catalog.remove_missing()
+            print(f"Catalog: {hits} unchanged, {misses} updated, {len(removed)} removed")
+            timer.done("catalog")
+
+            # Filter out -none-any.whl and corresponding tar.gz files that don't contain native binaries
+            filtered_wheel_files = []
+            for f in wheel_files:
+                # Always include if it matches included_prefixes
+                if not (f.endswith('-none-any.whl') or f.endswith('.tar.gz')) or not f.startswith('artifacts/') or f.startswith(included_prefixes):
+                    filtered_wheel_files.append(f)
+                    continue
+                candidate = native_binaries_candidate(catalog, f)
+                if candidate is None or catalog.get(candidate)['native']:
+                    print(f"Including {os.path.basename(f)} even though it's `none-any` - native binaries found")
+                    filtered_wheel_files.append(f)
+                else:
+                    print(f"Excluding {os.path.basename(f)} - no native binaries found")
+            wheel_files = filtered_wheel_files
+            artifacts = {f: catalog.get(f) for f in wheel_files}
+        timer.done("filter")
+
+        upload_metadata = git_metadata(wheel_files, {directory: future.result() for directory, future in directory_metadata_futures.items()})
+        timer.done("git metadata")
+
+    # Create JSON for each wheel file
+    with open(package_list, 'w') as package_list_file:
+        for filepath in wheel_files:
+            filename = os.path.basename(filepath)
+            upload_timestamp, uploader_name = upload_metadata[filepath]
+
+            entry = {
+                "filename": filename,
+                "hash": f"sha256={artifacts[filepath]['sha256']}",
+                "uploaded_by": uploader_name,
+                "upload_timestamp": upload_timestamp
+            }
+            if artifacts[filepath]['core_metadata'] is not None:
+                entry.update(core_metadata_entry(artifacts[filepath]['core_metadata']))
+
+            json.dump(entry, package_list_file)
+            package_list_file.write('\n')
+    timer.done("package list")
+
+    # Only regenerate the project pages whose files changed since the last run
+    manifest = load_dist_manifest() if args.incremental else None
+    previous_package_list_args = ()
+    if manifest is not None:
+        previous_package_list_args = ('--previous-package-list-json', previous_package_list)
+        remove_stale_projects(set(main.package_list_json(package_list)), set(main.package_list_json(previous_package_list)))
+    main.main((
+            '--package-list-json', package_list,
+            *previous_package_list_args,
+            '--output-dir', 'dist',
+            '--packages-url', '../../packages/',
+            '--title', 'WASIX Python native wheels',
+    ))
+    timer.done("html")
+
+    json_pages = write_simple_json(main.package_list_json(package_list), {os.path.basename(filepath): os.path.getsize(filepath) for filepath in wheel_files})
+    print(f"JSON simple API: {json_pages} pages written")
+    timer.done("json")
+
+    # Link all packages to dist/packages
+    os.makedirs('dist/packages', exist_ok=True)
+    previous_files = manifest['packages'] if manifest is not None else {}
+    packages = {os.path.basename(filepath): artifacts[filepath]['sha256'] for filepath in wheel_files}
+    methods = {'unchanged': 0, 'link': 0, 'reflink': 0, 'copy': 0}
     for filepath in wheel_files:
         filename = os.path.basename(filepath)
-        filedir = os.path.dirname(filepath)
-
-        with open(filepath, 'rb') as f:
-            content = f.read()
-            sha256_hash = hashlib.sha256(content).hexdigest()
-
-        timestamp_result = subprocess.run(["git", "log", "-1", "--pretty=%at", filename], capture_output=True, cwd=filedir)
-        upload_timestamp = int(timestamp_result.stdout.decode('utf-8').partition('\n')[0] or "0") or None
-        
-        name_result = subprocess.run(["git", "log", "-1", "--pretty=%aN", filename], capture_output=True, cwd=filedir)
-        uploader_name = name_result.stdout.decode('utf-8').partition('\n')[0] or "wasmer"
-
-        entry = {
-            "filename": filename,
-            "hash": f"sha256={sha256_hash}",
-            "uploaded_by": uploader_name,
-            "upload_timestamp": upload_timestamp
-        }
+        dst = os.path.join('dist/packages', filename)
+        if previous_files.get(filename) == packages[filename] and os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(filepath):
+            methods['unchanged'] += 1
+            continue
+        methods[link_or_copy(filepath, dst)] += 1
+    # PEP 658 metadata sidecars, so installers don't need to download whole wheels during resolution
+    for filepath, artifact in artifacts.items():
+        metadata = artifact['core_metadata']
+        if metadata is None:
+            continue
+        filename = os.path.basename(filepath) + '.metadata'
+        dst = os.path.join('dist/packages', filename)
+        packages[filename] = hashlib.sha256(metadata).hexdigest()
+        if previous_files.get(filename) == packages[filename] and os.path.exists(dst):
+            continue
+        with open(dst, 'wb') as f:
+            f.write(metadata)
+    stale_files = sorted(set(os.listdir('dist/packages')) - set(packages))
+    for filename in stale_files:
+        os.remove(os.path.join('dist/packages', filename))
+    print(f"Packages: {methods['unchanged']} unchanged, {methods['link']} hardlinked, {methods['reflink']} reflinked, {methods['copy']} copied, {len(stale_files)} removed")
+    save_dist_manifest({'packages': packages})
+    timer.done("packages")
 
-        json.dump(entry, package_list_file)
-        package_list_file.write('\n')
-
-main.main((
-        '--package-list-json', package_list,
-        '--output-dir', 'dist',
-        '--packages-url', '../../packages/',
-        '--title', 'WASIX Python native wheels',
-))
-
-# Copy all packages to dist/packages
-os.makedirs('dist/packages', exist_ok=True)
-for entry in wheel_files:
-    dst = os.path.join('dist/packages', os.path.basename(entry))
-    shutil.copy2(entry, dst)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the WASIX python package index in dist/')
+    parser.add_argument('--benchmark-git-metadata', action='store_true', help='Compare per-file and batched git metadata collection and exit')
+    parser.add_argument('--incremental', action='store_true', help='Only update the parts of dist/ that changed since the last run')
+    parser.add_argument('-j', '--jobs', type=int, default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(), help='Number of worker processes for cataloging artifacts and git queries (default: number of available cores)')
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(index_lock_file), exist_ok=True)
+    with open(index_lock_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generate_index(args)
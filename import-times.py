@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Cold import time of every package installed in an unpacked python webc like python-with-packages.
+
+Every top-level module of the installed wheels is imported in a fresh `python -X importtime` process with
+wasmer. The modules are found from the names in the WHEELS and PYTHON_WASIX_BINARIES_WHEELS lists of the
+Makefile: the catalog maps them to their distribution, and the distribution's files in site-packages tell
+which top-level modules it installs. Each import is repeated and the run with the median time is reported,
+with the submodules that took the most time themselves.
+
+Budgets are read from a file with a module name and a budget in milliseconds on each line. The script exits
+with 1 if the cumulative import time of a module is above its budget.
+
+Run it after `make python-with-packages.aot`, otherwise the first import of every module includes compiling it.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from artifact_catalog import Catalog
+from build_common import canonicalize_name
+
+wasmer = os.getenv('WASMER', 'wasmer')
+cache_dir = os.path.abspath(os.getenv('WASMER_CACHE_DIR', '.wasmer-cache'))
+
+# import time:       523 |       1764 |   numpy._core
+importtime_line = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def distribution_names(wheels, pwb_wheels, catalog_file):
+    """Map the names of the Makefile to the canonical names of their distributions."""
+    names = {}
+    catalog = Catalog(catalog_file) if catalog_file is not None and os.path.exists(catalog_file) else None
+    for project in wheels:
+        rows = catalog.for_project(project, 'wheel') if catalog is not None else []
+        if rows:
+            names[project] = rows[0]['name']
+        else:
+            # Good enough for most projects, the others need a catalog
+            names[project] = canonicalize_name(re.sub(r'^python-|-python$', '', project))
+    if catalog is not None:
+        catalog.db.close()
+    for wheel in pwb_wheels:
+        # Wheels from python-wasix-binaries are named after the wheel file
+        names[wheel] = canonicalize_name(wheel.split('-')[0])
+    return names
+
+def installed_distributions(package):
+    """Get the .dist-info directories in the site-packages of a package by canonical distribution name."""
+    distributions = {}
+    for dist_info in glob.glob(os.path.join(package, 'root', '**', 'site-packages', '*.dist-info'), recursive=True):
+        name = os.path.basename(dist_info)[:-len('.dist-info')].split('-')[0]
+        distributions[canonicalize_name(name)] = dist_info
+    return distributions
+
+def top_level_modules(dist_info):
+    """Get the importable top-level modules of an installed distribution."""
+    top_level_file = os.path.join(dist_info, 'top_level.txt')
+    if os.path.exists(top_level_file):
+        with open(top_level_file, 'r') as f:
+            candidates = [line.strip().replace('/', '.').split('.')[0] for line in f]
+    else:
+        with open(os.path.join(dist_info, 'RECORD'), 'r') as f:
+            candidates = [line.split(',')[0].split('/')[0] for line in f]
+        # Extension modules are named like _cffi_backend.cpython-313-wasm32-wasi.so
+        candidates = [candidate.split('.')[0] for candidate in candidates if not candidate.endswith(('.dist-info', '.data', '.pth'))]
+    modules = sorted({candidate for candidate in candidates if candidate.isidentifier() and candidate != '__pycache__'})
+    # Private modules like _cffi_backend are imported by the public ones
+    public = [module for module in modules if not module.startswith('_')]
+    return public or modules
+
+def parse_importtime(output, module):
+    """Get the entries of `-X importtime` output that belong to the import of a module, in import order."""
+    entries = []
+    for line in output.splitlines():
+        match = importtime_line.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        entries.append({'name': name, 'self': int(self_us), 'cumulative': int(cumulative_us), 'depth': (len(indent) - 1) // 2})
+        # Imports are printed when they finish, so a top-level entry comes after everything it imported
+        if entries[-1]['depth'] == 0:
+            if name == module:
+                return entries
+            entries = []
+    return None
+
+def measure(package, module, repeat):
+    """Import a module in fresh processes. Returns the parsed run with the median cumulative time."""
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [wasmer, 'run', '--llvm', package, '--', '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, env={**os.environ, 'WASMER_CACHE_DIR': cache_dir},
+        )
+        stderr = result.stderr.decode('utf-8', errors='replace')
+        entries = parse_importtime(stderr, module) if result.returncode == 0 else None
+        if entries is None:
+            error = stderr.strip().splitlines()[-1:] or [f'exit code {result.returncode}']
+            return {'module': module, 'error': error[0]}
+        runs.append(entries)
+    runs.sort(key=lambda entries: entries[-1]['cumulative'])
+    entries = runs[len(runs) // 2]
+    return {
+        'module': module,
+        'cumulative': entries[-1]['cumulative'] / 1000,
+        'self': entries[-1]['self'] / 1000,
+        'modules': len(entries),
+        'spread': (runs[-1][-1]['cumulative'] - runs[0][-1]['cumulative']) / 1000,
+        'slowest': [
+            {'name': entry['name'], 'self': entry['self'] / 1000, 'cumulative': entry['cumulative'] / 1000}
+            for entry in sorted(entries, key=lambda entry: entry['self'], reverse=True)
+        ],
+    }
+
+def load_budgets(budgets_file):
+    budgets = {}
+    with open(budgets_file, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                module, budget = line.split()
+                budgets[module] = float(budget)
+    return budgets
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('package', nargs='?', default='python-with-packages', help='Unpacked webc (default: python-with-packages)')
+    parser.add_argument('--wheels', default='', help='Names from the WHEELS list of the Makefile, separated by spaces')
+    parser.add_argument('--pwb-wheels', default='', help='Names from the PYTHON_WASIX_BINARIES_WHEELS list of the Makefile, separated by spaces')
+    parser.add_argument('--catalog', default=os.getenv('ARTIFACT_CATALOG', 'catalog.sqlite'), help='Artifact catalog to look up the distribution of each wheel')
+    parser.add_argument('--budgets', help='File with a module name and an import time budget in milliseconds on every line')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times every module is imported (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of imports measured in parallel. More than one makes the times less precise (default: 1)')
+    parser.add_argument('--top', type=int, default=3, help='Number of slowest submodules to show for each module (default: 3)')
+    parser.add_argument('--output', default='import-times.json', help='Where to write the full report (default: import-times.json)')
+    args = parser.parse_args()
+
+    distributions = installed_distributions(args.package)
+    modules = {}
+    for project, name in distribution_names(args.wheels.split(), args.pwb_wheels.split(), args.catalog).items():
+        if name not in distributions:
+            print(f"Warning: {project} ({name}) is not installed in {args.package}")
+            continue
+        for module in top_level_modules(distributions[name]):
+            modules.setdefault(module, project)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda module: {'project': modules[module], **measure(args.package, module, args.repeat)}, sorted(modules)))
+
+    budgets = load_budgets(args.budgets) if args.budgets else {}
+    over_budget = []
+    for result in results:
+        budget = budgets.get(result['module'])
+        if budget is not None and 'cumulative' in result:
+            result['budget'] = budget
+            if result['cumulative'] > budget:
+                over_budget.append(result)
+    with open(args.output, 'w') as f:
+        json.dump({'package': os.path.abspath(args.package), 'repeat': args.repeat, 'imports': results}, f, indent=2)
+
+    measured = sorted((result for result in results if 'cumulative' in result), key=lambda result: result['cumulative'], reverse=True)
+    print(f"{'module':<28} {'total ms':>9} {'self ms':>8} {'modules':>7} {'budget':>7}  slowest submodules (self ms)")
+    for result in measured:
+        budget = f"{result['budget']:.0f}" if 'budget' in result else '-'
+        slowest = ', '.join(f"{entry['name']} {entry['self']:.1f}" for entry in result['slowest'][:args.top])
+        marker = ' !' if result in over_budget else ''
+        print(f"{result['module']:<28} {result['cumulative']:>9.1f} {result['self']:>8.1f} {result['modules']:>7} {budget:>7}{marker} {slowest}")
+    for result in results:
+        if 'error' in result:
+            print(f"Warning: Could not import {result['module']} ({result['project']}): {result['error']}")
+    if measured:
+        print(f"Imported {len(measured)} modules, median {statistics.median(result['cumulative'] for result in measured):.1f}ms. Full report in {args.output}")
+    if over_budget:
+        print(f"{len(over_budget)} modules are over their import time budget: {', '.join(result['module'] for result in over_budget)}", file=sys.stderr)
+        exit(1)
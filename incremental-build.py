@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Keep the build trees of the Makefile between builds, for make INCREMENTAL=1.
+
+`sync` brings a build directory up to date with the directory it is copied from, the prepared worktree for
+pkgs/<name>.build and the unpacked sdist for pkgs/<name>.sdist. Only files whose content changed are copied, all
+others keep their time, so make, ninja and meson only rebuild what depends on the change. Files the build created
+stay, files that are gone from the source are removed. When a build file like configure.ac, CMakeLists.txt or
+meson.build changed, the directory is copied from scratch instead.
+
+`clean-dirs` replaces the `rm -rf` of the configure, cmake and meson build directories at the start of a recipe.
+It only removes them when the configuration of the target changed since they were configured: its expanded
+recipe, the WASIXCC_* variables, or the libs in the sysroots it depends on.
+"""
+from build_common import file_sha256
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+state_dir = os.path.join(root_dir, '.incremental')
+
+# Files that change how a project is configured, a change to one of them rebuilds it from scratch
+build_files = {
+    'configure', 'configure.ac', 'configure.in', 'aclocal.m4', 'Makefile.am', 'Makefile.in', 'CMakeLists.txt',
+    'CMakePresets.json', 'meson.build', 'meson_options.txt', 'meson.options', 'setup.py', 'setup.cfg',
+    'pyproject.toml', 'Cargo.toml', 'Cargo.lock', 'build.rs', 'BUILD', 'BUILD.bazel', 'WORKSPACE', 'MODULE.bazel',
+}
+build_file_suffixes = ('.cmake', '.m4', '.bzl')
+
+def state_path(path):
+    return os.path.join(state_dir, os.path.relpath(os.path.abspath(path), root_dir).replace('/', '%') + '.json')
+
+def read_state(path):
+    try:
+        with open(state_path(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_state(path, state):
+    os.makedirs(state_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=state_dir, delete=False) as f:
+        json.dump(state, f)
+    os.replace(f.name, state_path(path))
+
+def signature(path):
+    info = os.lstat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+def scan(source, previous):
+    """Files, symlinks and directories of the source tree. Files are hashed unless they did not change since the last sync."""
+    entries = {}
+    for directory, dirnames, filenames in os.walk(source):
+        for name in dirnames + filenames:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, source)
+            if os.path.islink(path):
+                entries[relative] = {'link': os.readlink(path)}
+            elif os.path.isdir(path):
+                entries[relative] = {'directory': True}
+            elif os.path.isfile(path):
+                old = previous.get(relative, {})
+                sha = old['sha'] if old.get('source') == signature(path) else file_sha256(path)
+                entries[relative] = {'sha': sha, 'source': signature(path)}
+    return entries
+
+def is_build_file(relative):
+    name = os.path.basename(relative)
+    return name in build_files or name.endswith(build_file_suffixes)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def command_sync(args):
+    source, destination = args.source, args.destination
+    state = read_state(destination) or {}
+    entries = scan(source, state.get('files', {}))
+    build_files_hash = hashlib.sha256(json.dumps(sorted((relative, entry['sha']) for relative, entry in entries.items() if 'sha' in entry and is_build_file(relative))).encode('utf-8')).hexdigest()
+
+    if not os.path.isdir(destination) or state.get('configuration') != build_files_hash:
+        if os.path.isdir(destination) and state:
+            print(f"Build files of {source} changed, copying it to {destination} from scratch", file=sys.stderr)
+        remove(destination)
+        subprocess.run(['cp', '-rf', source, destination], check=True)
+        for relative, entry in entries.items():
+            if 'sha' in entry:
+                entry['build'] = signature(os.path.join(destination, relative))
+        write_state(destination, {'configuration': build_files_hash, 'files': entries})
+        return
+
+    copied = 0
+    for relative, entry in sorted(entries.items()):
+        path = os.path.join(destination, relative)
+        if 'directory' in entry:
+            if os.path.islink(path) or (os.path.lexists(path) and not os.path.isdir(path)):
+                remove(path)
+            os.makedirs(path, exist_ok=True)
+        elif 'link' in entry:
+            if not os.path.islink(path) or os.readlink(path) != entry['link']:
+                remove(path)
+                os.symlink(entry['link'], path)
+                copied += 1
+        else:
+            old = state['files'].get(relative, {})
+            if os.path.isfile(path) and not os.path.islink(path):
+                if old.get('sha') == entry['sha'] and old.get('build') == signature(path):
+                    entry['build'] = old['build']
+                    continue
+                # Written by the last build, or copied by an earlier sync
+                if file_sha256(path) == entry['sha']:
+                    entry['build'] = signature(path)
+                    continue
+            remove(path)
+            shutil.copyfile(os.path.join(source, relative), path)
+            shutil.copymode(os.path.join(source, relative), path)
+            entry['build'] = signature(path)
+            copied += 1
+    # Files the source had at the last sync, but not anymore. Everything else in the build tree was built
+    removed = 0
+    for relative in sorted(set(state['files']) - set(entries), reverse=True):
+        path = os.path.join(destination, relative)
+        if os.path.lexists(path) and not (os.path.isdir(path) and not os.path.islink(path) and os.listdir(path)):
+            remove(path)
+            removed += 1
+    write_state(destination, {'configuration': build_files_hash, 'files': entries})
+    # Newer than the source, even if nothing changed
+    os.utime(destination)
+    print(f"Updated {destination} from {source}: {copied} changed, {removed} removed", file=sys.stderr)
+
+def sysroot_hash(path):
+    """Hash of the libs in a sysroot or unpacked lib, from the manifests package_lib wrote into their archives."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        if name.startswith('.') and name.endswith('.manifest'):
+            digest.update(name.encode('utf-8'))
+            with open(os.path.join(path, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def configuration(args):
+    """Everything the configuration of a target depends on, besides the build files of its source."""
+    recipe = subprocess.run(
+        ['python3', os.path.join(root_dir, 'build-cache.py'), 'recipe', '--target', args.target, '--prerequisites', args.prerequisites, '--order-only', args.order_only],
+        capture_output=True, text=True,
+    )
+    if recipe.returncode != 0:
+        raise ValueError(recipe.stderr.strip())
+    sysroots = {}
+    for path in args.prerequisites.split():
+        if path.endswith(('.sysroot', '.tar.zst.unpacked')):
+            sysroots[path] = sysroot_hash(os.path.join(root_dir, path))
+        elif path.endswith('.tar.zst'):
+            sysroots[path] = file_sha256(os.path.join(root_dir, path))
+    return {
+        'directory': os.path.relpath(os.getcwd(), root_dir),
+        'recipe': json.loads(recipe.stdout),
+        'environment': {name: value for name, value in sorted(os.environ.items()) if name.startswith('WASIXCC_')},
+        'sysroots': sysroots,
+    }
+
+def command_clean_dirs(args):
+    # The recipe usually changed into the build tree, but the target is relative to the Makefile
+    target = os.path.join(root_dir, args.target)
+    directories = args.directories[1:] if args.directories[:1] == ['--'] else args.directories
+    name = ' '.join(directories)
+    state = read_state(target) or {}
+    try:
+        key = hashlib.sha256(json.dumps(configuration(args), sort_keys=True).encode('utf-8')).hexdigest()
+    except (OSError, ValueError) as error:
+        print(f"Warning: Can not tell if the configuration of {args.target} changed, removing {name}: {error}", file=sys.stderr)
+        key = None
+    if key is not None and state.get(name) == key:
+        return
+    if state.get(name) is not None and any(os.path.lexists(directory) for directory in directories):
+        print(f"Configuration of {args.target} changed, removing {name}", file=sys.stderr)
+    for directory in directories:
+        remove(directory)
+    # A build that fails after this continues where it stopped next time
+    state[name] = key
+    write_state(target, state)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help='Copy the files that changed from a source tree to a build tree')
+    sync_parser.add_argument('source')
+    sync_parser.add_argument('destination')
+    sync_parser.set_defaults(handler=command_sync)
+
+    clean_dirs_parser = subparsers.add_parser('clean-dirs', help='Remove build directories if the configuration of their target changed')
+    clean_dirs_parser.add_argument('--target', required=True, help='Target the recipe belongs to')
+    clean_dirs_parser.add_argument('--prerequisites', default='', help='Normal prerequisites of the target, separated by spaces')
+    clean_dirs_parser.add_argument('--order-only', default='', help='Order-only prerequisites of the target, separated by spaces')
+    clean_dirs_parser.add_argument('directories', nargs=argparse.REMAINDER, help='Directories relative to the current directory')
+    clean_dirs_parser.set_defaults(handler=command_clean_dirs)
+
+    args = parser.parse_args()
+    args.handler(args)
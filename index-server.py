@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""Local package index server for builds that need the WASIX wheels from this repository.
+
+Serves the simple index that generate-index.py writes to dist/ and the packages straight from artifacts/.
+Project pages are served as PEP 691 JSON or HTML depending on the Accept header. All files support
+ETag/If-None-Match, If-Modified-Since and byte ranges, so pip and uv only transfer what changed.
+
+Use `start`, `stop` and `status` to manage a server in the background, or `serve` to run it in the foreground.
+"""
+from build_common import canonicalize_name
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import fcntl
+import json
+import mimetypes
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+state_dir = os.path.join(root_dir, '.index-server')
+state_file = os.path.join(state_dir, 'server.json')
+lock_file = os.path.join(state_dir, 'lock')
+log_file = os.path.join(state_dir, 'server.log')
+default_host = '127.0.0.1'
+default_port = int(os.getenv('INDEX_SERVER_PORT', '6931'))
+startup_timeout = 10
+
+# Representations of the simple API pages in the order the server prefers them (PEP 691)
+simple_content_types = (
+    ('application/vnd.pypi.simple.v1+json', 'index.json'),
+    ('application/vnd.pypi.simple.latest+json', 'index.json'),
+    ('application/vnd.pypi.simple.v1+html', 'index.html'),
+    ('application/vnd.pypi.simple.latest+html', 'index.html'),
+    ('text/html', 'index.html'),
+)
+
+def parse_accept(header):
+    """Parse an Accept header into a list of (media range, quality)."""
+    ranges = []
+    for part in header.split(','):
+        media_range, *params = [item.strip() for item in part.split(';')]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media_range.lower(), quality))
+    return ranges
+
+def negotiate_simple(header):
+    """Pick the content type and file of a simple API page for an Accept header, or None if nothing is acceptable."""
+    if not header:
+        return 'text/html', 'index.html'
+    accepted = parse_accept(header)
+    best = None
+    for content_type, filename in simple_content_types:
+        major = content_type.split('/')[0]
+        # The most specific matching range decides the quality
+        qualities = [quality for media_range, quality in accepted if media_range == content_type]
+        qualities = qualities or [quality for media_range, quality in accepted if media_range == f'{major}/*']
+        qualities = qualities or [quality for media_range, quality in accepted if media_range == '*/*']
+        if qualities and qualities[0] > 0 and (best is None or qualities[0] > best[0]):
+            best = (qualities[0], content_type, filename)
+    return best[1:] if best is not None else None
+
+def parse_range(header, size):
+    """Parse a single byte range. Returns (start, end) inclusive, None to serve the whole file or False if unsatisfiable."""
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        # Multiple ranges are rare, serving the whole file is always allowed
+        return None
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if start == '':
+            length = int(end)
+            if length == 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+class IndexRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'WasixIndexServer/1.0'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = [part for part in path.split('/') if part]
+        if any(part in ('.', '..') for part in parts):
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+
+        if parts[:1] == ['simple']:
+            if len(parts) > 2:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            if not path.endswith('/'):
+                self.redirect(path + '/')
+                return
+            negotiated = negotiate_simple(self.headers.get('Accept'))
+            if negotiated is None:
+                self.send_error(HTTPStatus.NOT_ACCEPTABLE)
+                return
+            content_type, filename = negotiated
+            # Clients asking for the latest version get told which version they got
+            content_type = content_type.replace('.latest+', '.v1+')
+            directory = os.path.join(self.server.dist_dir, 'simple', *map(canonicalize_name, parts[1:]))
+            self.send_file(os.path.join(directory, filename), content_type, send_body, vary='Accept')
+            return
+
+        if parts[:1] == ['packages'] and len(parts) == 2:
+            # Freshly built packages are served from artifacts/, everything else from the copy in dist/
+            artifact = os.path.join(self.server.artifact_dir, parts[1])
+            file_path = artifact if os.path.isfile(artifact) else os.path.join(self.server.dist_dir, 'packages', parts[1])
+        else:
+            file_path = os.path.join(self.server.dist_dir, *parts)
+            if os.path.isdir(file_path):
+                if not path.endswith('/'):
+                    self.redirect(path + '/')
+                    return
+                file_path = os.path.join(file_path, 'index.html')
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self.send_file(file_path, content_type, send_body)
+
+    def redirect(self, location):
+        self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_file(self, file_path, content_type, send_body, vary=None):
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-{stat.st_ino:x}"'
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+            def send_common_headers():
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                # Artifacts are rebuilt in place, so clients have to revalidate every time
+                self.send_header('Cache-Control', 'no-cache')
+                if vary is not None:
+                    self.send_header('Vary', vary)
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                send_common_headers()
+                self.end_headers()
+                return
+
+            byte_range = None
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header is not None and (if_range is None or if_range in (etag, last_modified)):
+                byte_range = parse_range(range_header, stat.st_size)
+            if byte_range is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                self.send_header('Content-Length', '0')
+                send_common_headers()
+                self.end_headers()
+                return
+
+            start, end = byte_range or (0, stat.st_size - 1)
+            self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{stat.st_size}')
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            send_common_headers()
+            self.end_headers()
+            if send_body and end >= start:
+                self.connection.sendfile(f, start, end - start + 1)
+
+class IndexServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, dist_dir, artifact_dir):
+        self.dist_dir = dist_dir
+        self.artifact_dir = artifact_dir
+        super().__init__(address, IndexRequestHandler)
+
+def read_state():
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def responds(host, port):
+    try:
+        with urllib.request.urlopen(f'http://{host}:{port}/simple/', timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+def running_server():
+    """Get the state of the background server if it is running."""
+    state = read_state()
+    if state is None or not is_alive(state['pid']) or not responds(state['host'], state['port']):
+        return None
+    return state
+
+def command_serve(args):
+    server = IndexServer((args.host, args.port), os.path.abspath(args.dist_dir), os.path.abspath(args.artifact_dir))
+    # Shut down cleanly when stopped
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Serving {args.dist_dir} and {args.artifact_dir} at http://{args.host}:{args.port}/simple", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def command_start(args):
+    os.makedirs(state_dir, exist_ok=True)
+    # Parallel builds may start the server at the same time
+    with open(lock_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = running_server()
+        if state is not None:
+            if state['port'] != args.port or state['host'] != args.host:
+                print(f"Index server is already running at http://{state['host']}:{state['port']}/simple", file=sys.stderr)
+                exit(1)
+            print(f"Index server is already running at http://{state['host']}:{state['port']}/simple")
+            return
+        with open(log_file, 'ab') as log:
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'serve', '--host', args.host, '--port', str(args.port), '--dist-dir', args.dist_dir, '--artifact-dir', args.artifact_dir],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True,
+            )
+        deadline = time.monotonic() + startup_timeout
+        while not responds(args.host, args.port):
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                print(f"Index server failed to start, see {log_file}", file=sys.stderr)
+                exit(1)
+            time.sleep(0.1)
+        with open(state_file, 'w') as f:
+            json.dump({'pid': process.pid, 'host': args.host, 'port': args.port}, f)
+        print(f"Index server started at http://{args.host}:{args.port}/simple (pid {process.pid})")
+
+def command_stop(args):
+    os.makedirs(state_dir, exist_ok=True)
+    with open(lock_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_state()
+        if state is None or not is_alive(state['pid']):
+            print("Index server is not running")
+        else:
+            os.kill(state['pid'], signal.SIGTERM)
+            deadline = time.monotonic() + startup_timeout
+            while is_alive(state['pid']) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if is_alive(state['pid']):
+                os.kill(state['pid'], signal.SIGKILL)
+            print(f"Index server stopped (pid {state['pid']})")
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+def command_status(args):
+    state = running_server()
+    if state is None:
+        print("Index server is not running")
+        exit(1)
+    print(f"Index server is running at http://{state['host']}:{state['port']}/simple (pid {state['pid']})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, handler, help in (
+        ('serve', command_serve, 'Run the server in the foreground'),
+        ('start', command_start, 'Start the server in the background, unless it is already running'),
+        ('stop', command_stop, 'Stop the background server'),
+        ('status', command_status, 'Check whether the background server is running'),
+    ):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(handler=handler)
+        if name in ('serve', 'start'):
+            subparser.add_argument('--host', default=default_host, help=f'Address to listen on (default: {default_host})')
+            subparser.add_argument('--port', type=int, default=default_port, help=f'Port to listen on (default: {default_port}, or $INDEX_SERVER_PORT)')
+            subparser.add_argument('--dist-dir', default=os.path.join(root_dir, 'dist'), help='Index generated by generate-index.py')
+            subparser.add_argument('--artifact-dir', default=os.path.join(root_dir, 'artifacts'), help='Directory the packages are served from')
+    args = parser.parse_args()
+    args.handler(args)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Share the job slots of make with build tools that are not make.
+
+The Makefile runs with -j$(JOBS) and nested makes take their job slots from the jobserver of the top-level make,
+so the whole build never runs more than JOBS jobs at once. `count` prints the default for JOBS: the number of
+cores this process may use, but not more jobs than fit in the available memory with --memory-per-job each.
+
+`run` is the adapter for tools that are no jobserver clients, or that lose the jobserver on the way because a
+process in between closes the file descriptors of make: cmake --build with ninja, cargo under maturin, bazel and
+python -m build. It takes as many free job slots from the jobserver as it can get without waiting, in addition
+to the one make gave the recipe. The command runs with that number in JOBS, CMAKE_BUILD_PARALLEL_LEVEL,
+CARGO_BUILD_JOBS and as -j in MAKEFLAGS. The slots go back to the jobserver when the command exits. The recipe
+line has to start with $(JOBSERVER), otherwise make does not pass the jobserver to it. Without a jobserver, the
+command gets as many slots as make -j would run.
+"""
+import argparse
+import os
+import re
+import signal
+import stat
+import subprocess
+import sys
+
+memory_per_job = int(os.getenv('JOB_MEMORY', '2048'))
+
+def available_memory():
+    """Memory in MiB this process can use, from /proc/meminfo and the memory limit of its cgroup."""
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            cgroup = f.readline().strip().split(':', 2)[-1]
+        with open(f'/sys/fs/cgroup{cgroup}/memory.max', 'r') as f:
+            limit = f.read().strip()
+        with open(f'/sys/fs/cgroup{cgroup}/memory.current', 'r') as f:
+            current = int(f.read().strip())
+        if limit != 'max':
+            free = (int(limit) - current) // 2**20
+            available = free if available is None else min(available, free)
+    except (OSError, ValueError):
+        pass
+    return available
+
+def job_count(memory):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    available = available_memory()
+    if available is None or memory <= 0:
+        return cores
+    return max(1, min(cores, available // memory))
+
+def open_jobserver():
+    """Connect to the jobserver in MAKEFLAGS. Returns a non-blocking file to take slots from and the fd to return them to."""
+    match = re.search(r'--jobserver-(?:auth|fds)=(\S+)', os.getenv('MAKEFLAGS', ''))
+    if match is None:
+        return None
+    auth = match.group(1)
+    try:
+        if auth.startswith('fifo:'):
+            read_fd = os.open(auth[len('fifo:'):], os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(auth[len('fifo:'):], os.O_WRONLY)
+            return read_fd, write_fd
+        read_fd, write_fd = (int(fd) for fd in auth.split(','))
+        if not stat.S_ISFIFO(os.fstat(read_fd).st_mode) or not stat.S_ISFIFO(os.fstat(write_fd).st_mode):
+            raise OSError(f'{auth} are not the pipes of a jobserver')
+        # Make waits on the same pipe, so it must stay blocking. Opening it again gives a file of our own
+        return os.open(f'/proc/self/fd/{read_fd}', os.O_RDONLY | os.O_NONBLOCK), write_fd
+    except (OSError, ValueError):
+        print("Warning: The jobserver of make is not available to this recipe line, start it with $(JOBSERVER). Running with a single job", file=sys.stderr)
+        return None
+
+def inherit_jobserver():
+    """MAKEFLAGS for a nested make that shares the jobserver of the make running this recipe line.
+
+    Make only passes its pipes to recipe lines that start with $(JOBSERVER), but it keeps them open. They are
+    opened again through /proc from the closest ancestor that has them. Returns None if there is no jobserver.
+    """
+    makeflags = os.getenv('MAKEFLAGS', '')
+    match = re.search(r'--jobserver-(?:auth|fds)=(\d+),(\d+)', makeflags)
+    if match is None:
+        return makeflags if '--jobserver-auth=fifo:' in makeflags else None
+    read_fd, write_fd = int(match.group(1)), int(match.group(2))
+    pid = os.getpid()
+    while pid > 1:
+        try:
+            read_info = os.stat(f'/proc/{pid}/fd/{read_fd}')
+            write_info = os.stat(f'/proc/{pid}/fd/{write_fd}')
+            if stat.S_ISFIFO(read_info.st_mode) and read_info.st_ino == write_info.st_ino:
+                reader = os.open(f'/proc/{pid}/fd/{read_fd}', os.O_RDONLY)
+                writer = os.open(f'/proc/{pid}/fd/{write_fd}', os.O_WRONLY)
+                os.set_inheritable(reader, True)
+                os.set_inheritable(writer, True)
+                return makeflags[:match.start()] + f'--jobserver-auth={reader},{writer}' + makeflags[match.end():]
+        except OSError:
+            pass
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                pid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            break
+    return None
+
+def take_slots(read_fd, limit):
+    """Take free job slots from the jobserver without waiting. Returns the tokens to give back."""
+    tokens = b''
+    while len(tokens) < limit:
+        try:
+            token = os.read(read_fd, 1)
+        except BlockingIOError:
+            break
+        if not token:
+            break
+        tokens += token
+    return tokens
+
+def command_count(args):
+    print(job_count(args.memory_per_job))
+
+def command_run(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No command given", file=sys.stderr)
+        exit(1)
+    makeflags = os.getenv('MAKEFLAGS', '')
+    # The size of the pool of the jobserver
+    pool = re.search(r'(?:^|\s)-j(\d+)', makeflags)
+    limit = args.jobs or (int(pool.group(1)) if pool is not None else job_count(args.memory_per_job))
+    jobserver = open_jobserver()
+    tokens = b''
+    if jobserver is not None:
+        tokens = take_slots(jobserver[0], limit - 1)
+        jobs = len(tokens) + 1
+    elif re.search(r'--jobserver-(auth|fds)=', makeflags):
+        # Make runs other jobs next to this one, only the slot of the recipe is certainly free
+        jobs = 1
+    else:
+        jobs = limit
+
+    # Nested makes get the slots of this command as -j instead of the jobserver, they could not use it anyway
+    words = re.sub(r'\s*(--jobserver-(auth|fds)=\S+|(?<!\S)-j\d*)', '', makeflags).split()
+    # The first word holds the single letter flags, like s for -s
+    flags = words[:1] if words and not words[0].startswith('-') else []
+    env = {
+        **os.environ,
+        'JOBS': str(jobs),
+        'CMAKE_BUILD_PARALLEL_LEVEL': str(jobs),
+        'CARGO_BUILD_JOBS': str(jobs),
+        'MAKEFLAGS': ' '.join(flags + [f'-j{jobs}'] + words[len(flags):]),
+    }
+    try:
+        process = subprocess.Popen(command, env=env)
+        signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        exit_code = process.wait()
+    finally:
+        if tokens:
+            os.write(jobserver[1], tokens)
+    exit(128 - exit_code if exit_code < 0 else exit_code)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--memory-per-job', type=int, default=memory_per_job, help=f'Memory in MiB one job may need (default: {memory_per_job}, or $JOB_MEMORY)')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    count_parser = subparsers.add_parser('count', help='Print the number of jobs the cores and the memory allow')
+    count_parser.set_defaults(handler=command_count)
+
+    run_parser = subparsers.add_parser('run', help='Run a command with the job slots it can get from the jobserver')
+    run_parser.add_argument('--jobs', type=int, help='Most job slots the command may use (default: the -j of make, or the job count)')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER)
+    run_parser.set_defaults(handler=command_run)
+
+    args = parser.parse_args()
+    args.handler(args)
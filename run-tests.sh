@@ -1,20 +1,213 @@
-output_file=$(mktemp)
+#!/usr/bin/env bash
+#
+# Run the tests in tests/ with wasmer.
+#
+# Usage: run-tests.sh [PYTHON_PACKAGE] [TEST_FILE...]
+#
+# Tests named *-broken.py are expected to fail and tests named *.skip.py are not run.
+# Tests run in parallel, each with a wall-clock timeout. Results are written to $TEST_RESULTS_DIR
+# as results.json and junit.xml, with the output of every test in logs/.
+#
+# TEST_JOBS: Number of tests to run in parallel (default: number of cores)
+# TEST_TIMEOUT: Seconds after which a test is killed and counted as failed (default: 600)
+# TEST_RESULTS_DIR: Where to write the results (default: test-results)
+# WASMER_CACHE_DIR: Wasmer module cache, prefilled by `make python-with-packages.aot` (default: .wasmer-cache)
+# TEST_HISTORY: Database that the durations, CPU time and peak RSS of every run are added to (default: test-history.sqlite)
+# TEST_SELECT: Set to "changed" to only run the tests affected by artifacts that changed since they last ran,
+#   see test-selection.py. Ignored if test files are given (default: all)
+# TEST_BATCH: Set to 1 to run the unittest based tests in batches, one python process per worker (default: 0)
+#
+# In batch mode test files marked with `# test-isolation: process` and tests not using unittest still get
+# a process of their own. See batch-tests.py.
 
 PYTHON_PACKAGE=${1:-"python-with-packages"}
+shift
+TEST_FILES=( "$@" )
+SCRIPT_DIR=$(dirname "$0")
+if test ${#TEST_FILES[@]} -eq 0 && test "$TEST_SELECT" = "changed"; then
+    TEST_FILES=( $(python3 "$SCRIPT_DIR/test-selection.py" select --verbose --package "$PYTHON_PACKAGE") )
+    if test ${#TEST_FILES[@]} -eq 0; then
+        echo "No tests are affected by changes since they last ran"
+        exit 0
+    fi
+elif test ${#TEST_FILES[@]} -eq 0; then
+    TEST_FILES=( tests/*.py )
+fi
 
-# Set if a test that was not expected to fail did fail
-WORKING_FAILED=()
-BROKEN_FAILED=()
-WORKING_PASSED=()
-BROKEN_PASSED=()
-SKIPPED=()
+TEST_JOBS=${TEST_JOBS:-$(nproc)}
+TEST_TIMEOUT=${TEST_TIMEOUT:-600}
+TEST_RESULTS_DIR=${TEST_RESULTS_DIR:-test-results}
+TEST_BATCH=${TEST_BATCH:-0}
+export WASMER_CACHE_DIR=${WASMER_CACHE_DIR:-$(pwd)/.wasmer-cache}
+export TEST_HISTORY=${TEST_HISTORY:-$(pwd)/test-history.sqlite}
 
 GREEN="\033[0;32m"
 RED="\033[0;31m"
 YELLOW="\033[0;33m"
 RESET="\033[0m"
 
-for testfile in tests/*.py; do
+# Results of the previous run are used to start the slowest tests first
+PREVIOUS_RESULTS=$(mktemp)
+if test -f "$TEST_RESULTS_DIR/results.tsv"; then
+    cp "$TEST_RESULTS_DIR/results.tsv" "$PREVIOUS_RESULTS"
+fi
+rm -rf "$TEST_RESULTS_DIR"
+mkdir -p "$TEST_RESULTS_DIR/logs" "$TEST_RESULTS_DIR/results" "$TEST_RESULTS_DIR/batches" "$TEST_RESULTS_DIR/usage"
+OUTPUT_LOCK="$TEST_RESULTS_DIR/.output.lock"
+
+function now {
+    date +%s.%N
+}
+
+function elapsed_since {
+    awk -v start="$1" -v end="$(now)" 'BEGIN { printf "%.3f", end - start }'
+}
+
+function expectation {
+    if [[ "$1" == *-broken.py ]]; then
+        echo "fail"
+    else
+        echo "pass"
+    fi
+}
+
+# Record name, expectation, status, exit code, duration, start time, CPU time and peak RSS of a test in results/<name>.tsv and print its output
+function record_result {
+    local TEST_NAME="$1"
+    local EXIT_CODE="$2"
+    local DURATION="$3"
+    local START="$4"
+    local CPU_TIME="${5:--}"
+    local MAX_RSS="${6:--}"
+    local LOG_FILE="$TEST_RESULTS_DIR/logs/$TEST_NAME.log"
+    local EXPECT=$(expectation "$TEST_NAME")
+
+    local STATUS="passed"
+    # timeout exits with 124, or 137 if the test had to be killed
+    if [ $EXIT_CODE -eq 124 ] || { [ $EXIT_CODE -eq 137 ] && [ "${DURATION%.*}" -ge "$TEST_TIMEOUT" ]; }; then
+        STATUS="timeout"
+    elif [ $EXIT_CODE -ne 0 ]; then
+        STATUS="failed"
+    fi
+
+    # Prepare output color. This will be changed depending on what we expect for the test
+    local COLOR
+    if [ "$STATUS" = "passed" ]; then
+        COLOR="$GREEN"
+        test "$EXPECT" = "fail" && COLOR="$RED"
+    else
+        COLOR="$RED"
+        test "$EXPECT" = "fail" && COLOR="$YELLOW"
+    fi
+
+    printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' "$TEST_NAME" "$EXPECT" "$STATUS" "$EXIT_CODE" "$DURATION" "$START" "$CPU_TIME" "$MAX_RSS" > "$TEST_RESULTS_DIR/results/$TEST_NAME.tsv"
+
+    # Print the output of a test in one piece, so parallel tests don't interleave
+    {
+        flock 9
+        echo -e "\033[0;34m▶ Finished:${RESET} \033[1m$TEST_NAME${RESET} (${DURATION%.*}s)"
+        cat "$LOG_FILE"
+        if [ "$STATUS" = "passed" ]; then
+            echo -e "  ${COLOR}✓ PASSED${RESET} $TEST_NAME"
+        else
+            echo -e "  ${COLOR}✗ FAILED${RESET} $TEST_NAME"
+            if [ "$STATUS" = "timeout" ]; then
+                echo -e "  ${COLOR}└── Test timed out after ${TEST_TIMEOUT}s${RESET}"
+            else
+                echo -e "  ${COLOR}└── Test failed with exit code $EXIT_CODE${RESET}"
+            fi
+        fi
+        echo ""
+    } 9>"$OUTPUT_LOCK"
+}
+
+# Run a single test in its own process, measuring the CPU time and peak RSS of wasmer
+function run_test {
+    local testfile="$1"
+    local TEST_NAME=$(basename "$testfile")
+    local USAGE_FILE="$TEST_RESULTS_DIR/usage/$TEST_NAME.tsv"
+
+    local START=$(now)
+    python3 "$SCRIPT_DIR/test-history.py" measure --output "$USAGE_FILE" -- \
+        timeout --kill-after=10 "$TEST_TIMEOUT" $WASMER run --net --mapdir="/src:$(pwd)" --llvm $PYTHON_PACKAGE /src/$testfile >"$TEST_RESULTS_DIR/logs/$TEST_NAME.log" 2>&1 </dev/null
+    local EXIT_CODE=$?
+    local DURATION=$(elapsed_since "$START")
+    local CPU_TIME MAX_RSS
+    IFS=$'\t' read -r CPU_TIME MAX_RSS < "$USAGE_FILE"
+    record_result "$TEST_NAME" "$EXIT_CODE" "$DURATION" "$START" "$CPU_TIME" "$MAX_RSS"
+}
+
+# Run several tests in one python process with batch-tests.py. Tests after one that crashed or hung the batch run in their own process.
+# CPU time and peak RSS are only known for the whole process, so they are not recorded for batched tests
+function run_batch {
+    local BATCH="$1"
+    shift
+    local PROGRESS="$TEST_RESULTS_DIR/batches/$BATCH.tsv"
+    local RESULTS_DIR=$(realpath "$TEST_RESULTS_DIR")
+    local BATCH_FILES=()
+    for testfile in "$@"; do
+        BATCH_FILES+=( "/src/$testfile" )
+    done
+
+    # The batch as a whole can take as long as all of its tests, batch-tests.py enforces the timeout of each test
+    timeout --kill-after=10 "$(( TEST_TIMEOUT * $# + 60 ))" $WASMER run --net --mapdir="/src:$(pwd)" --mapdir="/results:$RESULTS_DIR" --llvm $PYTHON_PACKAGE \
+        /src/batch-tests.py --results "/results/batches/$BATCH.tsv" --logs /results/logs --timeout "$TEST_TIMEOUT" "${BATCH_FILES[@]}" \
+        >"$TEST_RESULTS_DIR/logs/batch-$BATCH.log" 2>&1 </dev/null
+    touch "$PROGRESS"
+
+    local EVENT TEST_NAME VALUE DURATION START=""
+    local DONE=()
+    while IFS=$'\t' read -r EVENT TEST_NAME VALUE DURATION; do
+        if [ "$EVENT" = "start" ]; then
+            START="$VALUE"
+        else
+            record_result "$TEST_NAME" "$VALUE" "$DURATION" "$START"
+            DONE+=( "$TEST_NAME" )
+            START=""
+        fi
+    done < "$PROGRESS"
+
+    # A test that started but did not finish either hung until batch-tests.py killed the batch, or crashed it
+    if [ -n "$START" ]; then
+        local UNFINISHED=$(tail -n 1 "$PROGRESS" | cut -f 2)
+        local DURATION=$(elapsed_since "$START")
+        if [ "${DURATION%.*}" -ge "$TEST_TIMEOUT" ]; then
+            record_result "$UNFINISHED" 124 "$DURATION" "$START"
+            DONE+=( "$UNFINISHED" )
+        fi
+    fi
+    for testfile in "$@"; do
+        if [[ ! " ${DONE[*]} " == *" $(basename "$testfile") "* ]]; then
+            run_test "$testfile"
+        fi
+    done
+}
+
+# Order the tests by their previous duration, slowest first. New tests go first, as they may be slow
+SCHEDULE=()
+DURATIONS=()
+while IFS=$'\t' read -r DURATION testfile; do
+    SCHEDULE+=( "$testfile" )
+    DURATIONS+=( "${DURATION%.*}" )
+done < <(
+    for testfile in "${TEST_FILES[@]}"; do
+        DURATION=$(awk -F '\t' -v name="$(basename "$testfile")" '$1 == name { print $5 }' "$PREVIOUS_RESULTS")
+        printf '%s\t%s\n' "${DURATION:-999999}" "$testfile"
+    done | sort -t $'\t' -k1,1 -g -r -s
+)
+rm -f "$PREVIOUS_RESULTS"
+
+# Tests that can share a python process with other tests in batch mode
+function batchable {
+    test "$TEST_BATCH" = "1" && grep -q 'unittest' "$1" && ! grep -qF '# test-isolation: process' "$1"
+}
+
+SKIPPED=()
+PROCESS_TESTS=()
+BATCH_TESTS=()
+BATCH_DURATIONS=()
+for i in "${!SCHEDULE[@]}"; do
+    testfile="${SCHEDULE[$i]}"
     # Extract just the filename without path
     TEST_NAME=$(basename "$testfile")
 
@@ -22,46 +215,85 @@ for testfile in tests/*.py; do
     if [[ "$TEST_NAME" == *.skip.py ]]; then
         echo -e "${YELLOW}Skipping:${RESET} \033[1m$TEST_NAME${RESET}"
         SKIPPED+=( "$TEST_NAME" )
-        continue
-    fi
-
-    EXPECT_BROKEN=false
-    if [[ "$TEST_NAME" == *-broken.py ]]; then
-        EXPECT_BROKEN=true
+    elif batchable "$testfile"; then
+        BATCH_TESTS+=( "$testfile" )
+        BATCH_DURATIONS+=( "${DURATIONS[$i]}" )
+    else
+        PROCESS_TESTS+=( "$testfile" )
     fi
-    
-    # Print colorful running message
-    echo -e "\033[0;34m▶ Running:${RESET} \033[1m$TEST_NAME${RESET}"
-    
-    # Run the test
-    $WASMER run --net --mapdir="/src:$(pwd)" --llvm $PYTHON_PACKAGE /src/$testfile
-    EXIT_CODE=$?
+done
 
-    # Prepare output color. This will be changed depending on what we expect for the test
-    COLOR="$GREEN"
-    # Log result and prepare colorful outcome for later
-    if [ $EXIT_CODE -eq 0 ]; then
-        if $EXPECT_BROKEN; then
-            COLOR="${RED}"
-            BROKEN_PASSED+=( "$TEST_NAME" )
-        else
-            COLOR="${GREEN}"
-            WORKING_PASSED+=( "$TEST_NAME" )
+# Spread the batchable tests over one batch per worker, always adding the next slowest test to the shortest batch
+BATCHES=()
+BATCH_TOTALS=()
+BATCH_COUNT=$(( ${#BATCH_TESTS[@]} < TEST_JOBS ? ${#BATCH_TESTS[@]} : TEST_JOBS ))
+for (( i = 0; i < BATCH_COUNT; i++ )); do
+    BATCHES+=( "" )
+    BATCH_TOTALS+=( 0 )
+done
+for i in "${!BATCH_TESTS[@]}"; do
+    SHORTEST=0
+    for j in "${!BATCHES[@]}"; do
+        if [ "${BATCH_TOTALS[$j]}" -lt "${BATCH_TOTALS[$SHORTEST]}" ]; then
+            SHORTEST=$j
         fi
-        echo -e "  ${COLOR}✓ PASSED${RESET} $TEST_NAME" | tee -a "$output_file"
+    done
+    BATCHES[$SHORTEST]+=" ${BATCH_TESTS[$i]}"
+    BATCH_TOTALS[$SHORTEST]=$(( BATCH_TOTALS[SHORTEST] + BATCH_DURATIONS[i] ))
+done
+
+function wait_for_worker {
+    while [ "$(jobs -rp | wc -l)" -ge "$TEST_JOBS" ]; do
+        wait -n
+    done
+}
+
+SUITE_START=$(now)
+for i in "${!BATCHES[@]}"; do
+    wait_for_worker
+    echo -e "\033[0;34m▶ Running batch $i:${RESET}$(for testfile in ${BATCHES[$i]}; do echo -n " $(basename "$testfile")"; done)"
+    run_batch "$i" ${BATCHES[$i]} &
+done
+for testfile in "${PROCESS_TESTS[@]}"; do
+    wait_for_worker
+    echo -e "\033[0;34m▶ Running:${RESET} \033[1m$(basename "$testfile")${RESET}"
+    run_test "$testfile" &
+done
+wait
+SUITE_DURATION=$(elapsed_since "$SUITE_START")
+
+for TEST_NAME in "${SKIPPED[@]}"; do
+    printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' "$TEST_NAME" "skip" "skipped" "-" "0" "-" "-" "-" > "$TEST_RESULTS_DIR/results/$TEST_NAME.tsv"
+done
+# Missing values are "-" instead of empty, so read does not collapse the fields
+cat "$TEST_RESULTS_DIR"/results/*.tsv 2>/dev/null | sort > "$TEST_RESULTS_DIR/results.tsv"
+rm -rf "$TEST_RESULTS_DIR/results" "$TEST_RESULTS_DIR/batches" "$TEST_RESULTS_DIR/usage" "$OUTPUT_LOCK"
+
+# Set if a test that was not expected to fail did fail
+WORKING_FAILED=()
+BROKEN_FAILED=()
+WORKING_PASSED=()
+BROKEN_PASSED=()
+output_file=$(mktemp)
+while IFS=$'\t' read -r TEST_NAME EXPECT STATUS EXIT_CODE DURATION START CPU_TIME MAX_RSS; do
+    case "$EXPECT:$STATUS" in
+        skip:*) continue ;;
+        pass:passed) WORKING_PASSED+=( "$TEST_NAME" ) ; COLOR="$GREEN" ;;
+        fail:passed) BROKEN_PASSED+=( "$TEST_NAME" ) ; COLOR="$RED" ;;
+        pass:*) WORKING_FAILED+=( "$TEST_NAME" ) ; COLOR="$RED" ;;
+        fail:*) BROKEN_FAILED+=( "$TEST_NAME" ) ; COLOR="$YELLOW" ;;
+    esac
+    if [ "$STATUS" = "passed" ]; then
+        echo -e "  ${COLOR}✓ PASSED${RESET} $TEST_NAME" >> "$output_file"
     else
-        if $EXPECT_BROKEN; then
-            COLOR="${YELLOW}"
-            BROKEN_FAILED+=( "$TEST_NAME" )
+        echo -e "  ${COLOR}✗ FAILED${RESET} $TEST_NAME" >> "$output_file"
+        if [ "$STATUS" = "timeout" ]; then
+            echo -e "  ${COLOR}└── Test timed out after ${TEST_TIMEOUT}s${RESET}" >> "$output_file"
         else
-            COLOR="${RED}"
-            WORKING_FAILED+=( "$TEST_NAME" )
+            echo -e "  ${COLOR}└── Test failed with exit code $EXIT_CODE${RESET}" >> "$output_file"
         fi
-        echo -e "  ${COLOR}✗ FAILED${RESET} $TEST_NAME" | tee -a "$output_file"
-        echo -e "  ${COLOR}└── Test failed with exit code $EXIT_CODE${RESET}" | tee -a "$output_file"
     fi
-    echo ""
-done
+done < "$TEST_RESULTS_DIR/results.tsv"
 
 # Check if all broken tests failed and all working tests passed
 EXPECTED_OUTCOME=false
@@ -73,11 +305,71 @@ BROKEN_TESTS=( ${BROKEN_FAILED[@]} ${BROKEN_PASSED[@]} )
 WORKING_TESTS=( ${WORKING_FAILED[@]} ${WORKING_PASSED[@]} )
 ALL_TESTS=( ${WORKING_FAILED[@]} ${WORKING_PASSED[@]} ${BROKEN_FAILED[@]} ${BROKEN_PASSED[@]} ${SKIPPED[@]} )
 
+function json_string {
+    local value="${1//\\/\\\\}"
+    value="${value//\"/\\\"}"
+    printf '"%s"' "$value"
+}
+
+function xml_escape {
+    sed -e 's/&/\&amp;/g' -e 's/</\&lt;/g' -e 's/>/\&gt;/g' -e 's/"/\&quot;/g' | tr -d '\000-\010\013\014\016-\037'
+}
+
+# Write machine readable results
+{
+    printf '{"package":%s,"time":%s,"jobs":%s,"batch":%s,"timeout":%s,"duration":%s,"expected_outcome":%s,"tests":[' \
+        "$(json_string "$PYTHON_PACKAGE")" "$SUITE_START" "$TEST_JOBS" "$(test "$TEST_BATCH" = "1" && echo true || echo false)" "$TEST_TIMEOUT" "$SUITE_DURATION" "$EXPECTED_OUTCOME"
+    SEPARATOR=""
+    while IFS=$'\t' read -r TEST_NAME EXPECT STATUS EXIT_CODE DURATION START CPU_TIME MAX_RSS; do
+        printf '%s{"name":%s,"expected":%s,"status":%s,"exit_code":%s,"duration":%s,"start":%s,"cpu_time":%s,"max_rss":%s,"log":%s}' "$SEPARATOR" \
+            "$(json_string "$TEST_NAME")" "$(json_string "$EXPECT")" "$(json_string "$STATUS")" "${EXIT_CODE/#-/null}" "$DURATION" "${START/#-/null}" "${CPU_TIME/#-/null}" "${MAX_RSS/#-/null}" \
+            "$(test "$STATUS" = "skipped" && echo null || json_string "logs/$TEST_NAME.log")"
+        SEPARATOR=","
+    done < "$TEST_RESULTS_DIR/results.tsv"
+    printf ']}\n'
+} > "$TEST_RESULTS_DIR/results.json"
+
+{
+    echo '<?xml version="1.0" encoding="UTF-8"?>'
+    echo "<testsuites tests=\"${#ALL_TESTS[@]}\" failures=\"$(( ${#WORKING_FAILED[@]} + ${#BROKEN_PASSED[@]} ))\" time=\"$SUITE_DURATION\">"
+    echo "<testsuite name=\"$(echo "$PYTHON_PACKAGE" | xml_escape)\" tests=\"${#ALL_TESTS[@]}\" failures=\"$(( ${#WORKING_FAILED[@]} + ${#BROKEN_PASSED[@]} ))\" skipped=\"$(( ${#SKIPPED[@]} + ${#BROKEN_FAILED[@]} ))\" time=\"$SUITE_DURATION\">"
+    while IFS=$'\t' read -r TEST_NAME EXPECT STATUS EXIT_CODE DURATION START CPU_TIME MAX_RSS; do
+        echo "  <testcase classname=\"tests\" name=\"$TEST_NAME\" time=\"$DURATION\">"
+        case "$EXPECT:$STATUS" in
+            skip:*) echo "    <skipped message=\"Marked as skipped\"/>" ;;
+            pass:passed) ;;
+            fail:passed) echo "    <failure message=\"Marked as broken but passed\"/>" ;;
+            fail:*) echo "    <skipped message=\"Marked as broken and failed as expected\"/>" ;;
+            pass:timeout) echo "    <failure message=\"Timed out after ${TEST_TIMEOUT}s\"/>" ;;
+            pass:*) echo "    <failure message=\"Failed with exit code $EXIT_CODE\"/>" ;;
+        esac
+        if [ "$EXPECT:$STATUS" != "pass:passed" ] && [ "$STATUS" != "skipped" ]; then
+            echo "    <system-out>$(xml_escape < "$TEST_RESULTS_DIR/logs/$TEST_NAME.log")</system-out>"
+        fi
+        echo "  </testcase>"
+    done < "$TEST_RESULTS_DIR/results.tsv"
+    echo "</testsuite>"
+    echo "</testsuites>"
+} > "$TEST_RESULTS_DIR/junit.xml"
+
+# Split the durations into compile and execution time, if the module cache was prefilled
+if test -f "$WASMER_CACHE_DIR/aot-manifest.json"; then
+    python3 "$SCRIPT_DIR/aot-cache.py" report "$TEST_RESULTS_DIR"
+    echo ""
+fi
+
+# Add the run to the history and compare it against the previous runs
+python3 "$SCRIPT_DIR/test-history.py" record "$TEST_RESULTS_DIR"
+python3 "$SCRIPT_DIR/test-selection.py" record --package "$PYTHON_PACKAGE"
+python3 "$SCRIPT_DIR/test-history.py" report --package "$PYTHON_PACKAGE"
+echo ""
 
 # Print summary
 cat "$output_file"
+rm -f "$output_file"
 echo ""
 echo -e "\033[1;34mSummary:\033[0m"
+echo -e "  Ran ${#WORKING_TESTS[@]} working and ${#BROKEN_TESTS[@]} broken tests with $TEST_JOBS workers in ${SUITE_DURATION%.*}s. Results are in $TEST_RESULTS_DIR/"
 if $EXPECTED_OUTCOME; then
     echo -e "  \033[0;32mAll tests behaved as expected!\033[0m"
 else
@@ -93,14 +385,13 @@ fi
 if test ${#BROKEN_FAILED[@]} -gt 0; then
     echo -e "  ${YELLOW}However ${#BROKEN_TESTS[@]} are marked broken. ${RESET}\033[4;5mGo fix the underlying issues.${RESET}"
 fi
-if test ${#BROKEN_WORKING[@]} -gt 0; then
+if test ${#BROKEN_PASSED[@]} -gt 0; then
     echo -e "  ${RED}The following tests were marked broken but passed.${RESET}"
     echo -e "  ${RED}Go mark them as not broken 🎉:${RESET}"
-    for test in "${BROKEN_WORKING[@]}"; do
+    for test in "${BROKEN_PASSED[@]}"; do
         echo -e "    $YELLOW$test$RESET"
     done
 fi
 
 # Exit with the correct code
 $EXPECTED_OUTCOME
-
@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'build-telemetry.py')
+
+
+def entry(target, prerequisites, start, end):
+    return {
+        'run': '1', 'target': target, 'prerequisites': prerequisites, 'start': start, 'end': end,
+        'cpu': end - start, 'rss': 1024, 'exit': 0, 'cache': None,
+    }
+
+
+class TestReport(unittest.TestCase):
+    def report(self, entries):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as log:
+            log.writelines(json.dumps(item) + '\n' for item in entries)
+            log.flush()
+            result = subprocess.run([sys.executable, script, '--log', log.name, 'report', '--json'], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout)
+
+    def test_critical_path(self):
+        report = self.report([
+            entry('pkgs/a.lib', [], 0, 10),
+            entry('pkgs/c.lib', [], 0, 2),
+            entry('pkgs/b.lib', ['pkgs/a.lib', 'pkgs/c.lib'], 10, 15),
+        ])
+        self.assertEqual(report['critical_path'], ['pkgs/a.lib', 'pkgs/b.lib'])
+
+    def test_prerequisites_logged_after_their_dependent(self):
+        report = self.report([
+            entry('pkgs/b.lib', ['pkgs/a.lib', 'pkgs/c.lib'], 10, 15),
+            entry('pkgs/a.lib', [], 0, 10),
+            entry('pkgs/c.lib', [], 0, 2),
+        ])
+        self.assertEqual(report['critical_path'], ['pkgs/a.lib', 'pkgs/b.lib'])
+
+    def test_shorter_first_prerequisite(self):
+        report = self.report([
+            entry('pkgs/b.lib', ['pkgs/c.lib', 'pkgs/a.lib'], 10, 15),
+            entry('pkgs/c.lib', [], 0, 2),
+            entry('pkgs/a.lib', [], 0, 10),
+        ])
+        self.assertEqual(report['critical_path'], ['pkgs/a.lib', 'pkgs/b.lib'])
+
+
+if __name__ == '__main__':
+    unittest.main()
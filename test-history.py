@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""History of test durations and resource usage, to catch performance regressions in rebuilt packages.
+
+`measure` runs a command and writes the CPU time and peak RSS of it and everything it waited for. run-tests.sh
+wraps every wasmer process with it.
+
+`record` appends the results of a run-tests.sh run to the history database: wall time, CPU time and peak RSS
+of every test, together with the commit it was built from.
+
+`report` compares a run against a rolling baseline of the previous runs in which the same test passed. By default
+the tests of a package, e.g. pandas-test.py, are compared together: their wall and CPU times are added up and their
+peak RSS is the largest of them, in the current run as well as in every previous run they all passed in. A package or
+test counts as slower if it is slower than the baseline by more than the threshold and by more than three robust
+standard deviations (1.4826 * median absolute deviation) of the baseline, so tests that are noisy anyway are not flagged.
+"""
+from build_common import test_stem
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+history_file = os.getenv('TEST_HISTORY', 'test-history.sqlite')
+
+# Columns of the results table that can be compared, with their unit
+metrics = {
+    'wall': 's',
+    'cpu': 's',
+    'rss': 'MiB',
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    package TEXT NOT NULL,
+    commit_hash TEXT,
+    jobs INTEGER,
+    batch INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    test TEXT NOT NULL,
+    status TEXT NOT NULL,
+    wall REAL,
+    cpu REAL,
+    rss REAL,
+    PRIMARY KEY (run, test)
+);
+CREATE INDEX IF NOT EXISTS results_test ON results (test, status);
+"""
+
+def git_commit():
+    """Commit of the build scripts, with a + if the worktree or a submodule has changes."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True).stdout.decode('utf-8').strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+class History:
+    def __init__(self, path=history_file):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.db.commit()
+        self.db.close()
+
+    def record(self, results, commit):
+        cursor = self.db.execute(
+            'INSERT INTO runs (time, package, commit_hash, jobs, batch) VALUES (?, ?, ?, ?, ?)',
+            (results.get('time', time.time()), results['package'], commit, results.get('jobs'), int(bool(results.get('batch')))),
+        )
+        rows = []
+        for test in results['tests']:
+            if test['status'] == 'skipped':
+                continue
+            rss = test.get('max_rss')
+            rows.append((cursor.lastrowid, test['name'], test['status'], test['duration'], test.get('cpu_time'), None if rss is None else rss / 1024))
+        self.db.executemany('INSERT INTO results (run, test, status, wall, cpu, rss) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return cursor.lastrowid
+
+    def latest_run(self, package):
+        return self.db.execute('SELECT * FROM runs WHERE package = ? ORDER BY id DESC LIMIT 1', (package,)).fetchone()
+
+    def results(self, run):
+        return self.db.execute('SELECT * FROM results WHERE run = ? ORDER BY test', (run,)).fetchall()
+
+    def baseline(self, run, test, window, metric):
+        """Values of a metric by run, in the last runs before a run in which a test passed.
+
+        Batched and unbatched runs are not compared, as sharing a process changes the duration of every test."""
+        rows = self.db.execute(
+            f'SELECT results.run AS run, results.{metric} AS value FROM results JOIN runs ON runs.id = results.run '
+            f'WHERE runs.package = ? AND runs.batch = ? AND results.test = ? AND results.run < ? AND results.status = ? AND results.{metric} IS NOT NULL '
+            'ORDER BY results.run DESC LIMIT ?',
+            (run['package'], run['batch'], test, run['id'], 'passed', window),
+        ).fetchall()
+        return {row['run']: row['value'] for row in rows}
+
+    def prune(self, keep):
+        self.db.execute('DELETE FROM runs WHERE id NOT IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?)', (keep,))
+
+def compare(value, baseline, threshold):
+    """Compare a value against a baseline. Returns the relative change and whether it is a significant slowdown."""
+    median = statistics.median(baseline)
+    if median <= 0:
+        return 0, False
+    sigma = 1.4826 * statistics.median(abs(sample - median) for sample in baseline)
+    change = (value - median) / median
+    return change, change > threshold and value - median > 3 * sigma
+
+def command_measure(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No command given", file=sys.stderr)
+        exit(1)
+    process = subprocess.Popen(command)
+    # Forward termination to the command. Ctrl-C reaches it anyway, as it is in the same process group
+    signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _, status, usage = os.wait4(process.pid, 0)
+    # Includes the children the command waited for, like wasmer below timeout. ru_maxrss is in KiB on linux
+    with open(args.output, 'w') as f:
+        f.write(f'{usage.ru_utime + usage.ru_stime:.3f}\t{usage.ru_maxrss}\n')
+    exit_code = os.waitstatus_to_exitcode(status)
+    exit(128 - exit_code if exit_code < 0 else exit_code)
+
+def command_record(history, args):
+    with open(os.path.join(args.results, 'results.json'), 'r') as f:
+        results = json.load(f)
+    run = history.record(results, git_commit())
+    if args.keep:
+        history.prune(args.keep)
+    print(f"Recorded run {run} with {len(results['tests'])} tests in {history.path}")
+
+def command_report(history, args):
+    run = history.latest_run(args.package) if args.run is None else history.db.execute('SELECT * FROM runs WHERE id = ?', (args.run,)).fetchone()
+    if run is None:
+        print(f"No recorded runs of {args.package}", file=sys.stderr)
+        exit(1)
+
+    # The values of every package or test, now and in the previous runs, by metric
+    measured = {}
+    for result in history.results(run['id']):
+        if result['status'] != 'passed':
+            continue
+        name = test_stem(result['test']) if args.by == 'package' else result['test']
+        for metric in args.metric or metrics:
+            value = result[metric]
+            if value is None:
+                continue
+            baseline = history.baseline(run, result['test'], args.window, metric)
+            if len(baseline) < args.min_runs:
+                continue
+            combine = max if metric == 'rss' else sum
+            if (name, metric) not in measured:
+                measured[name, metric] = (value, baseline)
+                continue
+            # Only the runs in which every test of the package passed can be compared
+            previous_value, previous_baseline = measured[name, metric]
+            measured[name, metric] = (
+                combine([previous_value, value]),
+                {run_id: combine([previous_baseline[run_id], baseline[run_id]]) for run_id in previous_baseline if run_id in baseline},
+            )
+
+    regressions = []
+    rows = []
+    for (name, metric), (value, baseline) in sorted(measured.items()):
+        if len(baseline) < args.min_runs:
+            continue
+        change, slower = compare(value, list(baseline.values()), args.threshold)
+        rows.append((name, metric, value, statistics.median(baseline.values()), change, slower))
+        if slower:
+            regressions.append(rows[-1])
+
+    if args.all:
+        shown = sorted(rows, key=lambda row: row[4], reverse=True)
+    else:
+        shown = sorted(regressions, key=lambda row: row[4], reverse=True)
+    if shown:
+        print(f"{args.by:<48} {'metric':<6} {'now':>10} {'baseline':>10} {'change':>8}")
+        for name, metric, value, median, change, slower in shown:
+            unit = metrics[metric]
+            print(f"{name:<48} {metric:<6} {value:>6.2f} {unit:<3} {median:>6.2f} {unit:<3} {change:>+8.0%}{' !' if slower else ''}")
+    compared = len({row[0] for row in rows})
+    print(f"Compared {compared} {args.by}s of run {run['id']} ({run['commit_hash'] or 'unknown commit'}) against up to {args.window} previous runs")
+    if regressions:
+        print(f"{len(regressions)} significant slowdowns of more than {args.threshold:.0%}")
+        if args.fail:
+            exit(1)
+    else:
+        print("No significant slowdowns")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', default=history_file, help=f'Path to the history database (default: {history_file}, or $TEST_HISTORY)')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    measure_parser = subparsers.add_parser('measure', help='Run a command and write its CPU time and peak RSS to a file')
+    measure_parser.add_argument('--output', required=True, help='File to write the CPU seconds and peak RSS in KiB to, tab separated')
+    measure_parser.add_argument('command', nargs=argparse.REMAINDER)
+    measure_parser.set_defaults(handler=command_measure)
+
+    record_parser = subparsers.add_parser('record', help='Add the results of a run-tests.sh run to the history')
+    record_parser.add_argument('results', nargs='?', default='test-results', help='Results directory of run-tests.sh (default: test-results)')
+    record_parser.add_argument('--keep', type=int, default=200, help='Number of runs to keep, 0 keeps all (default: 200)')
+    record_parser.set_defaults(handler=command_record)
+
+    report_parser = subparsers.add_parser('report', help='Compare a run against the previous runs and list significant slowdowns')
+    report_parser.add_argument('--package', default='python-with-packages', help='Package the tests ran in (default: python-with-packages)')
+    report_parser.add_argument('--run', type=int, help='Run to check (default: the latest run of the package)')
+    report_parser.add_argument('--metric', action='append', choices=sorted(metrics), help='Metric to compare. Can be repeated (default: all)')
+    report_parser.add_argument('--window', type=int, default=10, help='Number of previous passing runs in the baseline (default: 10)')
+    report_parser.add_argument('--min-runs', type=int, default=3, help='Minimum number of previous runs to compare a test (default: 3)')
+    report_parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown that is reported, if it is significant (default: 0.2)')
+    report_parser.add_argument('--by', choices=('package', 'test'), default='package', help='Compare the tests of a package together, or every test on its own (default: package)')
+    report_parser.add_argument('--all', action='store_true', help='Show all compared packages or tests, not only the slower ones')
+    report_parser.add_argument('--fail', action='store_true', help='Exit with 1 if there are significant slowdowns')
+    report_parser.set_defaults(handler=command_report)
+
+    args = parser.parse_args()
+    if args.subcommand == 'measure':
+        args.handler(args)
+    else:
+        with History(args.history) as history:
+            args.handler(history, args)
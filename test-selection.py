@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Select the tests in tests/ that are affected by the artifacts that changed since they last ran.
+
+The dependency graph between the projects of the Makefile is read from the make database. A test covers the
+project it is named after, the projects whose modules it imports and the projects listed for it in
+resources/test-packages.txt. It is also affected by every project these depend on, at build time through
+their sysroots and at runtime through the requirements of their wheels. The shared sysroots every wheel is
+built against are not followed, a change of cpython itself selects every test.
+
+`map` prints the projects every test covers. `record` stores the artifact hashes of the latest recorded run of
+a package in the test history, next to the results of that run. `select` prints the tests whose test file, or
+the artifacts of one of their projects, changed since the last run they were part of.
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+from artifact_catalog import Catalog, sync_artifacts
+from build_common import canonicalize_name, file_sha256, test_stem
+
+history_file = os.getenv('TEST_HISTORY', 'test-history.sqlite')
+catalog_file = os.getenv('ARTIFACT_CATALOG', 'catalog.sqlite')
+overrides_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'test-packages.txt')
+python_wasix_binaries_wheels = 'python-wasix-binaries/wheels'
+
+# Sysroots that every wheel is built against. They only carry cpython, changes to it select every test anyway
+shared_projects = {'default', 'python-wheels'}
+# Projects that every test runs on
+runtime_projects = {'cpython'}
+
+schema = """
+CREATE TABLE IF NOT EXISTS tested_artifacts (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (run, key)
+);
+"""
+
+def make_database():
+    """Print the rules and variables of the Makefile without building anything."""
+    env = {**os.environ, 'SKIP_CC_CHECK': '1'}
+    result = subprocess.run(['make', '--no-print-directory', '-pRrq', '-f', 'Makefile', '.test-selection-nothing'], capture_output=True, env=env)
+    return result.stdout.decode('utf-8', errors='replace')
+
+def project_of(prerequisite):
+    """Get the project of a pkgs/<project>.<suffix> target."""
+    if not prerequisite.startswith('pkgs/'):
+        return None
+    return prerequisite[len('pkgs/'):].split('.')[0]
+
+class Projects:
+    def __init__(self, database, catalog=None):
+        self.variables = {}
+        self.dependencies = {}
+        self.runtime_requirements = {}
+        for line in database.splitlines():
+            match = re.match(r'^(WHEELS|LIBS|PYTHON_WASIX_BINARIES_WHEELS|DONT_INSTALL) :?= (.*)$', line)
+            if match is not None:
+                self.variables[match.group(1)] = match.group(2).split()
+                continue
+            target, _, prerequisites = line.partition(': ')
+            project = project_of(target)
+            # Target specific variables look like rules as well
+            if project is None or re.match(r'^\S+\s*[+?:]?=', prerequisites):
+                continue
+            # Order-only prerequisites like cross-venv are not inputs
+            for prerequisite in prerequisites.split('|')[0].split():
+                dependency = project_of(prerequisite)
+                if dependency is not None and dependency != project and dependency not in shared_projects:
+                    self.dependencies.setdefault(project, set()).add(dependency)
+
+        dont_install = set(self.variables.get('DONT_INSTALL', []))
+        self.wheels = [wheel for wheel in self.variables.get('WHEELS', []) if wheel not in dont_install]
+        self.pwb_wheels = [wheel for wheel in self.variables.get('PYTHON_WASIX_BINARIES_WHEELS', []) if wheel not in dont_install]
+        self.libs = self.variables.get('LIBS', [])
+
+        # Names a test file or an import can refer to a project by
+        self.aliases = {}
+        for project in self.libs + self.wheels:
+            self.add_alias(project, project)
+            self.add_alias(re.sub(r'^python-|-python$', '', project), project)
+        for wheel in self.pwb_wheels:
+            self.add_alias(wheel.split('-')[0], wheel)
+        if catalog is not None:
+            for project in self.wheels:
+                for row in catalog.for_project(project, 'wheel'):
+                    self.add_alias(row['name'], project)
+                    # Runtime dependencies of the wheel, extras are optional
+                    for requirement in json.loads(row['dependencies']):
+                        if 'extra' not in requirement:
+                            name = re.match(r'^[A-Za-z0-9._-]+', requirement)
+                            if name is not None:
+                                self.runtime_requirements.setdefault(project, set()).add(name.group(0))
+            for project, requirements in self.runtime_requirements.items():
+                for requirement in requirements:
+                    dependency = self.aliases.get(canonicalize_name(requirement))
+                    if dependency is not None and dependency != project:
+                        self.dependencies.setdefault(project, set()).add(dependency)
+
+    def add_alias(self, name, project):
+        self.aliases.setdefault(canonicalize_name(name), project)
+
+    def closure(self, projects):
+        """Get the projects and everything they depend on."""
+        result = set()
+        pending = list(projects)
+        while pending:
+            project = pending.pop()
+            if project not in result:
+                result.add(project)
+                pending.extend(self.dependencies.get(project, ()))
+        return result
+
+def imported_modules(test_file):
+    """Get the top-level modules a test file imports."""
+    with open(test_file, 'rb') as f:
+        try:
+            tree = ast.parse(f.read(), test_file)
+        except SyntaxError:
+            return set()
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split('.')[0])
+    return modules
+
+def load_overrides():
+    overrides = {}
+    if os.path.exists(overrides_file):
+        with open(overrides_file, 'r') as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if fields:
+                    overrides[fields[0]] = fields[1:]
+    return overrides
+
+def test_inputs(test_file, projects, overrides):
+    """Get the projects a test covers directly and the files in tests/ it depends on."""
+    covered = set()
+    files = {test_file}
+    alias = projects.aliases.get(canonicalize_name(test_stem(test_file)))
+    if alias is not None:
+        covered.add(alias)
+    for module in imported_modules(test_file):
+        local_file = os.path.join(os.path.dirname(test_file), f'{module}.py')
+        if os.path.exists(local_file):
+            files.add(local_file)
+        elif canonicalize_name(module) in projects.aliases:
+            covered.add(projects.aliases[canonicalize_name(module)])
+    covered.update(overrides.get(os.path.basename(test_file), []))
+    return covered, files
+
+def artifact_state(catalog, projects, test_files):
+    """Hash the artifacts of every project and every test file."""
+    state = {}
+    for project in projects.libs + projects.wheels:
+        rows = [row for row in catalog.for_project(project) if row['kind'] in ('lib', 'wheel', 'sdist')]
+        if rows:
+            state[project] = hashlib.sha256(' '.join(row['sha256'] for row in rows).encode('utf-8')).hexdigest()
+    for wheel in projects.pwb_wheels:
+        path = os.path.join(python_wasix_binaries_wheels, f'{wheel}.whl')
+        if os.path.exists(path):
+            state[wheel] = file_sha256(path)
+    for test_file in test_files:
+        state[test_file] = file_sha256(test_file)
+    return state
+
+def open_history(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA foreign_keys = ON')
+    return db
+
+def load(args):
+    """Read the Makefile and bring the catalog up to date."""
+    with Catalog(args.catalog) as catalog:
+        sync_artifacts(catalog)
+        projects = Projects(make_database(), catalog)
+        test_files = sorted(glob.glob('tests/*.py'))
+        return projects, test_files, artifact_state(catalog, projects, test_files)
+
+def command_map(args):
+    projects, test_files, _ = load(args)
+    overrides = load_overrides()
+    mapping = {}
+    for test_file in test_files:
+        covered, files = test_inputs(test_file, projects, overrides)
+        mapping[test_file] = {'covers': sorted(covered), 'files': sorted(files), 'depends': sorted(projects.closure(covered) - covered)}
+    if args.json:
+        print(json.dumps(mapping, indent=2))
+        return
+    for test_file, entry in mapping.items():
+        print(f"{test_file}: {' '.join(entry['covers']) or '-'}{' (depends on ' + ' '.join(entry['depends']) + ')' if entry['depends'] else ''}")
+    unmapped = [test_file for test_file, entry in mapping.items() if not entry['covers']]
+    if unmapped:
+        print(f"{len(unmapped)} tests are not mapped to a project, add them to {os.path.relpath(overrides_file)}: {' '.join(unmapped)}", file=sys.stderr)
+
+def command_record(args):
+    _, _, state = load(args)
+    db = open_history(args.history)
+    db.executescript(schema)
+    run = db.execute('SELECT id FROM runs WHERE package = ? ORDER BY id DESC LIMIT 1', (args.package,)).fetchone()
+    if run is None:
+        print(f"No recorded runs of {args.package}", file=sys.stderr)
+        exit(1)
+    db.executemany('INSERT OR REPLACE INTO tested_artifacts VALUES (?, ?, ?)', [(run['id'], key, sha256) for key, sha256 in state.items()])
+    db.commit()
+    db.close()
+
+def command_select(args):
+    projects, test_files, state = load(args)
+    overrides = load_overrides()
+    db = open_history(args.history)
+    db.executescript(schema)
+
+    selected = []
+    for test_file in args.tests or test_files:
+        # The artifacts of the last run of this test
+        run = db.execute(
+            'SELECT runs.id FROM results JOIN runs ON runs.id = results.run WHERE runs.package = ? AND results.test = ? ORDER BY runs.id DESC LIMIT 1',
+            (args.package, os.path.basename(test_file)),
+        ).fetchone()
+        tested = {} if run is None else {row['key']: row['sha256'] for row in db.execute('SELECT key, sha256 FROM tested_artifacts WHERE run = ?', (run['id'],))}
+        covered, files = test_inputs(test_file, projects, overrides)
+        inputs = projects.closure(covered) | runtime_projects | files
+        if not tested:
+            reasons = ['never ran' if run is None else 'no recorded artifacts']
+        else:
+            reasons = sorted(key for key in inputs if key in state and tested.get(key) != state[key])
+        if reasons:
+            selected.append(test_file)
+            if args.verbose:
+                print(f"{test_file}: {', '.join(reasons)}", file=sys.stderr)
+    db.close()
+    for test_file in selected:
+        print(test_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', default=history_file, help=f'Test history database of test-history.py (default: {history_file}, or $TEST_HISTORY)')
+    parser.add_argument('--catalog', default=catalog_file, help=f'Artifact catalog (default: {catalog_file}, or $ARTIFACT_CATALOG)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    map_parser = subparsers.add_parser('map', help='Print the projects each test covers and depends on')
+    map_parser.add_argument('--json', action='store_true', help='Print the mapping as JSON')
+    map_parser.set_defaults(handler=command_map)
+
+    record_parser = subparsers.add_parser('record', help='Store the current artifact hashes with the latest recorded run of a package')
+    record_parser.add_argument('--package', default='python-with-packages', help='Package the tests ran in (default: python-with-packages)')
+    record_parser.set_defaults(handler=command_record)
+
+    select_parser = subparsers.add_parser('select', help='Print the tests affected by changes since their last run')
+    select_parser.add_argument('--package', default='python-with-packages', help='Package the tests run in (default: python-with-packages)')
+    select_parser.add_argument('-v', '--verbose', action='store_true', help='Print why each test was selected')
+    select_parser.add_argument('tests', nargs='*', help='Only consider these tests (default: tests/*.py)')
+    select_parser.set_defaults(handler=command_select)
+
+    args = parser.parse_args()
+    args.handler(args)
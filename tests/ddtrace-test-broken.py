@@ -1,3 +1,4 @@
+# test-isolation: process
 # Works on native but prints an irrelevant error
 # Missing deps on WASIX
 import unittest
@@ -1,3 +1,4 @@
+# test-isolation: process
 import unittest
 import time as real_time
 
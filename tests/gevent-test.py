@@ -1,3 +1,4 @@
+# test-isolation: process
 import unittest
 import sys
 
@@ -1,4 +1,5 @@
 # Skipped because it gets stuck after the test is run
+# test-isolation: process
 import helloworld_pb2
 import helloworld_pb2_grpc
 import grpc
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Cache of the wheels needed to set up build environments.
+
+Every set of requirements is resolved once with `pip wheel` and stored in wheelhouse/<interpreter>/<key>/,
+where the key is a hash of the requirements and the active pip constraints. Later installs of the same set
+use `--no-index --find-links`, so they never hit the network and don't rebuild anything from source. Requirements
+that are URLs, like git+https://...@<commit>, are built on their own and installed by the name and version of the
+wheel they produced, otherwise pip would clone and build them again. Pin them to a commit, the key only covers their text.
+
+`install` installs requirements into the environment of an interpreter, e.g. while creating cross-venv.
+`exec` runs a command, usually `python3 -m build`, with pip pointed at the wheelhouse of the project in the
+current directory. It covers the static build requirements from pyproject.toml as well as the ones the build
+backend requests dynamically, which it reports after being imported from the unpacked static set. If a requirement
+set can not be resolved, the command runs with the index as before.
+
+The local index server serves the wheels in artifacts/, which change without a change to the requirements. A set
+resolved while pip used it records the hashes of the local wheels it contains, and is resolved again once they change.
+"""
+from build_common import canonicalize_name, file_sha256
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import urllib.parse
+import zipfile
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+wheelhouse_dir = os.path.abspath(os.getenv('WHEELHOUSE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wheelhouse')))
+artifacts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artifacts')
+complete_marker = 'requirements.txt'
+local_marker = 'local-wheels.json'
+# Build requirements of projects without a [build-system] table (PEP 518)
+default_build_requires = ['setuptools>=40.8.0']
+
+def normalize_requirement(requirement):
+    return re.sub(r'\s+', '', requirement)
+
+def interpreter_tag(python):
+    """Identify the interpreter and the platform its pip installs for. Cross environments report the target platform."""
+    if python == sys.executable:
+        tag = f"{sys.implementation.cache_tag}-{sysconfig.get_platform()}"
+    else:
+        code = 'import sys, sysconfig; print(f"{sys.implementation.cache_tag}-{sysconfig.get_platform()}")'
+        tag = subprocess.run([python, '-c', code], capture_output=True, check=True).stdout.decode('utf-8').strip()
+    return re.sub(r'[^\w.-]', '_', tag)
+
+def constraints():
+    """Get the content of the constraint files pip would apply, as they change the resolved set."""
+    content = []
+    for path in os.getenv('PIP_CONSTRAINT', '').split():
+        with open(path, 'r') as f:
+            content.append(f.read())
+    return content
+
+def requirement_set_dir(python, requirements):
+    requirements = sorted(set(map(normalize_requirement, requirements)))
+    key = hashlib.sha256(json.dumps([requirements, constraints()]).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(wheelhouse_dir, interpreter_tag(python), key), requirements
+
+def uses_local_index():
+    """Check if pip is pointed at the local index server, which serves the wheels in artifacts/."""
+    urls = f"{os.getenv('PIP_INDEX_URL', '')} {os.getenv('PIP_EXTRA_INDEX_URL', '')}".split()
+    return any(urllib.parse.urlsplit(url).hostname in ('127.0.0.1', 'localhost', '::1') for url in urls)
+
+def local_wheels(names):
+    """Get the hashes of the wheels in artifacts/ of the given distributions."""
+    wheels = {}
+    for filename in sorted(os.listdir(artifacts_dir)) if os.path.isdir(artifacts_dir) else []:
+        if filename.endswith('.whl') and canonicalize_name(filename.split('-')[0]) in names:
+            wheels[filename] = file_sha256(os.path.join(artifacts_dir, filename))
+    return wheels
+
+def local_wheels_changed(directory):
+    """Check if the local wheels a set was resolved with were rebuilt, or got a new version, since."""
+    try:
+        with open(os.path.join(directory, local_marker), 'r') as f:
+            recorded = json.load(f)
+    except FileNotFoundError:
+        return False
+    names = {canonicalize_name(filename.split('-')[0]) for filename in recorded}
+    return local_wheels(names) != recorded
+
+def is_url_requirement(requirement):
+    return '://' in requirement
+
+def wheel_requirement(filename):
+    """Requirement that installs exactly the given wheel, by its name and version."""
+    name, version = filename.split('-')[:2]
+    return f'{name}=={version}'
+
+def is_current(directory):
+    return os.path.exists(os.path.join(directory, complete_marker)) and not local_wheels_changed(directory)
+
+def fill(python, requirements):
+    """Make sure the wheels for a set of requirements are in the wheelhouse. Returns its directory.
+
+    The requirements.txt of the directory lists the requirements to install from it, with the URL requirements
+    replaced by the wheels that were built from them."""
+    directory, requirements = requirement_set_dir(python, requirements)
+    if is_current(directory):
+        print(f"Wheelhouse: using {os.path.relpath(directory)}", file=sys.stderr)
+        return directory
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    with open(f'{directory}.lock', 'w') as lock:
+        # Only one run resolves a set, the others use what it resolved
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_current(directory):
+            print(f"Wheelhouse: using {os.path.relpath(directory)}", file=sys.stderr)
+            return directory
+        if os.path.exists(os.path.join(directory, complete_marker)):
+            print(f"Wheelhouse: local wheels of {os.path.relpath(directory)} changed", file=sys.stderr)
+        print(f"Wheelhouse: resolving {' '.join(requirements)}", file=sys.stderr)
+        # Resolve into a temporary directory, so a failed run never leaves a partial set behind
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(directory), prefix='.tmp-')
+        try:
+            install_requirements = []
+            for requirement in requirements:
+                if not is_url_requirement(requirement):
+                    install_requirements.append(requirement)
+                    continue
+                if not re.search(r'@[0-9a-f]{40}(#|$)', requirement):
+                    print(f"Warning: {requirement} is not pinned to a commit, the wheelhouse will not notice when it changes", file=sys.stderr)
+                before = set(os.listdir(tmp_dir))
+                subprocess.run([python, '-m', 'pip', 'wheel', '--no-deps', '--wheel-dir', tmp_dir, requirement], check=True, stdout=sys.stderr)
+                install_requirements += [wheel_requirement(filename) for filename in sorted(set(os.listdir(tmp_dir)) - before)]
+            # The wheels built from URLs are found in the set, the rest of it is resolved as usual
+            subprocess.run([python, '-m', 'pip', 'wheel', '--find-links', tmp_dir, '--wheel-dir', tmp_dir, *install_requirements], check=True, stdout=sys.stderr)
+            if uses_local_index() and os.path.isdir(artifacts_dir):
+                # Wheels with the same name as one in artifacts/ came from the local index
+                local = set(os.listdir(artifacts_dir)).intersection(os.listdir(tmp_dir))
+                with open(os.path.join(tmp_dir, local_marker), 'w') as f:
+                    json.dump(local_wheels({canonicalize_name(filename.split('-')[0]) for filename in local}), f)
+            with open(os.path.join(tmp_dir, complete_marker), 'w') as f:
+                f.write(''.join(f'{requirement}\n' for requirement in install_requirements))
+            # Still stale, no other run replaces it while the lock is held
+            if os.path.exists(directory):
+                os.rename(directory, f'{tmp_dir}-stale')
+            os.rename(tmp_dir, directory)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(f'{tmp_dir}-stale', ignore_errors=True)
+    return directory
+
+def set_requirements(directory):
+    """Requirements to install a set with, from its requirements.txt."""
+    with open(os.path.join(directory, complete_marker), 'r') as f:
+        return f.read().split()
+
+def offline_env(directories):
+    """Environment variables that make pip install only from the given wheelhouse directories."""
+    return {'PIP_NO_INDEX': '1', 'PIP_FIND_LINKS': ' '.join(directories)}
+
+def static_build_requires(project_dir):
+    pyproject = os.path.join(project_dir, 'pyproject.toml')
+    if not os.path.exists(pyproject):
+        return list(default_build_requires)
+    with open(pyproject, 'rb') as f:
+        build_system = tomllib.load(f).get('build-system', {})
+    return build_system.get('requires', default_build_requires)
+
+def unpack_wheels(directory, target_dir):
+    """Make the wheels in a directory importable from target_dir. The backend is only imported to report its
+    requirements, so nothing has to be installed for that."""
+    for wheel in glob.glob(os.path.join(directory, '*.whl')):
+        with zipfile.ZipFile(wheel) as f:
+            for name in f.namelist():
+                top, _, path = name.partition('/')
+                if top.endswith('.data'):
+                    scheme, _, path = path.partition('/')
+                    if scheme not in ('purelib', 'platlib'):
+                        continue
+                else:
+                    path = name
+                if not path or path.endswith('/'):
+                    continue
+                destination = os.path.join(target_dir, path)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                with f.open(name) as source, open(destination, 'wb') as target:
+                    shutil.copyfileobj(source, target)
+
+def dynamic_build_requires(project_dir, distribution, static_dir):
+    """Ask the build backend for the requirements it adds on top of the static ones.
+
+    The answer is cached next to the static set, keyed by the project files that can influence it."""
+    from build import ProjectBuilder
+    from pyproject_hooks import default_subprocess_runner
+
+    project_hash = hashlib.sha256(distribution.encode('utf-8'))
+    for filename in ('pyproject.toml', 'setup.py', 'setup.cfg'):
+        path = os.path.join(project_dir, filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                project_hash.update(f.read())
+    cache_file = os.path.join(static_dir, 'dynamic', project_hash.hexdigest()[:16] + '.json')
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        unpack_wheels(static_dir, tmp_dir)
+
+        def runner(command, cwd=None, extra_environ=None):
+            pythonpath = os.pathsep.join(filter(None, [tmp_dir, os.getenv('PYTHONPATH')]))
+            default_subprocess_runner(command, cwd, {**(extra_environ or {}), 'PYTHONPATH': pythonpath})
+
+        builder = ProjectBuilder(project_dir, runner=runner)
+        requires = sorted(builder.get_requires_for_build(distribution))
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'w') as f:
+        json.dump(requires, f)
+    return requires
+
+def command_install(args):
+    try:
+        directory = fill(args.python, args.requirements)
+    except subprocess.CalledProcessError:
+        print("Wheelhouse: could not resolve the requirements, installing from the index", file=sys.stderr)
+        subprocess.run([args.python, '-m', 'pip', 'install', *args.requirements], check=True)
+        return
+    subprocess.run([args.python, '-m', 'pip', 'install', '--no-index', '--find-links', directory, *set_requirements(directory)], check=True)
+
+def command_exec(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        print("No command given", file=sys.stderr)
+        exit(1)
+    env = os.environ.copy()
+    try:
+        static_dir = fill(sys.executable, static_build_requires(args.project))
+        directories = [static_dir]
+        dynamic = dynamic_build_requires(args.project, args.distribution, static_dir)
+        if dynamic:
+            directories.append(fill(sys.executable, dynamic))
+        env.update(offline_env(directories))
+    except Exception as e:
+        print(f"Wheelhouse: not available for {os.path.abspath(args.project)} ({e}), using the index", file=sys.stderr)
+    sys.stdout.flush()
+    os.execvpe(command[0], command, env)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    install_parser = subparsers.add_parser('install', help='Install requirements from the wheelhouse, resolving them first if needed')
+    install_parser.add_argument('--python', default=sys.executable, help='Interpreter to install into (default: the one running this script)')
+    install_parser.add_argument('requirements', nargs='+')
+    install_parser.set_defaults(handler=command_install)
+
+    exec_parser = subparsers.add_parser('exec', help='Run a build command with pip pointed at the wheelhouse of a project')
+    exec_parser.add_argument('--project', default='.', help='Directory with the pyproject.toml (default: current directory)')
+    exec_parser.add_argument('--distribution', choices=('wheel', 'sdist'), default='wheel', help='Distribution that is built, the backend may need different requirements for each')
+    exec_parser.add_argument('command', nargs=argparse.REMAINDER)
+    exec_parser.set_defaults(handler=command_exec)
+
+    args = parser.parse_args()
+    args.handler(args)